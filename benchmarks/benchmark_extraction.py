@@ -0,0 +1,374 @@
+# Benchmark the extraction functions of mltools on synthetic data.
+# Generates multi-band GeoTIFFs and matching geojsons in mltools format (points and
+# polygons, with configurable count and density, over several image_ids), times
+# data_extractors and geojson_tools on them and reports throughput and peak memory.
+# Each benchmark runs in a child process (see runner.py), so that its peak memory
+# is its own.
+# Every benchmark also runs against older versions of mltools: options and
+# functions that a version does not have are replaced by the equivalent calls of
+# the original API, so that a baseline can be saved before a change.
+#
+# Usage:
+#     python benchmark_extraction.py --save baseline.json
+#     (change mltools)
+#     python benchmark_extraction.py --compare baseline.json
+
+import argparse
+import geojson
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+import geoio
+from osgeo import gdal, osr
+
+from mltools import data_extractors as de
+from mltools import geojson_tools as gt
+from runner import run_in_process
+
+# synthetic images are placed here, in lng/lat
+ORIGIN = (-122.4, 37.8)
+PIXEL_SIZE = 5e-6
+
+
+def make_image(file_name, xsize, ysize, bands=8, dtype=gdal.GDT_UInt16, seed=0,
+               zero_fraction=0.):
+    '''
+    Write a tiled GeoTIFF of random pixels in EPSG:4326.
+
+    INPUT   file_name (string): name of the image file
+            xsize, ysize (int): image dimensions in pixels
+            bands (int): number of bands. Defaults to 8.
+            dtype (int): GDAL data type. Defaults to GDT_UInt16.
+            seed (int): seed of the pixel values. Defaults to 0.
+            zero_fraction (float): fraction of the image lines that are zero in all
+                bands, as in a water-masked image. Defaults to 0.
+    '''
+    rng = np.random.RandomState(seed)
+    ds = gdal.GetDriverByName('GTiff').Create(file_name, xsize, ysize, bands, dtype,
+                                              ['TILED=YES'])
+    ds.SetGeoTransform((ORIGIN[0], PIXEL_SIZE, 0, ORIGIN[1], 0, -PIXEL_SIZE))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+
+    zero_lines = int(ysize * zero_fraction)
+    for b in xrange(1, bands + 1):
+        values = rng.randint(1, 2 ** 11, (ysize, xsize)).astype(np.uint16)
+        values[:zero_lines] = 0
+        ds.GetRasterBand(b).WriteArray(values)
+    ds.FlushCache()
+
+
+def make_mask(file_name, xsize, ysize, seed=0):
+    '''
+    Write a single-band binary GeoTIFF mask with the georeference of make_image.
+    '''
+    rng = np.random.RandomState(seed)
+    ds = gdal.GetDriverByName('GTiff').Create(file_name, xsize, ysize, 1,
+                                              gdal.GDT_Byte, ['TILED=YES'])
+    ds.SetGeoTransform((ORIGIN[0], PIXEL_SIZE, 0, ORIGIN[1], 0, -PIXEL_SIZE))
+    ds.GetRasterBand(1).WriteArray(rng.randint(0, 2, (ysize, xsize)).astype(np.uint8))
+    ds.FlushCache()
+
+
+def make_geojson(file_name, image_ids, xsize, ysize, features_per_image=1000,
+                 geometry='polygon', min_hw=5, max_hw=60, clusters=None, seed=0,
+                 classes=['No swimming pool', 'Swimming pool']):
+    '''
+    Write a geojson in mltools format with random features over the images.
+
+    INPUT   file_name (string): name of the geojson file
+            image_ids (list): image_id of each image
+            xsize, ysize (int): image dimensions in pixels
+            features_per_image (int): number of features per image. Defaults to 1000.
+            geometry (string): 'polygon' or 'point'. Defaults to 'polygon'.
+            min_hw, max_hw (int): range of the polygon side lengths in pixels.
+            clusters (int): number of clusters the features are packed in (dense
+                scenes), or None to spread them uniformly. Defaults to None.
+            seed (int): random seed. Defaults to 0.
+            classes (list): values of the class_name property.
+    '''
+    rng = np.random.RandomState(seed)
+    features, feature_id = [], 0
+
+    for image_id in image_ids:
+        if clusters:
+            centers = rng.uniform([max_hw, max_hw], [xsize - max_hw, ysize - max_hw],
+                                  (clusters, 2))
+            xy = centers[rng.randint(0, clusters, features_per_image)]
+            xy += rng.normal(0, 4 * max_hw, xy.shape)
+        else:
+            xy = rng.uniform(0, [xsize, ysize], (features_per_image, 2))
+        xy = np.clip(xy, 0, [xsize - max_hw - 1, ysize - max_hw - 1])
+        hw = rng.randint(min_hw, max_hw + 1, (features_per_image, 2))
+
+        for (x, y), (w, h) in zip(xy, hw):
+            lng, lat = ORIGIN[0] + x * PIXEL_SIZE, ORIGIN[1] - y * PIXEL_SIZE
+            if geometry == 'point':
+                geom = {'type': 'Point', 'coordinates': [lng, lat]}
+            else:
+                lng1, lat1 = lng + w * PIXEL_SIZE, lat - h * PIXEL_SIZE
+                geom = {'type': 'Polygon',
+                        'coordinates': [[[lng, lat], [lng1, lat], [lng1, lat1],
+                                         [lng, lat1], [lng, lat]]]}
+            features.append({'type': 'Feature', 'geometry': geom,
+                             'properties': {'image_id': image_id,
+                                            'feature_id': feature_id,
+                                            'class_name': classes[rng.randint(len(classes))]}})
+            feature_id += 1
+
+    with open(file_name, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+def make_dataset(data_dir, images=3, xsize=4096, ysize=4096, bands=8,
+                 features_per_image=2000, clusters=20):
+    '''
+    Generate the images (<image_id>.tif), a water mask and the geojsons used by the
+        benchmarks in data_dir.
+    '''
+    image_ids = ['10400100{:08X}'.format(i) for i in xrange(images)]
+    for i, image_id in enumerate(image_ids):
+        make_image(os.path.join(data_dir, image_id + '.tif'), xsize, ysize,
+                   bands=bands, seed=i, zero_fraction=0.3)
+    make_mask(os.path.join(data_dir, 'mask.tif'), xsize, ysize)
+    make_geojson(os.path.join(data_dir, 'polygons.geojson'), image_ids, xsize, ysize,
+                 features_per_image=features_per_image)
+    make_geojson(os.path.join(data_dir, 'dense.geojson'), image_ids, xsize, ysize,
+                 features_per_image=features_per_image, clusters=clusters)
+    make_geojson(os.path.join(data_dir, 'points.geojson'), image_ids, xsize, ysize,
+                 features_per_image=features_per_image, geometry='point')
+    return image_ids
+
+
+def _count_batches(batches, n=None):
+    '''
+    number of chips in the first n batches (all batches if n is None)
+    '''
+    ct = 0
+    for i, batch in enumerate(batches):
+        ct += len(batch[0])
+        if i + 1 == n:
+            break
+    return ct
+
+
+def _supported(function, **kwargs):
+    '''
+    the keyword arguments that function accepts; older versions of mltools do not
+        have all options
+    '''
+    args = inspect.getargspec(function).args
+    return {name: value for name, value in kwargs.iteritems() if name in args}
+
+
+def _get_iter_data_class(batches):
+    data = de.getIterData('polygons.geojson', batch_size=256, max_chip_hw=64)
+    return sum(len(data.next()[0]) for _ in xrange(batches))
+
+
+def _filter_polygon_size(n_features):
+    gt.filter_polygon_size('polygons.geojson', 'filtered.geojson', min_polygon_hw=10,
+                           max_polygon_hw=50)
+    return n_features
+
+
+def _apply_mask(image):
+    de.apply_mask(image, 'mask.tif', 'masked.tif')
+    ds = gdal.Open(image)
+    return (ds.RasterXSize * ds.RasterYSize * ds.RasterCount *
+            gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8)
+
+
+def _sliding_window(image, chip_size):
+    '''
+    chips of the windows that are not mostly zero (land), as in the deploy example
+    '''
+    chip_area = chip_size[0] * chip_size[1]
+    if hasattr(de, 'sliding_window'):
+        return _count_batches(de.sliding_window(image, chip_size, batch_size=256,
+                                                max_zeros=chip_area / 2))
+    # original API
+    img = geoio.GeoImage(image)
+    return sum(1 for chip in img.iter_window(win_size=chip_size, stride=chip_size)
+               if np.sum(chip == 0) < chip_area / 2)
+
+
+def _iter_features(input_file):
+    if hasattr(gt, 'iter_features'):
+        return sum(1 for _ in gt.iter_features(input_file))
+    # original API
+    return len(_get_from_full_load(input_file, []))
+
+
+def benchmarks(image_ids, features_per_image):
+    '''
+    Return the benchmarks as a dict {name: function}. Each function runs in the data
+        directory and returns the number of items it processed (chips or features;
+        bytes for apply_mask).
+    '''
+    image = image_ids[0] + '.tif'
+    n_features = len(image_ids) * features_per_image
+    return {
+        'get_data': lambda: len(de.get_data('polygons.geojson', mask=True)[0]),
+        'get_data_points': lambda: len(de.get_data('points.geojson',
+                                                   buffer=[16, 16])[0]),
+        'get_data_dense': lambda: len(de.get_data('dense.geojson', mask=True)[0]),
+        'get_data_dense_coalesce': lambda: len(de.get_data(
+            'dense.geojson', mask=True, **_supported(de.get_data, coalesce=True))[0]),
+        'get_data_packed': lambda: len(de.get_data(
+            'polygons.geojson', mask=True, **_supported(de.get_data, packed=True))[0]),
+        'get_iter_data': lambda: _count_batches(
+            de.get_iter_data('polygons.geojson', batch_size=256, max_chip_hw=64),
+            10),
+        'getIterData': lambda: _get_iter_data_class(5),
+        'filter_polygon_size': lambda: _filter_polygon_size(n_features),
+        'apply_mask': lambda: _apply_mask(image),
+        'random_window': lambda: len(de.random_window(image, [64, 64], no_chips=2000)),
+        'sliding_window': lambda: _sliding_window(image, [64, 64]),
+        'find_unique_values': lambda: len(gt.find_unique_values('polygons.geojson',
+                                                                'class_name')),
+        'get_from': lambda: len(gt.get_from('polygons.geojson',
+                                            ['feature_id', 'class_name'])),
+        'get_from_full_load': lambda: len(_get_from_full_load(
+            'polygons.geojson', ['feature_id', 'class_name'])),
+        'iter_features': lambda: _iter_features('polygons.geojson'),
+        'write_properties_to': lambda: _write_properties_to(),
+    }
+
+
+def _get_from_full_load(input_file, property_names):
+    '''
+    reference for get_from and iter_features: load the whole file with geojson.load
+    '''
+    with open(input_file) as f:
+        features = geojson.load(f)['features']
+    return [tuple([feat['properties'].get(x) for x in property_names])
+            for feat in features]
+
+
+class _Rows(list):
+    '''
+    rows of write_properties_to data. The original write_properties_to indexes them
+        with a one-element index array, which lists only accept in numpy < 1.12.
+    '''
+
+    def __getitem__(self, i):
+        if isinstance(i, np.ndarray):
+            i = int(i[0])
+        return list.__getitem__(self, i)
+
+
+def _write_properties_to():
+    ids = [v[0] for v in gt.get_from('polygons.geojson', ['feature_id'])][::2]
+    gt.write_properties_to(_Rows([(1., 'pool')] * len(ids)), ['score', 'class_name'],
+                           'polygons.geojson', 'classified.geojson',
+                           filter={'feature_id': ids})
+    return len(ids)
+
+
+def _run(name, data_dir, image_ids, features_per_image):
+    '''
+    child process: run one benchmark in data_dir
+    '''
+    os.chdir(data_dir)
+    return benchmarks(image_ids, features_per_image)[name]()
+
+
+def run(data_dir, image_ids, features_per_image, names=None, repeat=1,
+        timeout=3600):
+    '''
+    Run the benchmarks, each in a fresh process, and return {name: result}. With
+        repeat > 1, the fastest run of each benchmark is kept. A benchmark that takes
+        more than timeout seconds is stopped and reported as an error.
+    '''
+    names = names or sorted(benchmarks(image_ids, features_per_image))
+    report = {}
+    for name in names:
+        for _ in xrange(repeat):
+            result = run_in_process(_run, (name, data_dir, image_ids,
+                                           features_per_image), timeout=timeout)
+            best = report.get(name)
+            if best is None or 'error' in best or \
+                    result.get('seconds', np.inf) < best['seconds']:
+                report[name] = result
+    return report
+
+
+def compare(report, baseline):
+    '''
+    Print the report next to a baseline report.
+    '''
+    print '\n{:28s} {:>10s} {:>12s} {:>9s} {:>10s} {:>9s}'.format(
+        'benchmark', 'seconds', 'items/s', 'speedup', 'peak MB', 'mem')
+    for name in sorted(report):
+        result, base = report[name], baseline.get(name, {})
+        if 'error' in result:
+            print '{:28s} ERROR'.format(name)
+            continue
+        speedup = mem = ''
+        if 'seconds' in base:
+            speedup = '{:.2f}x'.format(base['seconds'] / max(result['seconds'], 1e-9))
+            mem = '{:.2f}x'.format(result['peak_mb'] / max(base['peak_mb'], 1e-9))
+        print '{:28s} {:10.3f} {:12.1f} {:>9s} {:10.1f} {:>9s}'.format(
+            name, result['seconds'], result['items_per_s'], speedup,
+            result['peak_mb'], mem)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark mltools extraction on synthetic GeoTIFFs.')
+    parser.add_argument('--data-dir', help='directory of the synthetic data; '
+                        'generated in a temporary directory if not given')
+    parser.add_argument('--images', type=int, default=3)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='width and height of the images in pixels')
+    parser.add_argument('--bands', type=int, default=8)
+    parser.add_argument('--features', type=int, default=2000,
+                        help='features per image')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='seconds after which a benchmark is stopped')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run')
+    parser.add_argument('--save', help='save the report to this json file')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='mltools_bench_')
+    try:
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        print 'Generating synthetic data in {}...'.format(data_dir)
+        image_ids = make_dataset(data_dir, images=args.images, xsize=args.size,
+                                 ysize=args.size, bands=args.bands,
+                                 features_per_image=args.features)
+
+        report = run(data_dir, image_ids, args.features, names=args.only,
+                     repeat=args.repeat, timeout=args.timeout)
+        baseline = {}
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        compare(report, baseline)
+
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'config': vars(args), 'results': report}, f, indent=2,
+                          sort_keys=True)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    errors = [name for name in report if 'error' in report[name]]
+    for name in errors:
+        print '\n{} failed:\n{}'.format(name, report[name]['error'])
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Benchmark reading a large geojson with geojson_tools, which reads files one
+# feature at a time, against loading the whole feature collection in memory with
+# geojson.load, as geojson_tools did before. Generates a geojson of random polygons
+# in mltools format and reports the time and peak memory of each reader. Each
+# reader runs in a child process (see runner.py), so that its peak memory is its
+# own. No imagery (and no GDAL call) is involved.
+#
+# Usage:
+#     python benchmark_geojson.py --features 200000
+
+import argparse
+import geojson
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+from mltools import geojson_tools as gt
+from runner import run_in_process
+
+
+def make_geojson(file_name, features=200000, vertices=5, seed=0):
+    '''
+    Write a geojson of random polygons in mltools format, one feature at a time.
+    '''
+    rng = np.random.RandomState(seed)
+    with open(file_name, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for i in xrange(features):
+            x, y = rng.uniform(-180, 180), rng.uniform(-80, 80)
+            ring = (np.array([x, y]) + rng.uniform(0, 1e-3, (vertices, 2))).tolist()
+            feature = {'type': 'Feature',
+                       'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]},
+                       'properties': {'feature_id': i,
+                                      'image_id': 'img{}'.format(i % 10),
+                                      'class_name': ['pool', 'no pool'][i % 2]}}
+            f.write((', ' if i else '') + json.dumps(feature))
+        f.write(']}')
+
+
+def _full_load(input_file):
+    with open(input_file) as f:
+        return len(geojson.load(f)['features'])
+
+
+def _get_from_full_load(input_file):
+    # get_from as it was before geojson_tools read files one feature at a time
+    with open(input_file) as f:
+        features = geojson.load(f)['features']
+    return len([tuple([feat['properties'].get(x) for x in ['feature_id', 'class_name']])
+                for feat in features])
+
+
+READERS = {
+    'geojson.load': _full_load,
+    'get_from_full_load': _get_from_full_load,
+    'iter_features': lambda input_file: sum(1 for _ in gt.iter_features(input_file)),
+    'get_from': lambda input_file: len(gt.get_from(input_file,
+                                                   ['feature_id', 'class_name'])),
+    'feature_index': lambda input_file: len(gt.FeatureIndex(input_file)),
+}
+
+
+def run(input_file, names, timeout=3600):
+    '''
+    Run the readers, each in a fresh process, and return {name: result}. A reader
+        that fails, dies or takes more than timeout seconds is reported as an error.
+    '''
+    return {name: run_in_process(READERS[name], (input_file,), timeout=timeout)
+            for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark streaming geojson reads against full loads.')
+    parser.add_argument('--features', type=int, default=200000)
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='seconds after which a reader is stopped')
+    parser.add_argument('--only', nargs='*', help='readers to run')
+    parser.add_argument('--save', help='save the report to this json file')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='mltools_bench_')
+    try:
+        input_file = os.path.join(data_dir, 'polygons.geojson')
+        make_geojson(input_file, features=args.features)
+        size_mb = os.path.getsize(input_file) / 1024. ** 2
+        print '{} features, {:.1f} MB'.format(args.features, size_mb)
+
+        report = run(input_file, args.only or sorted(READERS), timeout=args.timeout)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print '\n{:20s} {:>10s} {:>12s} {:>10s}'.format('reader', 'seconds',
+                                                 'features/s', 'peak MB')
+    for name in sorted(report):
+        result = report[name]
+        if 'error' in result:
+            print '{:20s} ERROR'.format(name)
+            continue
+        print '{:20s} {:10.2f} {:12.0f} {:10.1f}'.format(
+            name, result['seconds'], result['items_per_s'], result['peak_mb'])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': vars(args), 'file_mb': size_mb, 'results': report},
+                      f, indent=2, sort_keys=True)
+
+    errors = [name for name in report if 'error' in report[name]]
+    for name in errors:
+        print '\n{} failed:\n{}'.format(name, report[name]['error'])
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Run benchmark functions in child processes.
+# Each function runs in a fresh process, so that its peak memory is its own, and
+# the parent process survives functions that crash the interpreter (ex: in GDAL)
+# or hang.
+
+import multiprocessing
+import Queue
+import resource
+import time
+import traceback
+
+
+def _child(function, args, results):
+    '''
+    child process: run function(*args) and send back its timing and peak memory
+    '''
+    try:
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        items = function(*args)
+        seconds = time.time() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put({'seconds': seconds,
+                     'items': items,
+                     'items_per_s': items / max(seconds, 1e-9),
+                     'peak_mb': peak_rss / 1024.,
+                     'extra_peak_mb': (peak_rss - baseline_rss) / 1024.})
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+
+def _wait(p, results, timeout):
+    '''
+    result of the function running in process p. A process that dies without a
+        result (ex: a crash in GDAL) or runs for more than timeout seconds is
+        reported as an error.
+    '''
+    start = time.time()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not p.is_alive():
+                try:
+                    # the result may have arrived just before the process exited
+                    result = results.get(timeout=1)
+                except Queue.Empty:
+                    result = {'error': 'process exited with code {} and no '
+                                       'result'.format(p.exitcode)}
+                break
+            if time.time() - start > timeout:
+                p.terminate()
+                result = {'error': 'timed out after {} s'.format(timeout)}
+                break
+
+    p.join(10)
+    if p.is_alive():
+        p.terminate()
+        p.join()
+    if p.exitcode != 0 and 'error' not in result:
+        result = {'error': 'process exited with code {}'.format(p.exitcode)}
+    return result
+
+
+def run_in_process(function, args=(), timeout=3600):
+    '''
+    Run function(*args) in a fresh process. function returns the number of items
+        it processed.
+
+    INPUT   function (function): benchmark function
+            args (tuple): arguments of function. Defaults to ().
+            timeout (float): seconds after which the process is stopped. Defaults
+                to 3600.
+
+    OUTPUT  dictionary with the seconds, items, items_per_s, peak_mb (peak resident
+                memory of the process) and extra_peak_mb (peak memory above that of
+                the process before the call), or {'error': message} if the function
+                raised, the process died or it timed out.
+    '''
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_child, args=(function, args, results))
+    p.start()
+    return _wait(p, results, timeout)
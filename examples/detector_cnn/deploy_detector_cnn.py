@@ -3,10 +3,11 @@
 # In this example, we detect boats on a pansharpened image of Hong Kong harbor.
 # Implementation is with keras.
 
-import geoio
 import json
 import numpy as np
+import sys
 
+from mltools import deployment
 from mltools import geojson_tools as gt
 from keras.models import model_from_json
 from keras.optimizers import SGD
@@ -38,42 +39,27 @@ chip_area = chip_size[0]*chip_size[1]
 # 3. apply mask: de.apply_mask('1030010038CD4D00.tif', 'water_mask_resampled.tif' 
 #                              '1030010038CD4D00.tif') 
 image = '1030010038CD4D00.tif'
-img = geoio.GeoImage(image)
 
-# deploy model on chip batches
-chip_batch, location_batch, detections = [], [], []
+# deploy model on chip batches; a chip is mostly land, and skipped, if at least
+# chip_area/2 of its values (over all bands) are zero
+# the image is streamed in tiles, so memory use does not grow with its size
 batch_size = 32 
 stride = chip_size
-chips_in_image = img.meta.pixels/chip_area
 
-for i, (chip, location_dict) in enumerate(img.iter_window(win_size=chip_size, 
-                                                          stride=stride,
-                                                          return_location=True)):
-    if (i+1)%1000 == 0:
-        print '{}/{} chips'.format(i+1, chips_in_image)
+results = deployment.deploy(image, model.predict, chip_size, stride=stride,
+                            batch_size=batch_size, max_zeros=chip_area/2)
 
-    # if mostly land, move on
-    if np.sum(chip == 0) >= chip_area/2:
-        continue
+# a window is a boat if the boat probability is the larger one
+boats = deployment.detections(image, results, chip_size,
+                              select=lambda probs: probs[:, 0] > probs[:, 1])
 
-    chip_batch.append(chip.astype('float32')/255)
-    upper_left = location_dict['upper_left_pixel']
-    location_batch.append(location_dict['upper_left_pixel'])
-    if len(chip_batch) == batch_size:
-        chip_batch, location_batch = np.array(chip_batch), np.array(location_batch)
-        prob_dist_batch = model.predict(chip_batch)
-        detection_batch = location_batch[prob_dist_batch[:, 0] > prob_dist_batch[:, 1]]
-        detections.extend(detection_batch)
-        chip_batch, location_batch = [], []
-
-# convert center pixel coordinates to hex-encoded (lng,lat) and write to geojson
-no_detected = len(detections)
-if no_detected > 0:
-    results = [Point(img.raster_to_proj(*[d[0]+chip_size[0]/2,
-                                          d[1]+chip_size[1]/2])).wkb.encode('hex') for d in detections]
-    data = zip(results, range(no_detected), ['boat']*no_detected)
-    gt.write_to(data=data, property_names=['feature_id','class_name'], 
-                           output_file='detected_boats.geojson') 
-else:
+# convert center coordinates to hex-encoded (lng,lat) and write to geojson
+# detections are written as they are found, so the file is always written; it
+# holds no features if there are no detections
+data = ((Point(lng, lat).wkb.encode('hex'), i, 'boat')
+        for i, (lng, lat, _) in enumerate(boats))
+n_boats = gt.write_to(data=data, property_names=['feature_id','class_name'], 
+                      output_file='detected_boats.geojson') 
+if n_boats == 0:
     print 'There are no boat detections!'
     sys.exit(0)
@@ -86,13 +86,12 @@ train_boat_chips, test_boat_chips = boat_chips[:no_train], boat_chips[no_train:]
 print 'Collect background chips'
 img = geoio.GeoImage(image)
 no_noise = no_boats           # background chips = boat chips
-noise_chips, locations = [], []
-# invoke iter_window_random iterator
-for chip, location_dict in img.iter_window_random(win_size=chip_size, 
-                                                  no_chips=no_noise,
-                                                  return_location=True):
-    noise_chips.append(chip)
-    upper_left = location_dict['upper_left_pixel']
+# sample all chips in one pass; as before, no land filter is applied here
+# (pass reject=de.mostly_zero to redraw chips that are mostly land)
+noise_chips, upper_lefts = de.random_window_batch(image, chip_size,
+                                                  no_chips=no_noise)
+locations = []
+for upper_left in upper_lefts:
     center = [x+y for x,y in zip(upper_left, half_chip_size)]
     location = Point(img.raster_to_proj(*center))      # location in (lng, lat)  
     locations.append(location.wkb.encode('hex'))       # encode in hex
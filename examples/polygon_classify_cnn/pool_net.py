@@ -2,7 +2,6 @@ import numpy as np
 import random
 import json
 import geojson
-import subprocess
 from mltools.data_extractors import get_iter_data, getIterData
 from mltools.geojson_tools import write_properties_to
 from keras.layers.core import Dense, MaxoutDense, Dropout, Activation, Flatten, Reshape
@@ -146,24 +145,14 @@ class PoolNet(object):
 
     def _get_val_data(self, shapefile, val_size):
         '''
-        hacky...
-        creates validation data from input shapefile to use with fit_generator function
+        creates validation data from a shuffled pass over the input shapefile to use
+        with fit_generator function
         '''
-        with open(shapefile) as f:
-            data = geojson.load(f)
-            feats = data['features']
-            np.random.shuffle(feats)
-            data['features'] = feats
-
-        with open('tmp_val.geojson', 'w') as f:
-            geojson.dump(data, f)
-
-        val_gen = getIterData('tmp_val.geojson', batch_size=val_size,
+        val_gen = getIterData(shapefile, batch_size=val_size,
                               min_chip_hw=self.min_chip_hw, max_chip_hw=self.max_chip_hw,
-                              classes=self.classes)
+                              classes=self.classes, shuffle=True)
 
         x, y = val_gen.next()
-        subprocess.call('rm tmp_val.geojson', shell=True)
         return x, y
 
     def make_fc_model(self):
@@ -456,28 +445,26 @@ class PoolNet(object):
                     than catalog number. Defaults to None
         OUTPUT  (1) classified shapefile
         '''
-        yprob, ytrue = [], []
         if output_name[-8:] != '.geojson':
             output_file = '{}.geojson'.format(output_name)
         else:
             output_file = output_name
 
-        # Classify all chips in input shapefile
-        print 'Classifying test data...'
-        for x in get_iter_data(shapefile, batch_size = 5000, classes = self.classes,
-                                  max_chip_hw=self.input_shape[1], img_name=img_name,
-                                  min_chip_hw = self.min_chip_hw, return_labels=False):
-            print 'Classifying polygons...'
-            yprob += list(self.model.predict_proba(x)) # use model to predict classes
-
-        # Get predicted class and certainty of classification results
-        yhat = [np.argmax(i) for i in yprob]
-        ycert = [np.max(j) for j in yprob]
-
-        # Update shapefile, save as output_name
-        data = zip(yhat, ycert)
+        def classify():
+            # Classify all chips in input shapefile, one batch at a time
+            print 'Classifying test data...'
+            for x in get_iter_data(shapefile, batch_size = 5000, classes = self.classes,
+                                   max_chip_hw=self.input_shape[1], img_name=img_name,
+                                   min_chip_hw = self.min_chip_hw, return_labels=False):
+                print 'Classifying polygons...'
+                # predicted class and certainty of classification results
+                for yprob in self.model.predict_proba(x):
+                    yield int(np.argmax(yprob)), float(np.max(yprob))
+
+        # Update shapefile, save as output_name; results are written as they are
+        # computed
         property_names = ['CNN_class', 'certainty']
-        write_properties_to(data, property_names, shapefile, output_file)
+        write_properties_to(classify(), property_names, shapefile, output_file)
 
 
 # Evaluation methods
@@ -21,22 +21,21 @@ from sklearn.metrics import confusion_matrix
 # pixels can not always be extracted for all geometries in the file
 # so we need to know the ids of the polygons that will be classified
 print 'Read data'
-train_rasters, _, train_labels = de.get_data('train.geojson', return_labels=True, mask=True)
-test_rasters, _, test_labels = de.get_data('test.geojson', return_labels=True, mask=True)
-target_rasters, target_ids = de.get_data('target.geojson')
+# packed=True keeps the chips of each file in one contiguous buffer
+train_rasters, _, train_labels = de.get_data('train.geojson', return_labels=True,
+                                             mask=True, packed=True)
+test_rasters, _, test_labels = de.get_data('test.geojson', return_labels=True,
+                                           mask=True, packed=True)
+target_rasters, target_ids = de.get_data('target.geojson', packed=True)
 
 # You can create your own compute_features function here
 # or use one of the available functions in mltools.features
 compute_features = features.pool_basic
 
 print 'Compute features'
-feature_vectors = []
-for raster in train_rasters + test_rasters + target_rasters:
-    feature_vectors.append(compute_features(raster))
-
-X = feature_vectors[:len(train_rasters)]
-Y = feature_vectors[len(train_rasters):len(train_rasters)+len(test_rasters)]
-Z = feature_vectors[len(train_rasters)+len(test_rasters):]
+X = features.compute_all(train_rasters, compute_features)
+Y = features.compute_all(test_rasters, compute_features)
+Z = features.compute_all(target_rasters, compute_features)
 
 # Create classifier object.
 # n_estimators is the number of trees in the random forest.
@@ -1,4 +1,10 @@
+from . import chip_cache
+from . import chip_dataset
 from . import crowdsourcing
 from . import data_extractors
+from . import deployment
 from . import features
 from . import geojson_tools
+from . import metrics
+from . import packed_chips
+from . import raster_pool
@@ -0,0 +1,271 @@
+# Persistent on-disk cache for chips extracted from georeferenced imagery.
+# Chips are stored per (shapefile, image, extraction parameters) in flat
+# memory-mapped arrays, so repeated training runs can skip the raster reads.
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from packed_chips import PackedChips
+
+
+class ChipCache(object):
+    '''
+    Content-addressed cache of the chips produced by GeoImage.iter_vector. An entry
+        is keyed by the contents of the shapefile, the path and modification time of
+        the image, and the extraction parameters. When the total size of the cache
+        exceeds max_bytes, the least recently used entries are evicted.
+
+    INPUT   cache_dir (string): directory in which to store the cache entries. It is
+                created if it does not exist.
+            max_bytes (int): size budget of the cache in bytes. Defaults to 10 GB.
+
+    EXAMPLE
+            $ cache = ChipCache('/scratch/chips', max_bytes=50 * 1024 ** 3)
+            $ chips, ids = get_data('shapefile.geojson', cache=cache)
+            # the second call reads the chips from the cache
+            $ chips, ids = get_data('shapefile.geojson', cache=cache)
+    '''
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._digests = {}
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _file_digest(self, file_name):
+        '''
+        sha1 of the file contents, memoized on (path, size, mtime)
+        '''
+        stat = os.stat(file_name)
+        memo_key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+
+        if memo_key not in self._digests:
+            h = hashlib.sha1()
+            with open(file_name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self._digests[memo_key] = h.hexdigest()
+
+        return self._digests[memo_key]
+
+    def key(self, shapefile, image, **params):
+        '''
+        Compute the key of a cache entry.
+
+        INPUT   shapefile (string): name of the shapefile the chips are extracted from
+                image (string): name of the image the chips are extracted from
+                params: extraction parameters (ex: image_id, buffer, mask). Must be
+                    json serializable.
+        OUTPUT  key (string): hex digest identifying the entry
+        '''
+        image = os.path.abspath(image)
+        h = hashlib.sha1()
+        h.update(self._file_digest(shapefile))
+        h.update(image)
+        h.update(repr(os.path.getmtime(image)))
+        h.update(json.dumps(params, sort_keys=True))
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        '''
+        Return the CachedChips stored under key, or None on a cache miss.
+        '''
+        entry_dir = self._entry_dir(key)
+        index_file = os.path.join(entry_dir, 'index.json')
+        if not os.path.isfile(index_file):
+            return None
+
+        # mark entry as recently used
+        os.utime(index_file, None)
+        return CachedChips(entry_dir)
+
+    def writer(self, key):
+        '''
+        Return a ChipCacheWriter that stores chips under key.
+        '''
+        return ChipCacheWriter(self, key)
+
+    def size(self):
+        '''
+        Total size of the cache entries in bytes.
+        '''
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        '''
+        list of (last access time, key, size in bytes) for each committed entry
+        '''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            index_file = os.path.join(self._entry_dir(key), 'index.json')
+            try:
+                atime = os.path.getmtime(index_file)
+            except OSError:
+                continue    # not a committed entry
+            entry_dir = self._entry_dir(key)
+            size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                       for f in os.listdir(entry_dir))
+            entries.append((atime, key, size))
+        return entries
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used entries until the cache fits in max_bytes.
+
+        INPUT   keep (string): key of an entry that must not be evicted. Defaults to
+                    None.
+        '''
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+
+        for atime, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        '''
+        Remove all entries from the cache.
+        '''
+        for atime, key, size in self._entries():
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+
+class ChipCacheWriter(object):
+    '''
+    Appends chips to a new cache entry. The entry holds the buffers of a
+        PackedChips object (data.dat, mask.dat and the offsets and shapes in
+        index.json), written as the chips arrive. The entry becomes visible to
+        readers only after commit() is called; abort() discards it.
+
+    INPUT   cache (ChipCache): cache to write to
+            key (string): key of the new entry
+    '''
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmp_dir = '{}.tmp-{}'.format(cache._entry_dir(key), os.getpid())
+        self.dtype, self.has_mask = None, False
+        self.offsets, self.shapes, self.properties = [], [], []
+        self._offset = 0
+        self.committed = False
+
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self._data_file = open(os.path.join(self.tmp_dir, 'data.dat'), 'wb')
+        self._mask_file = open(os.path.join(self.tmp_dir, 'mask.dat'), 'wb')
+
+    def append(self, chip, properties):
+        '''
+        Add a chip (numpy array or masked array) and its properties to the entry.
+        '''
+        data = np.ma.getdata(chip)
+        if self.dtype is None:
+            self.dtype = data.dtype
+            self.has_mask = isinstance(chip, np.ma.MaskedArray)
+
+        self._data_file.write(np.ascontiguousarray(data, dtype=self.dtype).tobytes())
+        if self.has_mask:
+            self._mask_file.write(np.ma.getmaskarray(chip).tobytes())
+
+        self.offsets.append(self._offset)
+        self.shapes.append(list(data.shape))
+        self.properties.append(properties)
+        self._offset += data.size
+
+    def commit(self):
+        '''
+        Write the index, publish the entry and evict old entries if required.
+        '''
+        self._data_file.close()
+        self._mask_file.close()
+
+        if self.dtype is None:
+            self.dtype = np.dtype(np.uint8)     # no chips were appended
+
+        index = {'dtype': self.dtype.str,
+                 'has_mask': self.has_mask,
+                 'offsets': self.offsets,
+                 'shapes': self.shapes,
+                 'properties': self.properties}
+        with open(os.path.join(self.tmp_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+        entry_dir = self.cache._entry_dir(self.key)
+        try:
+            os.rename(self.tmp_dir, entry_dir)
+        except OSError:
+            # another process committed the same entry first
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.committed = True
+
+        self.cache.evict(keep=self.key)
+
+    def abort(self):
+        '''
+        Discard the entry.
+        '''
+        self._data_file.close()
+        self._mask_file.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class CachedChips(PackedChips):
+    '''
+    Read-only view of a cache entry: a PackedChips object whose buffers are
+        memory-mapped from disk, with the properties of each chip. Nothing is read
+        until a chip is accessed.
+
+    INPUT   entry_dir (string): directory of a committed cache entry
+    '''
+
+    def __init__(self, entry_dir):
+        with open(os.path.join(entry_dir, 'index.json')) as f:
+            index = json.load(f)
+
+        dtype = np.dtype(str(index['dtype']))
+        data = self._memmap(os.path.join(entry_dir, 'data.dat'), dtype)
+        mask = None
+        if index['has_mask']:
+            mask = self._memmap(os.path.join(entry_dir, 'mask.dat'), np.bool_)
+        PackedChips.__init__(self, data, index['offsets'], index['shapes'], mask)
+
+        self.properties = index['properties']
+        self._position = None
+
+    def _memmap(self, file_name, dtype):
+        # numpy can not memory map empty files
+        if os.path.getsize(file_name) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_name, dtype=dtype, mode='r')
+
+    def get(self, feature_id):
+        '''
+        Return the chip of the geometry with the given feature_id, or None.
+        '''
+        if self._position is None:
+            self._position = {p.get('feature_id'): i
+                              for i, p in enumerate(self.properties)}
+        i = self._position.get(feature_id)
+        if i is None:
+            return None
+        return self[i]
+
+    def __iter__(self):
+        '''
+        Yield (chip, properties) in extraction order, like GeoImage.iter_vector.
+        '''
+        for i in xrange(len(self)):
+            yield self[i], self.properties[i]
@@ -0,0 +1,299 @@
+# Sharded on-disk datasets of extracted chips.
+# Chips streamed from the chip generators in data_extractors are written to
+# fixed-size shards of numpy arrays with a global index, so that training jobs
+# can read them without GDAL or the source imagery.
+
+import json
+import os
+import data_extractors as de
+import geojson_tools as gt
+import numpy as np
+
+
+class ChipShardWriter(object):
+    '''
+    Writes chips and their label, feature_id and image_id columns to fixed-size
+        shards. Each shard is a set of .npy files (chips, labels, feature_ids,
+        image_ids); index.json lists the shards and their sizes and the number of
+        classes. Only one shard is held in memory at a time.
+
+    INPUT   output_dir (string): directory of the dataset. It is created if it does
+                not exist.
+            shard_size (int): number of chips per shard. Defaults to 10000.
+            dtype (string): data type of the stored chips (ex: 'uint8', 'uint16').
+                Defaults to 'uint8'.
+            classes (list['string']): class names; labels are stored as indices in
+                this list. If None, the number of classes is the largest label
+                over all shards plus one (so it is known only at close()).
+                Defaults to None.
+
+    EXAMPLE
+            $ writer = ChipShardWriter('pools_dataset', shard_size=5000)
+            $ writer.add(chips, feature_ids=ids, labels=y)
+            $ writer.close()
+    '''
+
+    def __init__(self, output_dir, shard_size=10000, dtype='uint8', classes=None):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.classes = classes
+        self.shards = []
+        self._buffers = None
+        self._ct = 0
+        self._max_label = -1
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+    def _new_buffers(self, chip_shape):
+        self._buffers = {
+            'chips': np.zeros((self.shard_size,) + chip_shape, dtype=self.dtype),
+            'labels': np.full(self.shard_size, -1, dtype=np.int32),
+            'feature_ids': np.zeros(self.shard_size, dtype=object),
+            'image_ids': np.zeros(self.shard_size, dtype=object)}
+
+    def add(self, chips, feature_ids=None, labels=None, image_ids=None):
+        '''
+        Append a batch of chips.
+
+        INPUT   chips (array): chips of shape (n, bands, h, w), of the dtype of the
+                    dataset. Chips are not converted: a ValueError is raised if the
+                    dtype differs (a float32 batch of normalized chips would be
+                    truncated to zeros in a uint8 dataset).
+                feature_ids (list): feature_id of each chip. Defaults to None.
+                labels (array): one-hot labels of shape (n, nb_classes) or class
+                    indices of shape (n,). Defaults to None.
+                image_ids (list): image_id of each chip. Defaults to None.
+        '''
+        chips = np.asarray(chips)
+        if chips.dtype != self.dtype:
+            raise ValueError('Chips of dtype {} can not be added to a dataset of '
+                             'dtype {}; create the batches with dtype={!r} and '
+                             'normalize=False'.format(chips.dtype, self.dtype,
+                                                      self.dtype.name))
+        n = len(chips)
+        if labels is not None:
+            labels = np.asarray(labels)
+            if labels.ndim == 2:
+                labels = labels.argmax(axis=1)
+            if len(labels):
+                self._max_label = max(self._max_label, int(labels.max()))
+
+        start = 0
+        while start < n:
+            if self._buffers is None:
+                self._new_buffers(chips.shape[1:])
+            m = min(self.shard_size - self._ct, n - start)
+            dst = slice(self._ct, self._ct + m)
+            src = slice(start, start + m)
+
+            self._buffers['chips'][dst] = chips[src]
+            if labels is not None:
+                self._buffers['labels'][dst] = labels[src]
+            if feature_ids is not None:
+                self._buffers['feature_ids'][dst] = list(feature_ids[src])
+            if image_ids is not None:
+                self._buffers['image_ids'][dst] = list(image_ids[src])
+
+            self._ct += m
+            start += m
+            if self._ct == self.shard_size:
+                self._flush()
+
+    def _flush(self):
+        '''
+        write the current shard to disk
+        '''
+        if self._ct == 0:
+            return
+
+        name = 'shard_{:05d}'.format(len(self.shards))
+        for column, values in self._buffers.iteritems():
+            values = values[:self._ct]
+            if values.dtype == object:
+                # let numpy infer int or string ids; anything else is stored as
+                # strings, so that shards load without pickle
+                values = np.array(values.tolist())
+                if values.dtype == object:
+                    values = values.astype(unicode)
+            np.save(os.path.join(self.output_dir, '{}_{}.npy'.format(name, column)),
+                    values)
+
+        self.shards.append({'name': name, 'size': self._ct})
+        self._buffers, self._ct = None, 0
+
+    def close(self):
+        '''
+        Write the last (partial) shard and the index.
+        '''
+        self._flush()
+        if self.classes:
+            nb_classes = len(self.classes)
+        else:
+            nb_classes = self._max_label + 1
+        index = {'shards': self.shards,
+                 'dtype': self.dtype.str,
+                 'classes': self.classes,
+                 'nb_classes': nb_classes}
+        with open(os.path.join(self.output_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+
+def export_chips(batches, output_dir, shard_size=10000, dtype='uint8', classes=None,
+                 shapefile=None, max_chips=None):
+    '''
+    Stream batches from get_iter_data or getIterData into a sharded chip dataset.
+
+    INPUT   batches (iterator): yields [chips, feature_ids, labels], i.e. a
+                generator created with return_id=True and return_labels=True. Create
+                it with dtype equal to the dtype of the dataset (ex: 'uint8');
+                batches of another dtype raise a ValueError.
+            output_dir (string): directory of the dataset
+            shard_size (int): number of chips per shard. Defaults to 10000.
+            dtype (string): data type of the stored chips. Defaults to 'uint8'.
+            classes (list['string']): class names of the labels. Defaults to None.
+            shapefile (string): shapefile the chips come from. If given, the image_id
+                of each chip is looked up from its feature_id; a feature_id that is
+                not in the shapefile raises a KeyError. Defaults to None.
+            max_chips (int): stop after this many chips (required for getIterData,
+                which streams indefinitely). Defaults to None.
+
+    OUTPUT  number of exported chips
+    '''
+    writer = ChipShardWriter(output_dir, shard_size=shard_size, dtype=dtype,
+                             classes=classes)
+    index = gt.feature_index(shapefile) if shapefile else None
+    total = 0
+
+    for chips, feature_ids, labels in batches:
+        if max_chips is not None:
+            n = min(len(chips), max_chips - total)
+            chips, feature_ids, labels = chips[:n], feature_ids[:n], labels[:n]
+
+        image_ids = None
+        if index is not None:
+            image_ids = []
+            for fid in feature_ids:
+                position = index.position(fid)
+                if position is None:
+                    raise KeyError('feature_id {!r} not found in {}'.format(
+                        fid, shapefile))
+                image_ids.append(index.columns['image_id'][position])
+
+        writer.add(chips, feature_ids=feature_ids, labels=labels, image_ids=image_ids)
+        total += len(chips)
+        if max_chips is not None and total >= max_chips:
+            break
+
+    writer.close()
+    return total
+
+
+class ChipDataset(object):
+    '''
+    Reads a sharded chip dataset written by ChipShardWriter or export_chips. Shards
+        are memory-mapped, so random access only reads the chips it touches.
+
+    INPUT   dataset_dir (string): directory of the dataset
+
+    EXAMPLE
+            $ data = ChipDataset('pools_dataset')
+            $ chip, label, feature_id, image_id = data[12]
+            $ for x, y in data.iter_batches(batch_size=32):
+            $     model.train_on_batch(x, y)
+    '''
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, 'index.json')) as f:
+            index = json.load(f)
+
+        self.shards = index['shards']
+        self.classes = index['classes']
+        # datasets written before the class count was stored only know it from
+        # their class names
+        self.nb_classes = index.get('nb_classes')
+        if self.nb_classes is None and self.classes:
+            self.nb_classes = len(self.classes)
+        self.dtype = np.dtype(str(index['dtype']))
+        sizes = [shard['size'] for shard in self.shards]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+        self._open = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, i):
+        '''
+        Return the columns (dict of arrays) of the i-th shard, memory-mapped.
+        '''
+        if i not in self._open:
+            name = self.shards[i]['name']
+            self._open[i] = {
+                column: np.load(os.path.join(self.dataset_dir,
+                                             '{}_{}.npy'.format(name, column)),
+                                mmap_mode='r')
+                for column in ['chips', 'labels', 'feature_ids', 'image_ids']}
+        return self._open[i]
+
+    def __getitem__(self, i):
+        '''
+        Return (chip, label, feature_id, image_id) of the i-th chip.
+        '''
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chip index out of range')
+
+        s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        columns, j = self.shard(s), i - self.offsets[s]
+        return (columns['chips'][j], int(columns['labels'][j]),
+                columns['feature_ids'][j], columns['image_ids'][j])
+
+    def iter_batches(self, batch_size=32, shuffle=True, seed=None, return_id=False,
+                     dtype='float32', normalize=True):
+        '''
+        Yield batches over the whole dataset (one epoch).
+
+        INPUT   batch_size (int): number of chips per batch. Defaults to 32.
+                shuffle (bool): visit the shards in random order and the chips of each
+                    shard in random order. Reads stay within one shard at a time.
+                    Defaults to True.
+                seed (int): seed for shuffling. Defaults to None.
+                return_id (bool): include feature ids in the output. Defaults to
+                    False.
+                dtype (string): data type of the chip batches. Defaults to 'float32'.
+                normalize (bool): divide chips by 255 (floating point dtypes only).
+                    Defaults to True.
+
+        OUTPUT  generator of [chips, feature_ids (if return_id), one-hot labels]. The
+                    labels of every batch have nb_classes columns.
+        '''
+        if self.nb_classes is None:
+            raise ValueError('The index of {} has neither classes nor a class '
+                             'count; export the dataset again with '
+                             'classes'.format(self.dataset_dir))
+
+        rng = np.random.RandomState(seed)
+        shard_order = np.arange(len(self.shards))
+        if shuffle:
+            rng.shuffle(shard_order)
+
+        for s in shard_order:
+            columns = self.shard(s)
+            order = np.arange(self.shards[s]['size'])
+            if shuffle:
+                order = rng.permutation(order)
+            for start in xrange(0, len(order), batch_size):
+                # sorted rows make the reads within a batch sequential on disk
+                rows = np.sort(order[start:start + batch_size])
+                chips = np.array(columns['chips'][rows], dtype=dtype)
+                de._normalize(chips, normalize)
+                data = [chips]
+
+                if return_id:
+                    data.append(np.asarray(columns['feature_ids'][rows]))
+
+                data.append(de._one_hot(columns['labels'][rows], self.nb_classes))
+                yield data
@@ -3,17 +3,44 @@
 # for machine learning algorithms.
 
 import geoio
-import geojson
 import geojson_tools as gt
+import json
 import numpy as np
+import os
+import Queue
+import atexit
+import raster_pool
+from metrics import ExtractionMetrics, print_progress
+from packed_chips import PackedChips
 import sys
-from itertools import cycle
+import threading
+import time
+import weakref
+from itertools import chain, cycle, islice, repeat
 import osgeo.gdal as gdal
+from osgeo import gdal_array, ogr, osr
 from osgeo.gdalconst import *
 from functools import reduce
-
-
-def get_data(shapefile, return_labels=False, buffer=[0, 0], mask=False):
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from numpy.lib.stride_tricks import as_strided
+
+# spatial reference of geojson coordinates
+_WGS84 = osr.SpatialReference()
+_WGS84.ImportFromEPSG(4326)
+if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+    # GDAL 3 would otherwise expect (lat, lng)
+    _WGS84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+# read-time resampling algorithms
+_RESAMPLE_ALGS = {'nearest': gdal.GRIORA_NearestNeighbour,
+                  'bilinear': gdal.GRIORA_Bilinear,
+                  'cubic': gdal.GRIORA_Cubic,
+                  'average': gdal.GRIORA_Average,
+                  'mode': gdal.GRIORA_Mode}
+
+def get_data(shapefile, return_labels=False, buffer=[0, 0], mask=False, workers=1,
+             cache=None, coalesce=False, packed=False):
     """Return pixel intensity array for each geometry in shapefile.
        The image reference for each geometry is found in the image_id
        property of the shapefile.
@@ -21,6 +48,8 @@ def get_data(shapefile, return_labels=False, buffer=[0, 0], mask=False):
        The function also returns a list of geometry ids; this is useful in
        case some of the shapefile entries do not produce a valid intensity
        array and/or class name.
+       If workers > 1, the image strips are processed in parallel by a pool of
+       worker processes. The output order is the same as for workers=1.
 
        Args:
            shapefile (str): Name of shapefile in mltools geojson format.
@@ -28,55 +57,518 @@ def get_data(shapefile, return_labels=False, buffer=[0, 0], mask=False):
            buffer (list): 2-dim buffer in PIXELS. The size of the box in each
                           dimension is TWICE the buffer size.
            mask (bool): Return a masked array.
+           workers (int): Number of worker processes. Each process extracts
+                          the chips of one image strip at a time.
+           cache (ChipCache): Read chips from (and store them in) this chip
+                              cache. Defaults to None.
+           coalesce (bool): Read spatially clustered geometries with one
+                            raster read per cluster instead of one per
+                            geometry, and rasterize their masks in one
+                            pass. Chips are then ordered by cluster within
+                            each image. Chips are those of iter_vector,
+                            but masks stay aligned with buffered windows
+                            (see _iter_coalesced). Defaults to False.
+           packed (bool): Return the chips as a PackedChips object, which
+                          holds all chips in one contiguous buffer and
+                          can be saved and memory-mapped. Worker processes
+                          then send back one buffer per image.
 
        Returns:
-           chips (list): List of pixel intensity numpy arrays.
+           chips (list): List of pixel intensity numpy arrays (a
+                         PackedChips object if packed=True).
            ids (list): List of corresponding geometry ids.
            labels (list): List of class names, if return_labels=True
     """
 
-    data = []
-
     # go through point_file and unique image_id's
     image_ids = gt.find_unique_values(shapefile, property_name='image_id')
+    jobs = [(shapefile, image_id, return_labels, buffer, mask, cache, coalesce,
+             packed) for image_id in image_ids]
 
     # go through the shapefile for each image --- this is how geoio works
-    for image_id in image_ids:
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(processes=min(workers, len(jobs)))
+        try:
+            # map preserves the order of image_ids
+            results = pool.map(_get_data_from_img_id, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_get_data_from_img_id, jobs)
+
+    if packed:
+        output = [PackedChips.concatenate(chips for chips, _ in results)]
+        for j in xrange(2 if return_labels else 1):
+            output.append([value for _, columns in results for value in columns[j]])
+        return output
+
+    data = [this_data for result in results for this_data in result]
 
-        # add tif extension
-        img = geoio.GeoImage(image_id + '.tif')
+    return zip(*data)
 
-        for chip, properties in img.iter_vector(vector=shapefile,
-                                                properties=True,
-                                                filter=[
-                                                    {'image_id': image_id}],
-                                                buffer=buffer,
-                                                mask=mask):
 
-            if chip is None or reduce(lambda x, y: x * y, chip.shape) == 0:
-                continue
+def _get_data_from_img_id(job):
+    """Extract the get_data entries of a single image strip. This is a module
+       level function so that it can be pickled and sent to worker processes.
 
-            # every geometry must have id
-            this_data = [chip, properties['feature_id']]
+       Args:
+           job (tuple): (shapefile, image_id, return_labels, buffer, mask,
+                        cache, coalesce, packed).
 
-            if return_labels:
-                try:
-                    label = properties['class_name']
-                    if label is None:
-                        continue
-                except (TypeError, KeyError):
+       Returns:
+           List of [chip, feature_id] or [chip, feature_id, label] entries.
+           If packed, (PackedChips, [feature_ids] or [feature_ids, labels]).
+    """
+
+    (shapefile, image_id, return_labels, buffer, mask, cache, coalesce,
+     packed) = job
+    data = []
+
+    # add tif extension
+    for chip, properties in _iter_vector(image_id + '.tif', shapefile, image_id,
+                                         buffer=buffer, mask=mask, cache=cache,
+                                         coalesce=coalesce):
+
+        if chip is None or reduce(lambda x, y: x * y, chip.shape) == 0:
+            continue
+
+        # every geometry must have id
+        this_data = [chip, properties['feature_id']]
+
+        if return_labels:
+            try:
+                label = properties['class_name']
+                if label is None:
                     continue
-                this_data.append(label)
+            except (TypeError, KeyError):
+                continue
+            this_data.append(label)
 
-            data.append(this_data)
+        data.append(this_data)
 
-    return zip(*data)
+    if packed:
+        columns = zip(*data)
+        if not columns:
+            columns = [[]] * (3 if return_labels else 2)
+        return PackedChips.from_chips(columns[0]), columns[1:]
+
+    return data
+
+
+def _iter_vector(image, shapefile, img_id, buffer=[0, 0], mask=False, cache=None,
+                 coalesce=False, start=0):
+    """Yield (chip, properties) for each geometry of img_id in shapefile, like
+       GeoImage.iter_vector: one item per geometry, in file order (in the
+       order of _iter_coalesced with coalesce), with chip None if the
+       geometry is not in the image. The geometries of img_id are looked up
+       in the index of the shapefile, so the rest of the shapefile is not
+       read. The first start geometries are skipped without being read, so
+       that an iteration can continue from a checkpoint.
+       If a chip cache is given, chips are read from the cache when
+       available; otherwise they are extracted from the image and stored in
+       the cache once the image has been fully traversed from the first
+       geometry.
+
+       Args:
+           image (str): Image file name.
+           shapefile (str): Name of shapefile in mltools geojson format.
+           img_id (str): Value of the image_id property to filter on.
+           buffer (list): 2-dim buffer in PIXELS.
+           mask (bool): Return masked arrays.
+           cache (ChipCache): Chip cache. Defaults to None (no caching).
+           coalesce (bool): Read the geometries with _iter_coalesced.
+           start (int): Number of geometries to skip.
+    """
+    index = gt.feature_index(shapefile)
+    positions = index.offsets('image_id', img_id)
+
+    writer = None
+    if cache is not None:
+        key = _cache_key(cache, image, shapefile, img_id, buffer, mask, coalesce)
+        cached = cache.get(key)
+        if cached is not None:
+            # the cache does not store the geometries without chip; with
+            # coalesce, these come first
+            if coalesce:
+                items = chain(repeat((None, None), len(positions) - len(cached)),
+                              cached)
+            else:
+                items = _cached_items(cached,
+                                      index.columns['feature_id'][positions].tolist())
+            for item in islice(items, start, None):
+                yield item
+            return
+        if start == 0:
+            writer = cache.writer(key)
+
+    if coalesce:
+        chips = _iter_coalesced(image, index.features(positions), buffer=buffer,
+                                mask=mask, start=start)
+    else:
+        chips = _iter_features_data(image, index.features(positions[start:]),
+                                    buffer=buffer, mask=mask)
+    try:
+        for chip, properties in chips:
+            if writer is not None and chip is not None:
+                writer.append(chip, properties)
+            yield chip, properties
+
+        if writer is not None:
+            writer.commit()
+    finally:
+        # extraction failed or the consumer stopped early; drop the partial entry
+        if writer is not None and not writer.committed:
+            writer.abort()
+
+
+def _cached_items(cached, feature_ids):
+    """Yield (chip, properties) from a cache entry for each of feature_ids,
+       or (None, None) for the feature_ids without chip. The entry holds the
+       chips of a subsequence of feature_ids, in the same order.
+    """
+    i = 0
+    for feature_id in feature_ids:
+        if i < len(cached) and cached.properties[i].get('feature_id') == feature_id:
+            yield cached[i], cached.properties[i]
+            i += 1
+        else:
+            yield None, None
+
+
+def _iter_features_data(image, features, buffer=[0, 0], mask=False):
+    """Yield (chip, properties) for each feature, reading the chips one at a
+       time with _get_feature_data.
+    """
+    img = raster_pool.open_image(image)
+    transform = _image_transform(raster_pool.open_dataset(image))
+    for feature in features:
+        chip = _get_feature_data(img, feature, buffer=buffer, mask=mask,
+                                 transform=transform)
+        yield chip, feature.get('properties') or {}
+
+
+def _cache_key(cache, image, shapefile, img_id, buffer, mask, coalesce=False):
+    """Key of the chip cache entry holding the chips of img_id."""
+    params = {'image_id': img_id, 'buffer': list(buffer), 'mask': mask}
+    if coalesce:
+        # chips are read differently, in a different order
+        params['coalesce'] = True
+    return cache.key(shapefile, image, **params)
+
+
+def _get_feature_data(img, feature, buffer=[0, 0], mask=False, transform=None):
+    """Extract the chip of a single geojson feature.
+
+       Args:
+           img (GeoImage): Image to read from.
+           feature (dict): geojson feature (lng, lat coordinates).
+           buffer (list): 2-dim buffer in PIXELS.
+           mask (bool): Return a masked array.
+           transform (CoordinateTransformation): Transformation to the spatial
+               reference of img (see _image_transform). Defaults to None (img
+               is in lng, lat).
+
+       Returns:
+           Pixel intensity numpy array, or None if the feature is not in img.
+    """
+    geom = _image_geometry(feature, transform)
+    try:
+        return img.get_data(geom=geom, buffer=buffer, mask=mask)
+    except geoio.base.OverlapError:
+        return None
+
+
+def _iter_resampled(image, features, size, min_hw=0, resample='average',
+                    buffer=[0, 0], mask=True):
+    """Yield (chip, properties) for each feature, with the window of the
+       feature read at the resolution at which its longer side is size
+       pixels. GDAL resamples while reading (using overviews when the image
+       has them), so large polygons read fewer bytes. Features whose window
+       is smaller than min_hw pixels at full resolution are skipped.
+
+       Args:
+           image (str): Image file name.
+           features (iterable): geojson feature dicts (lng, lat coordinates).
+           size (int): Length in pixels of the longer side of each chip.
+           min_hw (int): Minimum side length in pixels at full resolution.
+           resample (str): One of 'nearest', 'bilinear', 'cubic', 'average'
+                           and 'mode'.
+           buffer (list): 2-dim buffer in PIXELS (at full resolution).
+           mask (bool): Return masked arrays, masking pixels outside the
+                        polygon.
+    """
+    source_ds = raster_pool.open_dataset(image)
+    nbands = source_ds.RasterCount
+    geo_transform = source_ds.GetGeoTransform()
+    transform = _image_transform(source_ds)
+
+    for feature in features:
+        properties = feature.get('properties') or {}
+        geom = _image_geometry(feature, transform)
+        window = _pixel_window(geom, source_ds, buffer)
+        if window is None:
+            continue
+        x0, y0, x1, y1 = window
+        win_xsize, win_ysize = x1 - x0, y1 - y0
+        if min(win_xsize, win_ysize) < min_hw:
+            continue
+
+        scale = float(size) / max(win_xsize, win_ysize)
+        buf_xsize = max(1, int(round(win_xsize * scale)))
+        buf_ysize = max(1, int(round(win_ysize * scale)))
+        chip = source_ds.ReadAsArray(x0, y0, win_xsize, win_ysize,
+                                     buf_xsize=buf_xsize, buf_ysize=buf_ysize,
+                                     resample_alg=_RESAMPLE_ALGS[resample])
+        chip = chip.reshape((nbands, buf_ysize, buf_xsize))
+
+        if mask:
+            # rasterize the polygon on the grid of the resampled chip
+            window_transform = (geo_transform[0] + x0 * geo_transform[1],
+                                geo_transform[1] * win_xsize / float(buf_xsize), 0,
+                                geo_transform[3] + y0 * geo_transform[5], 0,
+                                geo_transform[5] * win_ysize / float(buf_ysize))
+            inside = _rasterize([geom], [1], (buf_ysize, buf_xsize),
+                                window_transform) > 0
+            chip = np.ma.masked_array(chip, mask=np.tile(~inside, (nbands, 1, 1)))
+
+        yield chip, properties
+
+
+def _iter_coalesced(image, features, buffer=[0, 0], mask=False, cell_size=512,
+                    max_overread=4, start=0):
+    """Yield (chip, properties) for each feature, reading clustered features
+       together. Features are bucketed into a grid of cell_size pixels by the
+       upper left corner of their window; each bucket is read with a single
+       read of the bounding window of its features, and the chips (and
+       masks) are sliced from it in memory. Sparse buckets, whose bounding
+       window is more than max_overread times the total area of their
+       windows, are read feature by feature. With mask, the polygons of a
+       bucket are burned into a label raster of its bounding window in one
+       rasterization per set of non-overlapping windows (usually one), and
+       the mask of each chip is derived by comparing labels. Chips are
+       yielded bucket by bucket, in row-major order of the grid, after
+       (None, properties) for the features that are not in the image.
+
+       Chips have the shapes of GeoImage.iter_vector (and get_data): the
+       window of a feature is its envelope rounded out to whole pixels and
+       grown by buffer, and the part of it outside the image is padded with
+       zeros (masked with mask). Pixel values and masks are the same as
+       those of iter_vector, except for the masks of windows with a buffer
+       or that cross the left or top image edge: get_data burns the polygon
+       into a raster anchored at the upper left corner of the polygon
+       rather than of the window, which shifts its mask by the buffer (or
+       the clipped part) relative to the data. Here the mask is aligned
+       with the data.
+       The first start items are skipped without reading their chips; the
+       buckets are read from the first remaining feature on.
+
+       Args:
+           image (str): Image file name.
+           features (iterable): geojson feature dicts (lng, lat coordinates).
+           buffer (list): 2-dim buffer in PIXELS.
+           mask (bool): Return masked arrays, masking pixels outside the
+                        polygon.
+           cell_size (int): Side length in pixels of the grid cells.
+           max_overread (float): Maximum ratio of the pixels read for a
+                                 bucket to the pixels of its chips.
+           start (int): Number of items to skip.
+    """
+    source_ds = raster_pool.open_dataset(image)
+    nbands = source_ds.RasterCount
+    geo_transform = source_ds.GetGeoTransform()
+    transform = _image_transform(source_ds)
+
+    geoms, properties, windows, full_windows = [], [], [], []
+    skipped = 0
+    for feature in features:
+        geom = _image_geometry(feature, transform)
+        if _pixel_window(geom, source_ds) is None:
+            # not in the image (the buffer does not count), like
+            # GeoImage.iter_vector on an OverlapError
+            if skipped < start:
+                skipped += 1
+            else:
+                yield None, feature.get('properties') or {}
+            continue
+        geoms.append(geom)
+        properties.append(feature.get('properties') or {})
+        windows.append(_pixel_window(geom, source_ds, buffer))
+        full_windows.append(_pixel_window(geom, source_ds, buffer, clip=False))
+
+    if not windows:
+        return
+
+    # grid index of the (clipped) windows: sort by cell row, then cell column
+    windows, full_windows = np.array(windows), np.array(full_windows)
+    areas = (windows[:, 2] - windows[:, 0]) * (windows[:, 3] - windows[:, 1])
+    cells = windows[:, :2] // cell_size
+    order = np.lexsort((windows[:, 0], cells[:, 0], cells[:, 1]))
+    cell_ids = cells[order, 1] * (cells[:, 0].max() + 1) + cells[order, 0]
+    starts = np.flatnonzero(np.r_[True, np.diff(cell_ids) != 0])
+    stops = np.r_[starts[1:], len(order)]
+
+    for first, last in zip(starts, stops):
+        members = order[first:last]
+        n = min(len(members), start - skipped)
+        members, skipped = members[n:], skipped + n
+        if len(members) == 0:
+            continue
+        x0, y0 = windows[members, :2].min(axis=0)
+        x1, y1 = windows[members, 2:].max(axis=0)
+        coalesced = (x1 - x0) * (y1 - y0) <= max_overread * areas[members].sum()
+        if coalesced:
+            tile = source_ds.ReadAsArray(int(x0), int(y0), int(x1 - x0),
+                                         int(y1 - y0))
+            tile = tile.reshape((nbands, y1 - y0, x1 - x0))
+
+        if mask:
+            # one label raster per layer of non-overlapping windows; feature i
+            # is burned as i + 1
+            layers = _window_layers(windows[members])
+            labels = [_rasterize([geoms[i] for i in members[layer]],
+                                 members[layer] + 1, (y1 - y0, x1 - x0),
+                                 _window_transform(geo_transform, x0, y0))
+                      for layer in layers]
+            label_of = {}
+            for layer, raster in zip(layers, labels):
+                for i in members[layer]:
+                    label_of[i] = raster
+
+        for i in members:
+            wx0, wy0, wx1, wy1 = windows[i]
+            rows, cols = slice(wy0 - y0, wy1 - y0), slice(wx0 - x0, wx1 - x0)
+            if coalesced:
+                # copy, so that the chips do not keep the whole tile alive
+                chip = tile[:, rows, cols].copy()
+            else:
+                # read the window alone
+                chip = source_ds.ReadAsArray(int(wx0), int(wy0), int(wx1 - wx0),
+                                             int(wy1 - wy0))
+                chip = chip.reshape((nbands, wy1 - wy0, wx1 - wx0))
+            if mask:
+                inside = label_of[i][rows, cols] == i + 1
+
+            fx0, fy0, fx1, fy1 = full_windows[i]
+            if (fx0, fy0, fx1, fy1) != (wx0, wy0, wx1, wy1):
+                # pad the part of the window outside the image with zeros
+                inner = (slice(wy0 - fy0, wy1 - fy0), slice(wx0 - fx0, wx1 - fx0))
+                padded = np.zeros((nbands, fy1 - fy0, fx1 - fx0), dtype=chip.dtype)
+                padded[(slice(None),) + inner] = chip
+                chip = padded
+                if mask:
+                    padded = np.zeros((fy1 - fy0, fx1 - fx0), dtype=bool)
+                    padded[inner] = inside
+                    inside = padded
+
+            if mask:
+                chip = np.ma.masked_array(chip, mask=np.tile(~inside, (nbands, 1, 1)))
+            yield chip, properties[i]
+
+
+def _window_layers(windows):
+    """Split pixel windows into layers of pairwise disjoint windows, so that
+       the polygons of a layer can be burned into one label raster without
+       overwriting each other.
+
+       Args:
+           windows (numpy array): Array of shape (n, 4) of (x0, y0, x1, y1).
+
+       Returns:
+           List of index arrays into windows, one per layer.
+    """
+    layers = []
+    for i, (x0, y0, x1, y1) in enumerate(windows):
+        for layer in layers:
+            other = windows[layer]
+            if not np.any((other[:, 0] < x1) & (x0 < other[:, 2]) &
+                          (other[:, 1] < y1) & (y0 < other[:, 3])):
+                layer.append(i)
+                break
+        else:
+            layers.append([i])
+    return [np.array(layer) for layer in layers]
+
+
+def _image_transform(source_ds):
+    """Return the transformation from geojson coordinates to the spatial
+       reference of source_ds, or None if they are the same.
+    """
+    image_srs = osr.SpatialReference(wkt=source_ds.GetProjection())
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        image_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if image_srs.IsSame(_WGS84):
+        return None
+    return osr.CoordinateTransformation(_WGS84, image_srs)
+
+
+def _image_geometry(feature, transform):
+    """Return the ogr geometry of a geojson feature in image coordinates."""
+    geom = ogr.CreateGeometryFromJson(json.dumps(feature['geometry']))
+    if transform is not None:
+        geom.Transform(transform)
+    return geom
+
+
+def _pixel_window(geom, source_ds, buffer=[0, 0], clip=True):
+    """Return the pixel window (x0, y0, x1, y1) of the envelope of geom,
+       grown by buffer and clipped to the image, or None if it is empty.
+       With clip=False, the window is not clipped (it may extend beyond the
+       image). The image must be north-up.
+    """
+    geo_transform = source_ds.GetGeoTransform()
+    minx, maxx, miny, maxy = geom.GetEnvelope()
+    x0 = int(np.floor((minx - geo_transform[0]) / geo_transform[1])) - buffer[0]
+    x1 = int(np.ceil((maxx - geo_transform[0]) / geo_transform[1])) + buffer[0]
+    y0 = int(np.floor((maxy - geo_transform[3]) / geo_transform[5])) - buffer[1]
+    y1 = int(np.ceil((miny - geo_transform[3]) / geo_transform[5])) + buffer[1]
+    if clip:
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, source_ds.RasterXSize), min(y1, source_ds.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def _window_transform(geo_transform, x0, y0):
+    """Geotransform of the window of an image starting at pixel (x0, y0)."""
+    return (geo_transform[0] + x0 * geo_transform[1], geo_transform[1], 0,
+            geo_transform[3] + y0 * geo_transform[5], 0, geo_transform[5])
+
+
+def _rasterize(geoms, values, shape, geo_transform):
+    """Burn geometries into a new raster.
+
+       Args:
+           geoms (list): ogr geometries, in the coordinates of geo_transform.
+           values (list): Value to burn for each geometry.
+           shape (tuple): (ysize, xsize) of the raster.
+           geo_transform (tuple): GDAL geotransform of the raster.
+
+       Returns:
+           uint32 numpy array of shape shape; 0 where no geometry was burned.
+    """
+    raster = gdal.GetDriverByName('MEM').Create('', shape[1], shape[0], 1, GDT_UInt32)
+    raster.SetGeoTransform(geo_transform)
+
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vector.CreateLayer('geoms', geom_type=ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    for geom, value in zip(geoms, values):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geom)
+        feature.SetField('value', int(value))
+        layer.CreateFeature(feature)
+
+    gdal.RasterizeLayer(raster, [1], layer, options=['ATTRIBUTE=value'])
+    return raster.ReadAsArray()
 
 
 def get_iter_data(shapefile, batch_size=32, nb_classes=2, min_chip_hw=0, max_chip_hw=125,
                   classes=['No swimming pool', 'Swimming pool'], return_id = False,
                   buffer=[0, 0], mask=True, normalize=True, img_name=None,
-                  return_labels=True):
+                  return_labels=True, cache=None, prefetch=0, dtype='float32',
+                  resample=None, coalesce=False, metrics=None, state=None):
     '''
     Generates batches of training data from shapefile.
 
@@ -98,11 +590,40 @@ def get_iter_data(shapefile, batch_size=32, nb_classes=2, min_chip_hw=0, max_chi
             img_name (string): name of tif image to use for extracting chips. Defaults to
                 None (the image name is assumed to be the image id listed in shapefile)
             return_labels (bool): Include labels in output. Defualts to True.
+            cache (ChipCache): chip cache to read chips from and store them in.
+                Defaults to None (no caching).
+            prefetch (int): number of batches to extract ahead of the caller in a
+                background thread. Defaults to 0 (extract on the caller's thread).
+            dtype (string): data type of the chip batches (ex: 'float32', 'uint8').
+                normalize is ignored for integer types. Defaults to 'float32'.
+            resample (string): if given, polygons are not rejected or zero-padded
+                to max_chip_hw: each polygon is read at the resolution at which its
+                longer side is max_chip_hw pixels, resampling with this algorithm
+                ('nearest', 'bilinear', 'cubic', 'average' or 'mode'). min_chip_hw
+                applies to the full resolution size. The chip cache is not used.
+                Defaults to None.
+            coalesce (bool): read spatially clustered polygons with one raster read
+                per cluster instead of one per polygon, and rasterize their masks in
+                one pass. Chips are then ordered by cluster within each image.
+                Ignored if resample is given. Defaults to False.
+            metrics (ExtractionMetrics): collects chips/s, bytes read, time spent
+                reading, padding and normalizing, and rejected chips by reason.
+                Defaults to None, in which case progress is printed at most once
+                per second.
+            state (dict): checkpoint of the iteration. After each batch returned by
+                g.next(), state holds the image and polygon position after that
+                batch and the number of batches and chips emitted (json
+                serializable). Pass the saved dictionary to a new get_iter_data
+                call with the same arguments to continue where it stopped. Images
+                and polygons before the checkpoint are not read again. Defaults to
+                None.
 
     OUTPUT  Returns a generator object (g). calling g.next() returns the following:
             chips: one batch of masked (if True) chips
             corresponding feature_id for chips (if return_id is True)
             corresponding chip labels (if return_labels is True)
+            If prefetch > 0 (and state is None), g is a BatchPrefetcher; g.stats()
+            reports the time spent waiting for batches.
 
     EXAMPLE:
         >> g = get_iter_data('shapefile.geojson', batch-size=12)
@@ -111,95 +632,222 @@ def get_iter_data(shapefile, batch_size=32, nb_classes=2, min_chip_hw=0, max_chi
         # y is a list of classifications for the chips in x
     '''
 
-    ct, inputs, labels, ids = 0, [], [], []
+    if metrics is None:
+        metrics = ExtractionMetrics(callback=print_progress)
+
+    if state and (state['batch_size'] != batch_size or
+                  state['shapefile'] != os.path.basename(shapefile)):
+        raise ValueError('state was saved for a different shapefile or batch size')
+
+    batches = _get_iter_data(shapefile, batch_size, nb_classes, min_chip_hw,
+                             max_chip_hw, classes, return_id, buffer, mask, normalize,
+                             img_name, return_labels, cache, dtype, resample,
+                             coalesce, metrics, state)
+    if prefetch > 0:
+        batches = BatchPrefetcher(batches, depth=prefetch)
+    if state is not None:
+        batches = _track_state(batches, state)
+    return batches
+
+
+def _track_state(batches, state):
+    """Yield the batches of (batch, state) pairs, copying each state into the
+       state dictionary when its batch is handed out.
+    """
+    for data, snapshot in batches:
+        state.clear()
+        state.update(snapshot)
+        yield data
+
+
+def _get_iter_data(shapefile, batch_size, nb_classes, min_chip_hw, max_chip_hw,
+                   classes, return_id, buffer, mask, normalize, img_name,
+                   return_labels, cache, dtype, resample, coalesce, metrics,
+                   state):
+    '''
+    Batch generator behind get_iter_data. See get_iter_data for the arguments.
+        If state is None, yields the batches; otherwise yields (batch, snapshot)
+        pairs and starts from the position saved in state.
+    '''
+
+    ct, chips, labels, ids = 0, None, [], []
     print 'Extracting image ids...'
     img_ids = gt.find_unique_values(shapefile, property_name='image_id')
 
     # Create numerical class names
     cls_dict = {classes[i]: i for i in xrange(len(classes))}
 
-    for img_id in img_ids:
-        if not img_name:
-            img = geoio.GeoImage(img_id + '.tif')
+    index = gt.feature_index(shapefile) if resample else None
+
+    # position of the iteration: index of the current image and number of
+    # polygons of that image consumed so far
+    resume = dict(state or {})
+    position = {'image': resume.get('image', 0), 'cursor': 0}
+    emitted = {'batches': resume.get('batches', 0), 'chips': resume.get('chips', 0)}
+
+    def snapshot():
+        snap = {'shapefile': os.path.basename(shapefile), 'batch_size': batch_size}
+        snap.update(position)
+        snap.update(emitted)
+        return snap
+
+    def consume(items, start):
+        # count the polygons pulled from items, which start at polygon start
+        position['cursor'] = start
+        for item in items:
+            position['cursor'] += 1
+            yield item
+
+    for i in xrange(position['image'], len(img_ids)):
+        img_id = img_ids[i]
+        image = img_name or img_id + '.tif'
+        start = resume.get('cursor', 0) if i == resume.get('image') else 0
+        position['image'] = i
+
+        if resample:
+            # chips come out with their longer side equal to max_chip_hw
+            positions = consume(index.offsets('image_id', img_id)[start:], start)
+            img_chips = _iter_resampled(image, index.features(positions), max_chip_hw,
+                                        min_hw=min_chip_hw, resample=resample,
+                                        buffer=buffer, mask=mask)
         else:
-            img = geoio.GeoImage(img_name)
+            img_chips = consume(_iter_vector(image, shapefile, img_id, buffer=buffer,
+                                             mask=mask, cache=cache,
+                                             coalesce=coalesce, start=start), start)
 
-        for chip, properties in img.iter_vector(vector=shapefile,
-                                                properties=True,
-                                                filter=[{'image_id': img_id}],
-                                                buffer=buffer,
-                                                mask=mask):
+        for chip, properties in metrics.timed(img_chips, 'read'):
 
             # check for adequate chip size
-            chan, h, w = np.shape(chip)
-            pad_h, pad_w = max_chip_hw - h, max_chip_hw - w
-            if chip is None or min(h, w) < min_chip_hw or max(
-                    h, w) > max_chip_hw:
+            reason = _reject_reason(chip, properties, min_chip_hw, max_chip_hw,
+                                    resample, return_labels, cls_dict)
+            if reason is not None:
+                metrics.reject(reason, chip)
                 continue
 
-            # zero-pad chip to standard net input size
-            chip = chip.filled(0).astype(float)  # replace masked entries with zeros
-            chip_patch = np.pad(chip, [(0, 0), (pad_h/2, (pad_h - pad_h/2)), (pad_w/2,
-                (pad_w - pad_w/2))], 'constant', constant_values=0)
-
-            # # resize image
-            # if resize_dim:
-            #     if resize_dim != chip_patch.shape:
-            #         chip_patch = resize(chip_patch, resize_dim)
-
-            if normalize:
-                chip_patch /= 255.
-
             # Get labels
             if return_labels:
-                try:
-                    label = properties['class_name']
-                    if label is None:
-                        continue
-                    labels.append(cls_dict[label])
-                except (TypeError, KeyError):
-                    continue
+                labels.append(cls_dict[properties['class_name']])
 
             if return_id:
                 id = properties['feature_id']
                 ids.append(id)
 
-            # do not include image_id for fitting net
-            inputs.append(chip_patch)
+            # zero-pad chip to standard net input size, in place
+            with metrics.timer('pad'):
+                if chips is None:
+                    chips = np.zeros((batch_size, chip.shape[0], max_chip_hw,
+                                      max_chip_hw), dtype=dtype)
+                _put_chip(chips, ct, chip)
             ct += 1
-            sys.stdout.write('\r%{0:.2f}'.format(100 * ct / float(batch_size)) + ' ' * 5)
-            sys.stdout.flush()
+            metrics.add_chip(chip)
 
             if ct == batch_size:
-                data = [np.array([i for i in inputs])]
+                with metrics.timer('normalize'):
+                    _normalize(chips, normalize)
+                data = [chips]
 
                 if return_id:
                     data.append(ids)
 
                 if return_labels:
                     # Create one-hot encoded labels
-                    Y = np.zeros((batch_size, nb_classes))
-                    for i in range(batch_size):
-                        Y[i, labels[i]] = 1
-
-                    data.append(Y)
-                yield data
-                ct, inputs, labels, ids = 0, [], [], []
+                    data.append(_one_hot(labels, nb_classes))
+                emitted['batches'] += 1
+                emitted['chips'] += ct
+                yield data if state is None else (data, snapshot())
+                ct, chips, labels, ids = 0, None, [], []
 
     # return any remaining inputs
-    if len(inputs) != 0:
-        data = [np.array([i for i in inputs])]
+    position.update(image=len(img_ids), cursor=0)
+    if ct != 0:
+        with metrics.timer('normalize'):
+            _normalize(chips[:ct], normalize)
+        data = [chips[:ct]]
 
         if return_id:
             data.append(ids)
 
         if return_labels:
             # Create one-hot encoded labels
-            Y = np.zeros((len(labels), nb_classes))
-            for i in range(len(labels)):
-                Y[i, labels[i]] = 1
-            data.append(Y)
-        yield data
+            data.append(_one_hot(labels, nb_classes))
+        emitted['batches'] += 1
+        emitted['chips'] += ct
+        yield data if state is None else (data, snapshot())
+
+
+def _reject_reason(chip, properties, min_chip_hw, max_chip_hw, resample,
+                   return_labels, cls_dict):
+    """Return the reason for which a chip can not be used in a batch, or None.
+
+       Returns:
+           'empty' (no chip), 'too_small', 'too_large', 'missing_label' (no
+           class_name) or 'unknown_class' (class_name not in the classes).
+    """
+    if chip is None:
+        return 'empty'
+
+    chan, h, w = np.shape(chip)
+    if not resample:
+        if min(h, w) < min_chip_hw:
+            return 'too_small'
+        if max(h, w) > max_chip_hw:
+            return 'too_large'
+
+    if return_labels:
+        try:
+            label = properties['class_name']
+        except (TypeError, KeyError):
+            return 'missing_label'
+        if label is None:
+            return 'missing_label'
+        if label not in cls_dict:
+            return 'unknown_class'
+
+    return None
+
+
+def _put_chip(batch, i, chip):
+    """Write chip into batch[i], centered and zero-padded to the batch chip
+       size. Masked entries are set to zero. batch[i] must be zero on entry.
+
+       Args:
+           batch (numpy array): Batch array of shape (n, chan, h, w).
+           i (int): Index of the chip in the batch.
+           chip (numpy array): Chip (masked or not) of shape (chan, h', w').
+    """
+    chan, h, w = chip.shape
+    top, left = (batch.shape[2] - h) / 2, (batch.shape[3] - w) / 2
+    patch = batch[i, :, top:top + h, left:left + w]
+
+    patch[...] = np.ma.getdata(chip)
+    if np.ma.is_masked(chip):
+        patch[np.ma.getmaskarray(chip)] = 0
+
+
+def _normalize(batch, normalize):
+    """Divide batch by 255 in place, if normalize and batch has a floating
+       point dtype. Zero padding is unaffected.
+    """
+    if normalize and batch.dtype.kind == 'f':
+        batch /= 255.
+
+
+def _one_hot(labels, nb_classes):
+    """Return one-hot encoded labels.
+
+       Args:
+           labels (list): Class indices; a negative index (no label) gives an
+               all-zero row.
+           nb_classes (int): Number of classes.
+
+       Returns:
+           Array of shape (len(labels), nb_classes).
+    """
+    labels = np.asarray(labels)
+    labeled = np.flatnonzero(labels >= 0)
+    Y = np.zeros((len(labels), nb_classes))
+    Y[labeled, labels[labeled]] = 1
+    return Y
 
 
 def random_window(image, chip_size, no_chips=10000):
@@ -213,58 +861,471 @@ def random_window(image, chip_size, no_chips=10000):
        Returns:
            List of chip rasters.
     """
-    img = geoio.GeoImage(image)
+    chips, locations = random_window_batch(image, chip_size, no_chips=no_chips)
+    return list(chips)
+
 
-    chips = []
-    for i, chip in enumerate(img.iter_window_random(
-            win_size=chip_size, no_chips=no_chips)):
-        chips.append(chip)
-        if i == no_chips - 1:
+def random_window_batch(image, chip_size, no_chips=10000, reject=None,
+                        max_rounds=10, seed=None):
+    """Sample random windows from an image and return them as one array.
+       All window offsets are drawn up front and read in storage block
+       order, so that consecutive reads hit the same blocks. The chips are
+       returned in the (random) order in which they were drawn.
+       If reject is given, rejected chips are replaced by new draws for up
+       to max_rounds rounds.
+
+       Args:
+           image (str): Image filename.
+           chip_size (list): Chip dimensions [xsize, ysize] in pixels.
+           no_chips (int): Number of chips.
+           reject (function): Predicate on a chip of shape (bands, ysize,
+                              xsize); chips for which it returns True are
+                              discarded (e.g. mostly_zero).
+           max_rounds (int): Maximum number of sampling rounds.
+           seed (int): Seed of the random number generator.
+
+       Returns:
+           chips (numpy array): Array of shape (n, bands, ysize, xsize), with
+                                n = no_chips unless max_rounds ran out.
+           locations (numpy array): Array of shape (n, 2) with the (x, y)
+                                    pixel of the upper left corner of each
+                                    chip.
+    """
+    source_ds = raster_pool.open_dataset(image)
+    nbands = source_ds.RasterCount
+    xsize, ysize = source_ds.RasterXSize, source_ds.RasterYSize
+    band = source_ds.GetRasterBand(1)
+    block_xsize, block_ysize = band.GetBlockSize()
+    win_xsize, win_ysize = chip_size
+    rng = np.random.RandomState(seed)
+
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    chips = np.zeros((no_chips, nbands, win_ysize, win_xsize), dtype=dtype)
+    locations = np.zeros((no_chips, 2), dtype=int)
+
+    filled = 0
+    for _ in xrange(max_rounds):
+        remaining = no_chips - filled
+        if remaining == 0:
             break
 
-    return chips
+        xs = rng.randint(0, xsize - win_xsize + 1, remaining)
+        ys = rng.randint(0, ysize - win_ysize + 1, remaining)
+
+        # read by block row, then block column
+        order = np.lexsort((xs, ys, xs // block_xsize, ys // block_ysize))
+        accepted = np.zeros(remaining, dtype=bool)
+        for i in order:
+            chip = chips[filled + i]
+            source_ds.ReadAsArray(int(xs[i]), int(ys[i]), win_xsize, win_ysize,
+                                  buf_obj=chip)
+            accepted[i] = reject is None or not reject(chip)
+        locations[filled:filled + remaining] = np.column_stack((xs, ys))
+
+        # move accepted chips to the front, keeping the draw order
+        keep = filled + np.flatnonzero(accepted)
+        chips[filled:filled + len(keep)] = chips[keep]
+        locations[filled:filled + len(keep)] = locations[keep]
+        filled += len(keep)
+
+    if filled < no_chips:
+        print 'Only {} of {} chips were accepted'.format(filled, no_chips)
+
+    return chips[:filled], locations[:filled]
+
+
+def mostly_zero(chip, fraction=0.5):
+    """Return True if at least fraction of the pixels of chip are zero in
+       all bands (e.g. land in a water-masked image).
+
+       Args:
+           chip (numpy array): Array of shape (bands, ysize, xsize).
+           fraction (float): Fraction of pixels.
+    """
+    zero = np.all(chip == 0, axis=0)
+    return zero.sum() >= fraction * zero.size
+
+
+def sliding_window(image, chip_size, stride=None, batch_size=32,
+                   max_zero_fraction=None, tile_lines=512, dtype=None,
+                   normalize=False, tile_columns=None, max_zeros=None):
+    """Slide a window over an image and yield batches of chips with their
+       locations. The image is read in tiles of about tile_lines lines and
+       tile_columns columns (full width by default); adjacent tiles overlap
+       by the window size minus the stride, so that every window lies in
+       exactly one tile. The (possibly overlapping) windows of a tile are
+       array views, and the validity filter is computed for all windows of
+       a tile at once. Windows that do not fit entirely in the image are
+       skipped.
+
+       Args:
+           image (str): Image filename.
+           chip_size (list): Chip dimensions [xsize, ysize] in pixels.
+           stride (list): Window step [x, y] in pixels. Defaults to
+                          chip_size (no overlap).
+           batch_size (int): Number of chips per batch.
+           max_zero_fraction (float): Skip windows in which at least this
+                                      fraction of the pixels is zero in all
+                                      bands (e.g. land in a water-masked
+                                      image). Defaults to None (no filter).
+           tile_lines (int): Approximate number of image lines per read.
+           dtype (str): Data type of the chip batches. Defaults to None (the
+                        image data type).
+           normalize (bool): Divide chips by 255. Only applied to floating
+                             point dtypes.
+           tile_columns (int): Approximate number of image columns per read.
+                               Defaults to None (full width). Set it to
+                               bound the memory used on wide strips.
+           max_zeros (int): Skip windows with at least this many zero
+                            values, counted over all bands (the criterion
+                            np.sum(chip == 0) >= max_zeros). Defaults to
+                            None (no filter).
+
+       Yields:
+           chips (numpy array): Array of shape (n, bands, ysize, xsize),
+                                n <= batch_size.
+           locations (numpy array): Array of shape (n, 2) with the (x, y)
+                                    pixel of the upper left corner of each
+                                    chip.
+    """
+    source_ds = raster_pool.open_dataset(image)
+    nbands = source_ds.RasterCount
+    xsize, ysize = source_ds.RasterXSize, source_ds.RasterYSize
+    win_xsize, win_ysize = chip_size
+    stride_x, stride_y = stride or chip_size
+    if dtype is None:
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+            source_ds.GetRasterBand(1).DataType)
+
+    # window grid
+    nx = (xsize - win_xsize) // stride_x + 1
+    ny = (ysize - win_ysize) // stride_y + 1
+    if nx <= 0 or ny <= 0:
+        return
+    rows_per_tile = max(1, (tile_lines - win_ysize) // stride_y + 1)
+    cols_per_tile = nx
+    if tile_columns is not None:
+        cols_per_tile = max(1, (tile_columns - win_xsize) // stride_x + 1)
+
+    def new_batch():
+        return (np.zeros((batch_size, nbands, win_ysize, win_xsize), dtype=dtype),
+                np.zeros((batch_size, 2), dtype=int))
+
+    def finish(chips):
+        if normalize and chips.dtype.kind == 'f':
+            chips /= 255.
+        return chips
+
+    chips, locations = new_batch()
+    ct = 0
+    tiles = [(row, col) for row in xrange(0, ny, rows_per_tile)
+             for col in xrange(0, nx, cols_per_tile)]
+    for row, col in tiles:
+        rows, cols = min(rows_per_tile, ny - row), min(cols_per_tile, nx - col)
+        xoff, yoff = col * stride_x, row * stride_y
+        tile_xsize = (cols - 1) * stride_x + win_xsize
+        tile_ysize = (rows - 1) * stride_y + win_ysize
+        tile = source_ds.ReadAsArray(xoff, yoff, tile_xsize, tile_ysize)
+        tile = tile.reshape((nbands, tile_ysize, tile_xsize))
+
+        windows = _window_view(tile, chip_size, (stride_x, stride_y))
+        valid = np.ones((rows, cols), dtype=bool)
+        if max_zero_fraction is not None:
+            zeros = _window_sums(np.all(tile == 0, axis=0), chip_size,
+                                 (stride_x, stride_y))
+            valid &= zeros < max_zero_fraction * win_xsize * win_ysize
+        if max_zeros is not None:
+            zeros = _window_sums((tile == 0).sum(axis=0), chip_size,
+                                 (stride_x, stride_y))
+            valid &= zeros < max_zeros
+
+        # copy valid windows into batches, as many at a time as fit
+        valid_rows, valid_cols = np.nonzero(valid)
+        start = 0
+        while start < len(valid_rows):
+            n = min(batch_size - ct, len(valid_rows) - start)
+            r, c = valid_rows[start:start + n], valid_cols[start:start + n]
+            chips[ct:ct + n] = windows[r, c]
+            locations[ct:ct + n, 0] = xoff + c * stride_x
+            locations[ct:ct + n, 1] = yoff + r * stride_y
+            ct += n
+            start += n
+
+            if ct == batch_size:
+                yield finish(chips), locations
+                chips, locations = new_batch()
+                ct = 0
+
+    # return any remaining chips
+    if ct > 0:
+        yield finish(chips[:ct]), locations[:ct]
+
+
+def _window_view(tile, win_size, stride):
+    """Return the windows of a (bands, y, x) tile as a read-only view of
+       shape (rows, cols, bands, win_ysize, win_xsize).
+    """
+    bands, tile_ysize, tile_xsize = tile.shape
+    (win_xsize, win_ysize), (stride_x, stride_y) = win_size, stride
+    rows = (tile_ysize - win_ysize) // stride_y + 1
+    cols = (tile_xsize - win_xsize) // stride_x + 1
+    band_step, y_step, x_step = tile.strides
+    return as_strided(tile, shape=(rows, cols, bands, win_ysize, win_xsize),
+                      strides=(y_step * stride_y, x_step * stride_x, band_step,
+                               y_step, x_step))
+
+
+def _window_sums(values, win_size, stride):
+    """Sum a 2-dim array over every window of the grid, using an integral
+       image. Returns an array of shape (rows, cols).
+    """
+    (win_xsize, win_ysize), (stride_x, stride_y) = win_size, stride
+    tile_ysize, tile_xsize = values.shape
+    integral = np.zeros((tile_ysize + 1, tile_xsize + 1), dtype=np.int64)
+    integral[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
 
+    y0 = (np.arange((tile_ysize - win_ysize) // stride_y + 1) * stride_y)[:, None]
+    x0 = (np.arange((tile_xsize - win_xsize) // stride_x + 1) * stride_x)[None, :]
+    y1, x1 = y0 + win_ysize, x0 + win_xsize
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
 
-def apply_mask(input_file, mask_file, output_file):
+
+def apply_mask(input_file, mask_file, output_file, workers=4, tile_lines=256,
+               nodata=None, creation_options=['TILED=YES', 'COMPRESS=DEFLATE',
+                                              'BIGTIFF=IF_SAFER']):
     """Apply binary mask on image. Input image and mask must have the same
        (x,y) dimension and the same projection.
+       The image is processed in tiles aligned with its native block size.
+       Tiles are read and masked by a pool of threads, and each tile is
+       written to all output bands with a single call. Only a few tiles are
+       held in memory at any time, whatever the size of the image.
+       The output has the data type of the input image (e.g. 16-bit
+       multispectral imagery is not truncated to 8 bits).
 
        Args:
            input_file (str): Input file name.
            mask_file (str): Mask file name.
            output_file (str): Masked image file name.
+           workers (int): Number of threads reading and masking tiles.
+           tile_lines (int): Minimum number of lines per tile. Tiles span an
+                             integer number of blocks, so scanline-organized
+                             images are still read in large chunks.
+           nodata (int/float): If given, masked pixels are set to this value
+                               and it is recorded as the nodata value of the
+                               output bands. Otherwise masked pixels are set
+                               to zero.
+           creation_options (list): GTiff creation options of the output.
+                                    Defaults to a tiled, deflate-compressed
+                                    (Big)TIFF.
+
+       Returns:
+           Dictionary with the number of bytes read from input_file, the
+           elapsed seconds and the throughput in MB/s.
     """
 
     source_ds = gdal.Open(input_file, GA_ReadOnly)
     nbands = source_ds.RasterCount
-    mask_ds = gdal.Open(mask_file, GA_ReadOnly)
-
     xsize, ysize = source_ds.RasterXSize, source_ds.RasterYSize
-    xmasksize, ymasksize = mask_ds.RasterXSize, mask_ds.RasterYSize
 
     print 'Generating mask'
 
     # Create target DS
     driver = gdal.GetDriverByName('GTiff')
-    dst_ds = driver.Create(output_file, xsize, ysize, nbands, GDT_Byte)
+    data_type = source_ds.GetRasterBand(1).DataType
+    dst_ds = driver.Create(output_file, xsize, ysize, nbands, data_type,
+                           options=creation_options)
     dst_ds.SetGeoTransform(source_ds.GetGeoTransform())
     dst_ds.SetProjection(source_ds.GetProjection())
-
-    # Apply mask --- this is line by line at the moment, not so efficient
-    for i in range(ysize):
-        # read line from input image
-        line = source_ds.ReadAsArray(xoff=0, yoff=i, xsize=xsize, ysize=1)
-        # read line from mask
-        mask_line = mask_ds.ReadAsArray(xoff=0, yoff=i, xsize=xsize, ysize=1)
-        # apply mask
-        masked_line = line * (mask_line > 0)
-        # write
+    if nodata is not None:
         for n in range(1, nbands + 1):
-            dst_ds.GetRasterBand(n).WriteArray(masked_line[n - 1].astype(np.uint8),
-                                               xoff=0, yoff=i)
+            dst_ds.GetRasterBand(n).SetNoDataValue(nodata)
+    fill = 0 if nodata is None else nodata
+
+    # tiles are whole blocks of the source image
+    block_xsize, block_ysize = source_ds.GetRasterBand(1).GetBlockSize()
+    tile_ysize = block_ysize * max(1, int(np.ceil(tile_lines / float(block_ysize))))
+    tiles = [(xoff, yoff, min(block_xsize, xsize - xoff), min(tile_ysize, ysize - yoff))
+             for yoff in xrange(0, ysize, tile_ysize)
+             for xoff in xrange(0, xsize, block_xsize)]
+
+    # GDAL datasets can not be shared between threads; open one set per thread
+    local = threading.local()
+
+    def mask_tile(tile):
+        if not hasattr(local, 'source_ds'):
+            local.source_ds = gdal.Open(input_file, GA_ReadOnly)
+            local.mask_ds = gdal.Open(mask_file, GA_ReadOnly)
+        xoff, yoff, win_xsize, win_ysize = tile
+        data = local.source_ds.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
+        data = data.reshape((nbands, win_ysize, win_xsize))
+        mask = local.mask_ds.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
+        return tile, data.nbytes, np.where(mask > 0, data, fill).astype(data.dtype)
+
+    start, nbytes = time.time(), 0
+    pool = ThreadPool(processes=workers)
+    try:
+        # a few tiles per thread at a time keeps memory bounded
+        chunk = 2 * workers
+        for i in xrange(0, len(tiles), chunk):
+            for tile, tile_bytes, masked in pool.map(mask_tile, tiles[i:i + chunk]):
+                xoff, yoff, win_xsize, win_ysize = tile
+                dst_ds.WriteRaster(xoff, yoff, win_xsize, win_ysize, masked.tobytes(),
+                                   buf_type=data_type,
+                                   band_list=range(1, nbands + 1))
+                nbytes += tile_bytes
+    finally:
+        pool.close()
+        pool.join()
+
     # close datasets
     source_ds, dst_ds = None, None
 
+    elapsed = time.time() - start
+    throughput = nbytes / 1e6 / max(elapsed, 1e-9)
+    print 'Masked {:.1f} MB in {:.1f} s ({:.1f} MB/s)'.format(nbytes / 1e6, elapsed,
+                                                              throughput)
+    return {'bytes': nbytes, 'seconds': elapsed, 'mb_per_s': throughput}
+
+
+class BatchPrefetcher(object):
+    '''
+    Runs a batch generator in a background thread, keeping up to depth ready batches
+        in a bounded queue, so that extraction overlaps with training. GDAL reads and
+        most numpy operations release the GIL, so a thread is enough to keep the
+        extraction going while the model trains.
+
+    INPUT   generator (iterator): source of batches (ex: output of get_iter_data)
+            depth (int): maximum number of batches waiting in the queue. Defaults to 2.
+
+    OUTPUT  an iterator over the batches of generator. stats() reports the time the
+                consumer waited for batches (extraction-bound) and the time the
+                producer waited for room in the queue (consumer-bound). close()
+                stops the thread and closes generator; it is called at exit for the
+                prefetchers that are still running.
+
+    EXAMPLE
+            $ g = BatchPrefetcher(get_iter_data('shapefile.geojson'), depth=4)
+            $ x, y = g.next()
+            $ g.stats()
+            $ g.close()
+    '''
+
+    def __init__(self, generator, depth=2):
+        self.generator = generator
+        self.depth = depth
+        self.queue = Queue.Queue(maxsize=depth)
+        self.batches = 0
+        self.wait_time = 0.
+        self.producer_wait_time = 0.
+        self._done = False
+        self._closed = threading.Event()
+
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+        _prefetchers.add(self)
+
+    def _put(self, item):
+        '''
+        put item in the queue, waiting for room unless the prefetcher is closed;
+        return False if it is closed
+        '''
+        while not self._closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        '''
+        thread target: move batches from the generator to the queue
+        '''
+        try:
+            for batch in self.generator:
+                start = time.time()
+                queued = self._put(('batch', batch))
+                self.producer_wait_time += time.time() - start
+                if not queued:
+                    break
+            else:
+                self._put(('done', None))
+        except Exception:
+            self._put(('error', sys.exc_info()))
+        finally:
+            # the generator runs on this thread, so it is closed here; this
+            # releases what it holds (ex: tiles and raster handles)
+            if self._closed.is_set() and hasattr(self.generator, 'close'):
+                self.generator.close()
+
+    def close(self):
+        '''
+        Stop the background thread and close the generator. Batches that are still
+            queued are dropped; next() raises StopIteration afterwards.
+        '''
+        self._done = True
+        self._closed.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        _prefetchers.discard(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        '''
+        return the next batch, blocking until one is ready
+        '''
+        if self._done:
+            raise StopIteration
+
+        start = time.time()
+        kind, item = self.queue.get()
+        self.wait_time += time.time() - start
+
+        if kind == 'done':
+            self._done = True
+            raise StopIteration
+        if kind == 'error':
+            self._done = True
+            raise item[0], item[1], item[2]
+
+        self.batches += 1
+        return item
+
+    def stats(self):
+        '''
+        Return queue statistics.
+
+        OUTPUT  stats (dict): batches (number of batches consumed), wait_time (seconds
+                    the consumer waited for a batch), producer_wait_time (seconds the
+                    extraction thread waited for room in the queue), queued (batches
+                    currently ready) and mean_wait_time (wait_time per batch).
+        '''
+        return {'batches': self.batches,
+                'wait_time': self.wait_time,
+                'producer_wait_time': self.producer_wait_time,
+                'queued': self.queue.qsize(),
+                'mean_wait_time': self.wait_time / max(self.batches, 1)}
+
+
+# prefetchers with a running thread, which are closed at exit: a thread left running
+# during interpreter shutdown fails once the modules it uses are torn down
+_prefetchers = weakref.WeakSet()
+
+
+def _close_prefetchers():
+    for prefetcher in list(_prefetchers):
+        prefetcher.close()
+
+atexit.register(_close_prefetchers)
+
 
 class getIterData(object):
     '''
@@ -289,9 +1350,55 @@ class getIterData(object):
                 proportions don't add to one they will each be divided by the total of
                 the values. Defaults to None, in which case proportions will be
                 representative of ratios in the shapefile.
+            cache (ChipCache): chip cache to read chips from and store them in.
+                Defaults to None (no caching).
+            prefetch (int): number of batches to assemble ahead of next() in a
+                background thread. Defaults to 0 (assemble on the caller's thread).
+                self.prefetcher.stats() reports the time spent waiting for batches.
+            dtype (string): data type of the chip batches (ex: 'float32', 'uint8').
+                normalize is ignored for integer types. Defaults to 'float32'.
+            shuffle (bool): reshuffle the order of the polygons of each image at every
+                epoch. The polygons are kept in memory and chips are read one polygon
+                at a time (or from the cache if it holds the image). Defaults to
+                False (polygons are read in shapefile order).
+            seed (int): seed of the random number generator used for shuffling.
+                Defaults to None.
+            class_props (dict): proportion of each class in every batch, in the form
+                {class_name: proportion}. The chips of each image are sampled so
+                that its share of the batch follows these proportions; chips of a
+                class whose quota is already filled are skipped. With shuffle=True
+                they are skipped before they are read; otherwise they are read and
+                then discarded. Classes that an image does not contain (or that are
+                not in classes, with return_labels) are left out of its quotas, and
+                the quota of a class none of whose chips of an image pass the size
+                filters is spread over the other classes after the first epoch.
+                A ValueError is raised if no class is left. Defaults to None (no
+                balancing).
+            resample (string): if given, polygons are read at the resolution at which
+                their longer side is max_chip_hw pixels instead of being rejected or
+                zero-padded, resampling with this algorithm ('nearest', 'bilinear',
+                'cubic', 'average' or 'mode'). min_chip_hw applies to the full
+                resolution size. The chip cache is not used. Defaults to None.
+            coalesce (bool): read spatially clustered polygons with one raster read
+                per cluster instead of one per polygon. Ignored if shuffle or
+                resample is given. Defaults to False.
+            metrics (ExtractionMetrics): collects chips/s, bytes read, time spent
+                reading, padding and normalizing, and rejected chips by reason
+                (including 'quota_full' with class_props), for all images.
+                Defaults to None, in which case progress is printed at most once
+                per second. self.metrics.summary() reports the statistics.
+            state (dict or string): iteration state returned by state() (or the file
+                written by save_state()) of a previous instance created with the same
+                arguments. Iteration continues exactly where that instance stopped;
+                the polygons of each image before its checkpoint are not read
+                again. Defaults to None (start from the first polygon).
 
     OUTPUT  creates a class instance that will produce batches of chips from the input
-                shapefile when create_batch() is called.
+                shapefile when create_batch() is called. The chips of each image are
+                streamed indefinitely: when all polygons of an image have been used,
+                a new epoch starts for that image. self.epochs holds the number of
+                completed epochs per image. next() raises a ValueError if an epoch of
+                an image yields no chip that passes the filters.
 
     EXAMPLE
             $ data_generator = getIterData('shapefile.geojson', batch_size=1000)
@@ -302,7 +1409,10 @@ class getIterData(object):
 
     def __init__(self, shapefile, batch_size=10000, min_chip_hw=0, max_chip_hw=125,
                  classes=['No swimming pool', 'Swimming pool'], return_labels=True,
-                 return_id=False, mask=True, normalize=True, props=None):
+                 return_id=False, mask=True, normalize=True, props=None, cache=None,
+                 prefetch=0, dtype='float32', shuffle=False, seed=None,
+                 class_props=None, resample=None, coalesce=False, metrics=None,
+                 state=None):
 
         self.shapefile = shapefile
         self.batch_size = batch_size
@@ -313,6 +1423,18 @@ class getIterData(object):
         self.return_id = return_id
         self.mask = mask
         self.normalize = normalize
+        self.cache = cache
+        self.dtype = dtype
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.epochs = {}
+        self.class_props = class_props
+        self.resample = resample
+        self.coalesce = coalesce
+        self.metrics = metrics or ExtractionMetrics(callback=print_progress)
+        self.positions = {}
+        self.quotas = {}
+        self.batches_emitted, self.chips_emitted = 0, 0
 
         # get image proportions
         print 'Getting image proportions...'
@@ -324,20 +1446,46 @@ class getIterData(object):
             self.img_ids = gt.find_unique_values(shapefile, property_name='image_id')
             self.props = {}
             for id in self.img_ids:
-                if int(self.get_proportion('image_id', id) * self.batch_size) > 0:
-                    self.props[id] = int(self.get_proportion('image_id', id) * self.batch_size)
+                prop = int(self.get_proportion('image_id', id) * self.batch_size)
+                if prop > 0:
+                    self.props[id] = prop
 
         # account for difference in batch size and total due to rounding
         total = np.sum(self.props.values())
         if total < batch_size:
-            diff = np.random.choice(self.props.keys())
+            diff = self.rng.choice(self.props.keys())
             self.props[diff] += batch_size - total
 
+        # index polygons by image once, so that epochs can be reshuffled in memory;
+        # only the positions and indexed properties of the polygons are kept, the
+        # geometries are read from the shapefile when the polygons are extracted
+        self.index = None
+        if self.shuffle or self.resample:
+            print 'Indexing polygons...'
+            self.index = gt.feature_index(shapefile)
+
+        # continue from a checkpoint; this restores the batch shares of the images
+        # (the rounding remainder above is drawn at random) and the class quotas
+        self._resume = {}
+        if state is not None:
+            self._restore(state)
+
+        if self.class_props:
+            for id in self.props:
+                if id not in self.quotas:
+                    self.quotas[id] = self._class_quotas(id, self.props[id])
+        self._state = self._snapshot()
+
         # initialize generators
         print 'Creating chip generators for each image...'
         self.chip_gens = {}
-        for id in self.img_ids:
-            self.chip_gens[id] = self.yield_from_img_id(id, batch=self.props[id])
+        for id in self.props:
+            self.chip_gens[id] = self.yield_from_img_id(id, batch=self.props[id],
+                                                        repeat=True)
+
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = BatchPrefetcher(self._iter_batches(), depth=prefetch)
 
     def _format_props_input(self, props):
         '''
@@ -351,6 +1499,31 @@ class getIterData(object):
         p_new = {i: int(props[i] * self.batch_size) for i in props.keys()}
         return p_new
 
+    def _class_quotas(self, img_id, batch, available=None):
+        '''
+        helper function to split the batch share of an image into per-class quotas,
+        among the available classes (by default, the classes of class_props that
+        the image contains)
+        '''
+        if available is None:
+            index = gt.feature_index(self.shapefile)
+            img_classes = index.columns['class_name'][
+                index.columns['image_id'] == img_id]
+            available = [c for c in self.class_props if np.any(img_classes == c) and
+                         (c in self.classes or not self.return_labels)]
+        if not available:
+            raise ValueError('Image {} has no polygon of the classes of '
+                             'class_props'.format(img_id))
+
+        total = float(sum(self.class_props[c] for c in available))
+        quotas = {c: int(batch * self.class_props[c] / total) for c in available}
+
+        # hand out the rounding remainder, largest classes first
+        remainder = batch - sum(quotas.values())
+        for c in sorted(available, key=lambda c: -self.class_props[c])[:remainder]:
+            quotas[c] += 1
+        return quotas
+
     def get_proportion(self, property_name, property):
         '''
         Helper function to get the proportion of polygons with a given property in a
@@ -363,14 +1536,14 @@ class getIterData(object):
                     shapefile (ex: '1040010014800C00')
         OUTPUT  proportion (float): proportion of polygons that have the property of interest
         '''
-        total, prop = 0,0
+        # indexed properties are counted once per shapefile
+        if property_name in gt.FeatureIndex.properties:
+            return gt.feature_index(self.shapefile).proportion(property_name, property)
 
-        # open shapefile, get polygons
-        with open(self.shapefile) as f:
-            data = geojson.load(f)['features']
+        total, prop = 0,0
 
-        # loop through features, find property count
-        for polygon in data:
+        # read polygons one at a time, find property count
+        for polygon in gt.iter_features(self.shapefile):
             total += 1
 
             try:
@@ -381,13 +1554,16 @@ class getIterData(object):
 
         return float(prop) / total
 
-    def yield_from_img_id(self, img_id, batch):
+    def yield_from_img_id(self, img_id, batch, repeat=False):
         '''
         helper function to yield data from a given shapefile for a specific img_id
 
         INPUT   img_id (str): ids of the images from which to generate patches from
                 batch (int): number of chips to generate per iteration from the input
                     image id
+                repeat (bool): start a new epoch when the polygons of the image are
+                    used up, instead of stopping. Batches span epoch boundaries.
+                    Defaults to False.
 
         OUTPUT  Returns a generator object (g). calling g.next() returns the following:
                 chips:
@@ -402,75 +1578,274 @@ class getIterData(object):
             # y is a list of classifications for the chips in x
         '''
 
-        ct, inputs, labels, ids = 0, [], [], []
+        ct, chips, labels, ids = 0, None, [], []
         cls_dict = {self.classes[i]: i for i in xrange(len(self.classes))}
 
-        img = geoio.GeoImage(img_id + '.tif')
-        for chip, properties in img.iter_vector(vector=self.shapefile,
-                                                properties=True,
-                                                filter=[{'image_id': img_id}],
-                                                mask=self.mask):
-            # check for adequate chip size
-            if chip is None:
-                continue
-            chan, h, w = np.shape(chip)
-            pad_h, pad_w = self.max_chip_hw - h, self.max_chip_hw - w
-            if min(h, w) < self.min_chip_hw or max(h, w) > self.max_chip_hw:
-                continue
-
-            # zero-pad chip to standard net input size
-            chip = chip.filled(0).astype(float)  # replace masked entries with zeros
-            chip_patch = np.pad(chip, [(0, 0), (pad_h/2, (pad_h - pad_h/2)), (pad_w/2,
-                (pad_w - pad_w/2))], 'constant', constant_values=0)
-
-            if self.normalize:
-                chip_patch /= 255.
-
-            # get labels
-            if self.return_labels:
-                try:
-                    label = properties['class_name']
-                    if label is None:
-                        continue
-                    labels.append(cls_dict[label])
-                except (TypeError, KeyError):
+        # per-class quotas of each batch, if classes are balanced
+        quotas = None
+        if self.class_props:
+            if img_id not in self.quotas:
+                self.quotas[img_id] = self._class_quotas(img_id, batch)
+            quotas = self.quotas[img_id]
+        class_ct = {}
+        # classes with a chip that passes the filters in the current epoch
+        usable = set()
+
+        def quota_full(properties):
+            if quotas is None:
+                return False
+            class_name = properties.get('class_name')
+            if class_ct.get(class_name, 0) >= quotas.get(class_name, 0):
+                if quotas.get(class_name, 0) > 0:
+                    usable.add(class_name)
+                return True
+            return False
+
+        while True:
+            # a resumed epoch may have produced chips before the checkpoint
+            resumed = img_id in self._resume
+            epoch_ct = 1 if resumed else 0
+            usable.clear()
+            img_chips = self._iter_img_id(img_id, skip=quota_full)
+            for chip, properties in self.metrics.timed(img_chips, 'read'):
+                # check for adequate chip size
+                reason = _reject_reason(chip, properties, self.min_chip_hw,
+                                        self.max_chip_hw, self.resample,
+                                        self.return_labels, cls_dict)
+                if reason is None:
+                    usable.add(properties.get('class_name'))
+                    if quota_full(properties):
+                        reason = 'quota_full'
+                if reason is not None:
+                    self.metrics.reject(reason, chip)
                     continue
 
-            # get id
-            if self.return_id:
-                id = properties['feature_id']
-                ids.append(id)
-
-            inputs.append(chip_patch)
-            ct += 1
-            sys.stdout.write('\r%{0:.2f}'.format(100 * ct / float(batch)) + ' ' * 5)
-            sys.stdout.flush()
-
-            if ct == batch:
-                data = [np.array([i for i in inputs])]
+                # get labels
+                if self.return_labels:
+                    labels.append(cls_dict[properties['class_name']])
 
+                # get id
                 if self.return_id:
-                    data.append(ids)
+                    id = properties['feature_id']
+                    ids.append(id)
+
+                epoch_ct += 1
+                class_name = properties.get('class_name')
+                class_ct[class_name] = class_ct.get(class_name, 0) + 1
+
+                # zero-pad chip to standard net input size, in place
+                with self.metrics.timer('pad'):
+                    if chips is None:
+                        chips = np.zeros((batch, chip.shape[0], self.max_chip_hw,
+                                          self.max_chip_hw), dtype=self.dtype)
+                    _put_chip(chips, ct, chip)
+                ct += 1
+                self.metrics.add_chip(chip)
+
+                if ct == batch:
+                    with self.metrics.timer('normalize'):
+                        _normalize(chips, self.normalize)
+                    data = [chips]
+
+                    if self.return_id:
+                        data.append(ids)
 
-                # Create one-hot encoded labels
-                if self.return_labels:
-                    Y = np.zeros((batch, len(self.classes)))
-                    for i in range(batch):
-                        Y[i, labels[i]] = 1
-                    data.append(Y)
-                yield data
-                ct, inputs, labels, ids = 0, [], [], []
+                    # Create one-hot encoded labels
+                    if self.return_labels:
+                        data.append(_one_hot(labels, len(self.classes)))
+                    yield data
+                    ct, chips, labels, ids = 0, None, [], []
+                    class_ct = {}
+
+            # image exhausted; start a new epoch
+            self.epochs[img_id] = self.epochs.get(img_id, 0) + 1
+            if not repeat:
+                break
+            if epoch_ct == 0:
+                raise ValueError('No polygon of image {} passes the '
+                                 'filters'.format(img_id))
+
+            # a batch can not be filled while a class without usable chips has a
+            # quota; spread its quota over the other classes
+            if quotas and not resumed:
+                unfillable = [c for c in quotas if quotas[c] > 0 and c not in usable]
+                if unfillable:
+                    print 'No chip of class(es) {} of image {} passes the filters; ' \
+                        'spreading their quota over the other classes'.format(
+                            ', '.join(map(str, unfillable)), img_id)
+                    new_quotas = self._class_quotas(
+                        img_id, batch, [c for c in quotas if c in usable])
+                    quotas.clear()
+                    quotas.update(new_quotas)
+
+    def _iter_img_id(self, img_id, skip=None):
+        '''
+        helper generator yielding (chip, properties) for one epoch of an image. With
+        shuffle, polygons for which skip(properties) is True are not read. The
+        position of the epoch is kept in self.positions[img_id]: the seed of its
+        shuffle order and the number of polygons consumed (cursor).
+        '''
+        position = self._resume.pop(img_id, None)
+        if position is None:
+            position = {'seed': None, 'cursor': 0}
+            if self.shuffle:
+                position['seed'] = int(self.rng.randint(2 ** 31 - 1))
+        self.positions[img_id] = position
+        start = position['cursor']
+
+        image = img_id + '.tif'
+        if self.shuffle or self.resample:
+            order = self.index.offsets('image_id', img_id)
+            if self.shuffle:
+                order = np.random.RandomState(position['seed']).permutation(order)
+
+            def consume():
+                # positions of the polygons in epoch order, from the cursor on; skip
+                # sees the indexed properties, before the polygon is read
+                for p in xrange(start, len(order)):
+                    position['cursor'] = p + 1
+                    if skip is None or not skip(self.index.record(order[p])):
+                        yield order[p]
+
+        if self.resample:
+            # lazy, so that skip sees the quotas as they fill up
+            for item in _iter_resampled(image, self.index.features(consume()),
+                                        self.max_chip_hw,
+                                        min_hw=self.min_chip_hw,
+                                        resample=self.resample, mask=self.mask):
+                yield item
+            return
+
+        if not self.shuffle:
+            # one item per polygon; a resumed epoch starts at its cursor, without
+            # reading the polygons before it
+            for item in _iter_vector(image, self.shapefile, img_id, mask=self.mask,
+                                     cache=self.cache, coalesce=self.coalesce,
+                                     start=start):
+                position['cursor'] += 1
+                yield item
+            return
+
+        # a cached image serves chips by feature_id in any order
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(_cache_key(self.cache, image, self.shapefile,
+                                               img_id, [0, 0], self.mask))
+
+        img = None
+        for feature in self.index.features(consume()):
+            properties = feature.get('properties') or {}
+            chip = None
+            if cached is not None:
+                chip = cached.get(properties.get('feature_id'))
+            if chip is None:
+                if img is None:
+                    img = raster_pool.open_image(image)
+                    transform = _image_transform(raster_pool.open_dataset(image))
+                chip = _get_feature_data(img, feature, mask=self.mask,
+                                         transform=transform)
+            yield chip, properties
+
+    def _iter_batches(self):
+        '''
+        helper generator feeding the prefetcher
+        '''
+        while True:
+            yield self._next_batch()
 
     def next(self):
         '''
         generate a batch of chips
         '''
-        data = []
+        if self.prefetcher is not None:
+            batch, self._state = self.prefetcher.next()
+        else:
+            batch, self._state = self._next_batch()
+        return batch
+
+    def state(self):
+        '''
+        Return the iteration state after the last batch returned by next(): the
+            random number generator state, the completed epochs and the position
+            of the current epoch of each image, and the number of batches and chips
+            emitted. The state is a json-serializable dictionary; pass it as the
+            state argument of a new getIterData with the same arguments to
+            continue where this one stopped.
+        '''
+        return self._state
 
-        # hit each generator in chip_gens
-        for img_id, gen in self.chip_gens.iteritems():
-            print '\nCollecting chips for image ' + str(img_id) + '...'
-            data += zip(*gen.next())
+    def save_state(self, file_name):
+        '''
+        Save state() to a json file.
+        '''
+        with open(file_name, 'w') as f:
+            json.dump(self.state(), f)
+
+    def _snapshot(self):
+        '''
+        helper function to capture the iteration state at a batch boundary
+        '''
+        positions = {img_id: dict(p) for img_id, p in self._resume.iteritems()}
+        positions.update({img_id: dict(p) for img_id, p in self.positions.iteritems()})
+        algorithm, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        return {'shapefile': os.path.basename(self.shapefile),
+                'batch_size': self.batch_size,
+                'rng': [algorithm, keys.tolist(), pos, has_gauss, cached_gaussian],
+                'epochs': dict(self.epochs),
+                'props': {img_id: int(p) for img_id, p in self.props.iteritems()},
+                'quotas': {img_id: dict(q) for img_id, q in self.quotas.iteritems()},
+                'positions': positions,
+                'batches': self.batches_emitted,
+                'chips': self.chips_emitted}
+
+    def _restore(self, state):
+        '''
+        helper function to continue from a state() dictionary or save_state() file
+        '''
+        if isinstance(state, basestring):
+            with open(state) as f:
+                state = json.load(f)
+
+        if state['batch_size'] != self.batch_size or \
+                state['shapefile'] != os.path.basename(self.shapefile):
+            raise ValueError('state was saved for a different shapefile or batch size')
+
+        algorithm, keys, pos, has_gauss, cached_gaussian = state['rng']
+        self.rng.set_state((str(algorithm), np.array(keys, dtype=np.uint32), pos,
+                            has_gauss, cached_gaussian))
+        self.epochs = dict(state['epochs'])
+        if 'props' in state:
+            self.props = dict(state['props'])
+        self.quotas = {img_id: dict(q) for img_id, q in
+                       state.get('quotas', {}).iteritems()}
+        self._resume = {img_id: dict(p) for img_id, p in state['positions'].iteritems()}
+        self.batches_emitted = state['batches']
+        self.chips_emitted = state['chips']
+
+    def _next_batch(self):
+        '''
+        collect a batch of chips from the image generators, and the state after it
+        '''
+        batches = []
 
-        np.random.shuffle(data)
-        return [np.array(i) for i in zip(*data)]
+        # hit each generator in chip_gens, in a fixed order
+        for img_id in sorted(self.chip_gens):
+            print '\nCollecting chips for image ' + str(img_id) + '...'
+            batches.append(self.chip_gens[img_id].next())
+
+        # merge image batches, scattering them straight into shuffled positions
+        total = sum(len(b[0]) for b in batches)
+        order = self.rng.permutation(total)
+        merged = []
+        for i in xrange(len(batches[0])):
+            parts = [np.asarray(b[i]) for b in batches]
+            out = np.empty((total,) + parts[0].shape[1:], dtype=np.result_type(*parts))
+            start = 0
+            for part in parts:
+                out[order[start:start + len(part)]] = part
+                start += len(part)
+            merged.append(out)
+
+        self.batches_emitted += 1
+        self.chips_emitted += total
+        return merged, self._snapshot()
@@ -0,0 +1,93 @@
+# Deploy a trained classifier over a whole image strip.
+# The strip is streamed in tiles and batches of chips, and the predictions are
+# emitted batch by batch, so that the memory used does not depend on the size
+# of the strip.
+
+import numpy as np
+import data_extractors as de
+import raster_pool
+
+
+def deploy(image, predict, chip_size, stride=None, batch_size=32,
+           tile_size=[2048, 2048], max_zero_fraction=None, dtype='float32',
+           normalize=True, compute_features=None, prefetch=1, max_zeros=None):
+    '''
+    Run a batch predictor on the sliding windows of an image and yield the
+        predictions as they are computed. The image is read in tiles of about
+        tile_size pixels that overlap by the window size minus the stride, so only
+        one tile and a few batches are held in memory at a time. Tiles are read in
+        a background thread while the predictor runs; the thread is stopped when
+        the generator is closed or garbage collected (ex: after a break).
+
+    INPUT   image (string): name of the image file
+            predict (function): batch predictor, called with an array of shape
+                (n, bands, ysize, xsize), or (n, features) if compute_features is
+                given. For example model.predict of a keras model, or
+                predict_proba of a sklearn classifier.
+            chip_size (list[int]): window dimensions [xsize, ysize] in pixels
+            stride (list[int]): window step [x, y] in pixels. Defaults to None
+                (chip_size, no overlap).
+            batch_size (int): number of chips per call of predict. Defaults to 32.
+            tile_size (list[int]): approximate [xsize, ysize] of the tiles read
+                from the image. Defaults to [2048, 2048].
+            max_zero_fraction (float): skip windows in which at least this fraction
+                of the pixels is zero in all bands. Defaults to None (no filter).
+            dtype (string): data type of the chip batches. Defaults to 'float32'.
+            normalize (bool): divide chips by 255 (floating point dtypes only).
+                Defaults to True.
+            compute_features (function): feature function applied to each chip
+                (ex: features.pool_basic); predict then gets the feature vectors.
+                Defaults to None (predict gets the chips).
+            prefetch (int): number of batches to read ahead of the predictor.
+                Defaults to 1; 0 reads on the caller's thread.
+            max_zeros (int): skip windows with at least this many zero values,
+                counted over all bands. Defaults to None (no filter).
+
+    OUTPUT  generator of (locations, predictions) per batch. locations is an array
+                of shape (n, 2) with the (x, y) pixel of the upper left corner of
+                each window; predictions is the output of predict for the batch.
+
+    EXAMPLE
+            $ for locations, probs in deploy('strip.tif', model.predict, [125, 125]):
+            $     hits = locations[probs[:, 1] > 0.5]
+    '''
+    batches = de.sliding_window(image, chip_size, stride=stride,
+                                batch_size=batch_size,
+                                max_zero_fraction=max_zero_fraction,
+                                tile_lines=tile_size[1], tile_columns=tile_size[0],
+                                dtype=dtype, normalize=normalize,
+                                max_zeros=max_zeros)
+    if prefetch > 0:
+        batches = de.BatchPrefetcher(batches, depth=prefetch)
+
+    try:
+        for chips, locations in batches:
+            if compute_features is not None:
+                chips = np.array([compute_features(chip) for chip in chips])
+            yield locations, predict(chips)
+    finally:
+        # the caller may stop early (or predict may raise); stop the reads and
+        # release the tiles
+        batches.close()
+
+
+def detections(image, results, chip_size, select):
+    '''
+    Turn the output of deploy into detections, one at a time.
+
+    INPUT   image (string): name of the image file
+            results (iterator): (locations, predictions) batches from deploy
+            chip_size (list[int]): window dimensions [xsize, ysize] in pixels
+            select (function): called with the predictions of a batch; returns a
+                boolean array marking the windows that are detections
+
+    OUTPUT  generator of (lng, lat, prediction) for each detection, with (lng, lat)
+                the center of the window in the image projection
+    '''
+    img = raster_pool.open_image(image)
+    for locations, predictions in results:
+        hits = np.flatnonzero(select(predictions))
+        for i in hits:
+            x, y = locations[i]
+            lng, lat = img.raster_to_proj(x + chip_size[0] / 2., y + chip_size[1] / 2.)
+            yield lng, lat, predictions[i]
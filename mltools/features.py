@@ -71,3 +71,28 @@ def pool_basic(data):
     band36_ratio = band_ratios(data, 3, 6)
 
     return [np.max(band26_ratio), np.max(band36_ratio), np.min(pool_data), np.min(covered_pool_data)]
+
+
+def compute_all(chips, compute_features):
+    '''Apply a feature function to every chip and stack the feature vectors.
+       Chips of a PackedChips object are visited as views of its buffer, so no
+       chip is copied.
+
+       Args:
+           chips (list or PackedChips): Chips of shape (n,x,y).
+           compute_features (function): Feature function, e.g. pool_basic.
+
+       Returns:
+           Feature numpy array of shape (number of chips, number of features).
+    '''
+
+    vectors = None
+    for i, chip in enumerate(chips):
+        vector = compute_features(chip)
+        if vectors is None:
+            vectors = np.zeros((len(chips), len(vector)))
+        vectors[i] = vector
+
+    if vectors is None:
+        return np.zeros((0, 0))
+    return vectors
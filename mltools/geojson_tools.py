@@ -1,37 +1,57 @@
 # Contains functions for manipulating jsons and geojsons.
 
 import geojson
+import json
 import numpy as np
 import geoio
 import sys
 import random
 import subprocess
 import os
+import re
+import raster_pool
+from metrics import ExtractionMetrics, print_progress
+from collections import Counter, OrderedDict
+from itertools import islice
 
 from shapely.wkb import loads
 
 
 def join(input_files, output_file):
-    """Join geojsons into one. The spatial reference system of the
-       output file is the same as the one of the last file in the list.
+    """Join geojsons into one. The files are read and written one feature
+       at a time. All files must have the same spatial reference system,
+       which is the one of the output file.
 
        Args:
            input_files (list): List of file name strings.
            output_file (str): Output file name.
+
+       Returns:
+           Number of features written.
     """
 
-    # get feature collections
-    final_features = []
-    for file in input_files:
-        with open(file) as f:
-            feat_collection = geojson.load(f)
-            final_features += feat_collection['features']
+    headers = [{} for file in input_files]
+    with FeatureWriter(output_file, headers[0] if headers else None) as writer:
+        for file, header in zip(input_files, headers):
+            for feature in iter_features(file, header):
+                writer.write(feature)
+
+            if _crs_name(header.get('crs')) != _crs_name(headers[0].get('crs')):
+                raise ValueError('{} and {} have different crs'.format(
+                    input_files[0], file))
 
-    feat_collection['features'] = final_features
+    return writer.count
 
-    # write to output file
-    with open(output_file, 'w') as f:
-        geojson.dump(feat_collection, f)
+
+def _crs_name(crs):
+    """Name of a geojson crs member, None for WGS84 (the geojson default)."""
+    if crs is None:
+        return None
+    name = (crs.get('properties') or {}).get('name')
+    if name in ('EPSG:4326', 'urn:ogc:def:crs:EPSG::4326',
+                'urn:ogc:def:crs:OGC:1.3:CRS84'):
+        return None
+    return name or json.dumps(crs, sort_keys=True)
 
 
 def split(input_file, file_1, file_2, no_in_first_file):
@@ -60,9 +80,109 @@ def split(input_file, file_1, file_2, no_in_first_file):
         geojson.dump(feat_collection_2, f)
 
 
+def shard(input_file, property_name='image_id', shards=None, output_file=None,
+          max_open=128):
+    """Split a geojson into smaller files in one pass: one file per value of
+       property_name (ex: one per image_id), or a given number of shards of
+       balanced size. Features keep their file order, and each output file
+       gets the crs of input_file. Features without property_name (or with
+       a null value) are treated as having the value None; without shards
+       they go to the file named with None (ex: input_None.geojson).
+       Non-ASCII values are UTF-8 encoded in the file names; a value that is
+       not a valid file name (containing a path separator, or '.' or '..')
+       raises a ValueError.
+
+       Args:
+           input_file (str): Input file name.
+           property_name (str): Property to shard by. All features with the
+                                same value go to the same file. If None,
+                                features are dealt to the shards in turn.
+                                Defaults to 'image_id'.
+           shards (int): Number of output files. If None, there is one file
+                         per value of property_name. Otherwise values are
+                         assigned to shards, largest first, so that the
+                         shards have about the same number of features
+                         (counted with feature_index for indexed properties,
+                         in an extra pass otherwise). Defaults to None.
+           output_file (str): Output file name pattern, formatted with the
+                              property value or shard number. Defaults to
+                              input_file with '_{}' before the extension.
+           max_open (int): Maximum number of output files open at a time.
+                           When more files are written, the least recently
+                           written one is closed and reopened at its next
+                           feature. Defaults to 128.
+
+       Returns:
+           Dictionary {output file name: number of features}.
+    """
+    if property_name is None and shards is None:
+        raise ValueError('Give a property_name, a number of shards or both')
+
+    if output_file is None:
+        root, ext = os.path.splitext(input_file)
+        output_file = root + '_{}' + (ext or '.geojson')
+
+    # assign property values to shards
+    assignment = None
+    if shards is not None and property_name is not None:
+        if property_name in FeatureIndex.properties:
+            counts = feature_index(input_file).counts[property_name]
+        else:
+            counts = Counter((feat.get('properties') or {}).get(property_name)
+                             for feat in iter_features(input_file))
+        assignment, sizes = {}, np.zeros(shards, dtype=int)
+        for value, count in sorted(counts.iteritems(), key=lambda vc: -vc[1]):
+            assignment[value] = int(np.argmin(sizes))
+            sizes[assignment[value]] += count
+
+    # writers with an open file handle, least recently written first
+    header, writers, open_writers = {}, {}, OrderedDict()
+    try:
+        for i, feature in enumerate(iter_features(input_file, header)):
+            if property_name is None:
+                key = i % shards
+            else:
+                key = (feature.get('properties') or {}).get(property_name)
+                if assignment is not None:
+                    key = assignment[key]
+            if key not in writers:
+                writers[key] = FeatureWriter(_shard_name(output_file, key), header)
+            writers[key].write(feature)
+
+            open_writers.pop(key, None)
+            open_writers[key] = writers[key]
+            if len(open_writers) > max_open:
+                open_writers.popitem(last=False)[1].pause()
+    except:
+        for writer in writers.values():
+            writer.__exit__(*sys.exc_info())
+        raise
+
+    for writer in writers.values():
+        writer.close()
+    return {writer.output_file: writer.count for writer in writers.values()}
+
+
+def _shard_name(output_file, value):
+    """Format the output file name pattern of shard with a property value."""
+    if not isinstance(value, unicode):
+        value = str(value)
+    if value in ('.', '..') or '\0' in value or \
+            any(sep in value for sep in ('/', os.sep, os.altsep) if sep):
+        raise ValueError('Value {!r} can not be used in a file name'.format(value))
+
+    if isinstance(output_file, unicode):
+        return output_file.format(unicode(value, 'utf-8')
+                                  if isinstance(value, str) else value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return output_file.format(value)
+
+
 def get_from(input_file, property_names):
     """Reads a geojson and returns a list of value tuples, each value
-       corresponding to a property in property_names.
+       corresponding to a property in property_names. The file is read one
+       feature at a time.
 
        Args:
            input_file (str): File name.
@@ -72,49 +192,181 @@ def get_from(input_file, property_names):
            List of value tuples.
     """
 
-    # get feature collections
-    with open(input_file) as f:
-        feature_collection = geojson.load(f)
-
-    features = feature_collection['features']
     values = [tuple([feat['properties'].get(x)
-                     for x in property_names]) for feat in features]
+                     for x in property_names]) for feat in iter_features(input_file)]
 
     return values
 
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """Incremental tokenizer over a json file: reads the file in chunks and
+       decodes one value at a time from a buffer holding the unread part of
+       the current chunk.
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.eof = '', 0, False
+        self.base = f.tell()    # file offset of buf[0]
+
+    def _fill(self):
+        # read at least as much as is pending, so a value larger than
+        # chunk_size is decoded in a number of passes logarithmic in its size
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.base += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def tell(self):
+        """File offset of the next unread character."""
+        return self.base + self.pos
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at the end)."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of {} at {}, found {}'.format(
+                list(chars), self.tell(), repr(c)))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the next json value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self.buf) and not self.eof:
+                # a number may continue in the next chunk
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(input_file, header=None, chunk_size=2 ** 20,
+                  with_offsets=False):
+    """Read the features of a geojson feature collection one at a time,
+       without loading the whole file. Memory use is bounded by chunk_size
+       and the size of the largest feature.
+
+       Args:
+           input_file (str): File name.
+           header (dict): If given, it is filled with the members of the
+                          feature collection other than features (ex: type,
+                          crs) as they are read. Members written after the
+                          features are only there once all features are read.
+           chunk_size (int): Number of bytes read at a time. Defaults to 1 MB.
+           with_offsets (bool): Yield (offset, feature), with offset the
+                                position of the feature in the file in bytes
+                                (see read_features). Defaults to False.
+
+       Yields:
+           Feature dictionaries, in file order.
+    """
+    with open(input_file, 'rb') as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'features':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.pos += 1
+                else:
+                    while True:
+                        stream.peek()
+                        offset = stream.tell()
+                        feature = stream.value()
+                        yield (offset, feature) if with_offsets else feature
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                value = stream.value()
+                if header is not None:
+                    header[key] = value
+
+            if stream.expect(',}') == '}':
+                return
+
+
+def read_features(input_file, offsets, chunk_size=2 ** 14):
+    """Read the features at the given byte offsets of a geojson file (as
+       yielded by iter_features with with_offsets=True), in the order of
+       offsets. offsets can be a generator; each feature is read when its
+       offset is pulled from it, and the file is opened once.
+
+       Args:
+           input_file (str): File name.
+           offsets (iterable): Byte offsets of features in input_file.
+           chunk_size (int): Number of bytes read at a time. Defaults to 16 kB.
+
+       Yields:
+           Feature dictionaries.
+    """
+    with open(input_file, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            yield _JSONStream(f, chunk_size).value()
+
+
 def write_to(data, property_names, output_file):
     '''Write list of tuples to geojson.
        First entry of each tuple should be geometry in hex coordinates
-       and the rest properties.
+       and the rest properties. Features are written as they are read from
+       data, which can be a generator.
 
        Args:
-           data: List of tuples.
+           data: List (or iterable) of tuples.
            property_names: List of strings. Should be same length as the
                            number of properties.
            output_file (str): Output file name.
 
+       Returns:
+           Number of features written.
     '''
 
-    geojson_features = []
-    for entry in data:
-        coords_in_hex, properties = entry[0], entry[1:]
-        geometry = loads(coords_in_hex, hex=True)
-        property_dict = dict(zip(property_names, properties))
-        if geometry.geom_type == 'Polygon':
-            coords = [list(geometry.exterior.coords)]   # brackets required
-            geojson_feature = geojson.Feature(geometry=geojson.Polygon(coords),
-                                              properties=property_dict)
-        elif geometry.geom_type == 'Point':
-            coords = list(geometry.coords)[0]
-            geojson_feature = geojson.Feature(geometry=geojson.Point(coords),
-                                              properties=property_dict)
-        geojson_features.append(geojson_feature)
-
-    feature_collection = geojson.FeatureCollection(geojson_features)
+    def features():
+        for entry in data:
+            coords_in_hex, properties = entry[0], entry[1:]
+            geometry = loads(coords_in_hex, hex=True)
+            property_dict = dict(zip(property_names, properties))
+            if geometry.geom_type == 'Polygon':
+                coords = [list(geometry.exterior.coords)]   # brackets required
+                geojson_feature = geojson.Feature(geometry=geojson.Polygon(coords),
+                                                  properties=property_dict)
+            elif geometry.geom_type == 'Point':
+                coords = list(geometry.coords)[0]
+                geojson_feature = geojson.Feature(geometry=geojson.Point(coords),
+                                                  properties=property_dict)
+            yield geojson_feature
 
-    with open(output_file, 'wb') as f:
-        geojson.dump(feature_collection, f)
+    return write_features(features(), output_file)
 
 
 def write_properties_to(data, property_names, input_file,
@@ -122,11 +374,15 @@ def write_properties_to(data, property_names, input_file,
     """Writes property data to polygon_file for all
        geometries indicated in the filter, and creates output file.
        The length of data must be equal to the number of geometries in
-       the filter. Existing property values are overwritten.
+       the filter. Existing property values are overwritten. Features are
+       read, updated and written one at a time; output_file can be
+       input_file.
 
        Args:
            data (list): List of tuples. Each entry is a tuple of dimension equal
-                        to property_names.
+                        to property_names. Without filter, data can be an
+                        iterable (ex: a generator), which is read one entry
+                        per feature.
            property_names (list): Property names.
            input_file (str): Input file name.
            output_file (str): Output file name.
@@ -134,33 +390,362 @@ def write_properties_to(data, property_names, input_file,
                           What this achieves is to write the first entry of data
                           to the properties of the feature with
                           'property_name'=value1, and so on. This makes sense only
-                          if these values are unique. If Filter=None, then
-                          data is written to all geometries in the input file.
+                          if these values are unique: if a value is repeated,
+                          the first of its entries is written. If Filter=None,
+                          then data is written to all geometries in the input file.
+
+       Returns:
+           Dictionary with the number of features written, and with a filter,
+           the number of matched features, the filter values found in no
+           feature (unmatched), the repeated filter values (duplicates) and
+           the number of features matching a filter value beyond the end of
+           data (no_data), which are written unchanged. These problems, and
+           a data length that differs from the number of filter values, are
+           also reported on stdout.
     """
 
-    with open(input_file) as f:
-        feature_collection = geojson.load(f)
+    def features():
+        if filter is None:
+            rows = iter(data)
+            for i, feature in enumerate(iter_features(input_file, header)):
+                row = next(rows, None)
+                if row is None:
+                    raise IndexError('data has {} entries, fewer than the features '
+                                     'of {}'.format(i, input_file))
+                for j, property_value in enumerate(row):
+                    feature['properties'][property_names[j]] = property_value
+                yield feature
+            return
+
+        # look up the filter values of a chunk of features at a time
+        chunks = iter_features(input_file, header)
+        while True:
+            chunk = list(islice(chunks, 4096))
+            if not chunk:
+                return
+            positions = join.lookup([(feature['properties'] or {}).get(filter_name)
+                                     for feature in chunk])
+            for feature, position in zip(chunk, positions):
+                if position >= len(data):
+                    report['no_data'] += 1
+                elif position >= 0:
+                    report['matched'] += 1
+                    for j, property_value in enumerate(data[position]):
+                        feature['properties'][property_names[j]] = property_value
+                yield feature
+
+    # members of the input collection (type, crs, ...) are copied as read
+    header = {}
+    report = {}
+
+    if filter is not None:
+        filter_name, filter_values = filter.items()[0]
+        if len(filter_values) != len(data):
+            print 'data has {} entries for {} values of {}'.format(
+                len(data), len(filter_values), filter_name)
+        join = _PropertyJoin(filter_values)
+        report['matched'] = 0
+        report['no_data'] = 0
+
+    report['written'] = write_features(features(), output_file, header)
+
+    if filter is not None:
+        report['unmatched'] = join.unmatched()
+        report['duplicates'] = join.duplicates
+        if report['unmatched']:
+            print '{} of the {} values of {} are not in {}'.format(
+                len(report['unmatched']), len(filter_values), filter_name, input_file)
+        if report['duplicates']:
+            print '{} values of {} are repeated; their first entry was written'.format(
+                len(report['duplicates']), filter_name)
+        if report['no_data']:
+            print '{} features matched a value of {} with no data entry; they were ' \
+                'written unchanged'.format(report['no_data'], filter_name)
+
+    return report
+
+
+class _PropertyJoin(object):
+    """Index of the values of a join key (ex: the feature ids of a filter),
+       mapping a value to the position of its first occurrence. Numeric keys
+       are looked up a whole array at a time in a sorted copy of the values;
+       other keys in a dictionary.
+
+       Args:
+           values (list): Values of the join key.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.first = {}
+        self.duplicates = []
+        for i, value in enumerate(values.tolist()):
+            if value in self.first:
+                if value not in self.duplicates:
+                    self.duplicates.append(value)
+            else:
+                self.first[value] = i
+
+        self.numeric = values.dtype.kind in 'iuf' and len(values) > 0
+        if self.numeric:
+            first = np.array(sorted(self.first.values()), dtype=int)
+            order = np.argsort(values[first], kind='mergesort')
+            self.sorted_values, self.sorted_positions = values[first][order], first[order]
+
+        self.values = values
+        self.matched = np.zeros(len(values), dtype=bool)
+
+    def lookup(self, keys):
+        """Positions of keys in the values, -1 for the keys not found."""
+        key_array = np.asarray(keys)
+        if self.numeric and key_array.dtype.kind in 'iuf':
+            ix = np.searchsorted(self.sorted_values, key_array)
+            ix = np.minimum(ix, len(self.sorted_values) - 1)
+            positions = np.where(self.sorted_values[ix] == key_array,
+                                 self.sorted_positions[ix], -1)
+        else:
+            positions = np.array([self.first.get(key, -1) for key in keys], dtype=int)
 
-    features = feature_collection['features']
+        self.matched[positions[positions >= 0]] = True
+        return positions
 
-    if filter is None:
-        for i, feature in enumerate(features):
-            for j, property_value in enumerate(data[i]):
-                feature['properties'][property_names[j]] = property_value
-    else:
-        filter_name = filter.keys()[0]
-        filter_values = np.array(filter.values()[0])
+    def unmatched(self):
+        """Values that no key looked up so far matched."""
+        return [self.values[i].item() for i in sorted(self.first.values())
+                if not self.matched[i]]
+
+
+def write_features(features, output_file, header=None):
+    """Write features to a geojson feature collection one at a time, so that
+       memory use does not depend on the number of features.
+
+       Args:
+           features (iterable): Feature dictionaries (or geojson.Feature), for
+                                example a generator.
+           output_file (str): Output file name. It is replaced once all
+                              features are written, so it can be the file the
+                              features are read from.
+           header (dict): Members of the feature collection other than
+                          features (ex: crs). Defaults to a FeatureCollection
+                          type only.
+
+       Returns:
+           Number of features written.
+    """
+    with FeatureWriter(output_file, header) as writer:
         for feature in features:
-            compare_value = feature['properties'][filter_name]
-            ind = np.where(filter_values == compare_value)[0]
-            if len(ind) > 0:
-                for j, property_value in enumerate(data[ind]):
-                    feature['properties'][property_names[j]] = property_value
+            writer.write(feature)
+    return writer.count
+
+
+class FeatureWriter(object):
+    """Incremental writer of a geojson feature collection. Features are
+       written to disk as they are passed to write(); the collection is
+       closed by close() or at the end of a with block. The file is written
+       to a temporary file in the same directory and renamed to output_file
+       when closed, so output_file can be the file the features are read
+       from, and it is never left half written.
+
+       Args:
+           output_file (str): Output file name.
+           header (dict): Members of the feature collection other than
+                          features (ex: {'crs': crs}). They are written with
+                          the first feature, so header can be filled while
+                          the input is read (see iter_features); members
+                          added later are written by close(). Defaults to
+                          None (type FeatureCollection only).
+    """
+
+    def __init__(self, output_file, header=None):
+        self.output_file = output_file
+        self.header = header if header is not None else {}
+        self.count = 0
+        self.closed = False
+        self._written = set()
+        self._tmp_file = '{}.{}.tmp'.format(output_file, os.getpid())
+        self._f = open(self._tmp_file, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pause()
+            self.closed = True
+            os.remove(self._tmp_file)
+
+    def _file(self):
+        # the temporary file, reopened at its end after pause()
+        if self._f is None:
+            self._f = open(self._tmp_file, 'r+b')
+            self._f.seek(0, os.SEEK_END)
+        return self._f
+
+    def _write_members(self, members):
+        # header members not written yet, each followed by a comma
+        for key in sorted(members):
+            if key not in self._written and key != 'features':
+                self._file().write('{}: {}, '.format(json.dumps(key),
+                                                     geojson.dumps(members[key])))
+                self._written.add(key)
+
+    def _start(self):
+        self._file().write('{')
+        self._write_members(dict({'type': 'FeatureCollection'}, **self.header))
+        self._file().write('"features": [')
+
+    def write(self, feature):
+        """Append a feature to the collection."""
+        if self.count == 0:
+            self._start()
+        else:
+            self._file().write(', ')
+        self._file().write(geojson.dumps(feature))
+        self.count += 1
+
+    def pause(self):
+        """Close the file handle until the next write() or close(), so that
+           many collections can be written at once without running out of
+           file handles.
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def close(self):
+        """Finish the collection and move it to output_file."""
+        if self.closed:
+            return
+        if self.count == 0:
+            self._start()
+        f = self._file()
+        f.write('], ')
+        # members of the header that were read after the features
+        self._write_members(self.header)
+        f.seek(-2, os.SEEK_CUR)
+        f.write('}')
+        f.truncate()
+        self.pause()
+        self.closed = True
+        os.rename(self._tmp_file, self.output_file)
+
+
+class FeatureIndex(object):
+    """In-memory index of a geojson file, built in a single pass.
+       For each feature it stores its position in the file, its byte offset,
+       the image_id, class_name and feature_id properties. Geometries are
+       not kept; features(positions) reads whole features from the file on
+       demand. Use feature_index() to get a shared, memoized instance.
 
-    feature_collection['features'] = features
+       Args:
+           input_file (str): File name.
+    """
+
+    properties = ['image_id', 'class_name', 'feature_id']
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+
+        columns = {name: [] for name in self.properties}
+        starts = []
+        for start, feat in iter_features(input_file, with_offsets=True):
+            properties = feat.get('properties') or {}
+            for name in self.properties:
+                columns[name].append(properties.get(name))
+            starts.append(start)
+
+        self.size = len(starts)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.columns = {name: np.array(values) for name, values in columns.iteritems()}
+        self.counts = {name: Counter(values) for name, values in columns.iteritems()}
+        self._positions = {}
+
+    def __len__(self):
+        return self.size
+
+    def unique(self, property_name):
+        """Distinct values of an indexed property (same output as
+           find_unique_values).
+        """
+        return np.unique(self.columns[property_name])
+
+    def count(self, property_name, value):
+        """Number of features whose property equals value."""
+        return self.counts[property_name][value]
+
+    def proportion(self, property_name, value):
+        """Proportion of features whose property, converted to str, equals
+           value. Same semantics as getIterData.get_proportion.
+        """
+        if self.size == 0:
+            return 0.
+
+        matches = 0
+        for v, count in self.counts[property_name].iteritems():
+            try:
+                if v is not None and str(v) == value:
+                    matches += count
+            except UnicodeError:
+                continue
+
+        return float(matches) / self.size
+
+    def offsets(self, property_name, value):
+        """Positions (in file order) of the features whose property equals
+           value.
+        """
+        return np.flatnonzero(self.columns[property_name] == value)
+
+    def position(self, feature_id):
+        """Position of the feature with the given feature_id, or None."""
+        if not self._positions:
+            self._positions = {fid: i for i, fid in
+                               enumerate(self.columns['feature_id'].tolist())}
+        return self._positions.get(feature_id)
+
+    def record(self, position):
+        """Indexed properties of the feature at position, as a dictionary."""
+        record = {}
+        for name in self.properties:
+            value = self.columns[name][position]
+            record[name] = value.item() if isinstance(value, np.generic) else value
+        return record
+
+    def features(self, positions):
+        """Read the features at the given positions from the file, in the
+           order of positions (see read_features; positions can be a
+           generator).
+        """
+        return read_features(self.input_file,
+                             (self.starts[position] for position in positions))
+
+
+_feature_indices = {}
 
-    with open(output_file, 'w') as f:
-        geojson.dump(feature_collection, f)
+
+def feature_index(input_file):
+    """Return the FeatureIndex of a geojson file. Indices are memoized on
+       (path, size, modification time), so all mltools helpers reading the
+       same unchanged file share one index.
+
+       Args:
+           input_file (str): File name.
+
+       Returns:
+           FeatureIndex object.
+    """
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_size, stat.st_mtime)
+
+    if key not in _feature_indices:
+        # an edited file invalidates its old index
+        for old_key in [k for k in _feature_indices if k[0] == key[0]]:
+            del _feature_indices[old_key]
+        _feature_indices[key] = FeatureIndex(input_file)
+
+    return _feature_indices[key]
 
 
 def find_unique_values(input_file, property_name):
@@ -174,12 +759,11 @@ def find_unique_values(input_file, property_name):
            List of distinct values of property.
            If property does not exist, it returns None.
     """
-    with open(input_file) as f:
-        feature_collection = geojson.load(f)
+    if property_name in FeatureIndex.properties:
+        return feature_index(input_file).unique(property_name)
 
-    features = feature_collection['features']
     values = np.array([feat['properties'].get(property_name)
-                       for feat in features])
+                       for feat in iter_features(input_file)])
     return np.unique(values)
 
 
@@ -279,7 +863,7 @@ def create_balanced_geojson(shapefile, output_file, balanced = True,
 
 
 def filter_polygon_size(shapefile, output_file, min_polygon_hw=0, max_polygon_hw=125,
-                        shuffle=False):
+                        shuffle=False, metrics=None):
     '''
     Creates a geojson file containing only acceptable side dimensions for polygons.
     INPUT   (1) string 'shapefile': name of shapefile with original samples
@@ -291,18 +875,23 @@ def filter_polygon_size(shapefile, output_file, min_polygon_hw=0, max_polygon_hw
                 given polygon
             (5) bool 'shuffle': shuffle polygons before saving to output file. Defaults to
                 False
+            (6) ExtractionMetrics 'metrics': collects polygons/s, bytes read, read time
+                and rejected polygons by reason. Defaults to None, in which case
+                progress is printed at most once per second.
     OUTPUT  (1) a geojson file (output_file.geojson) containing only polygons of
                 acceptable side dimensions
     '''
     # load polygons
     with open(shapefile) as f:
         data = geojson.load(f)
-    total = float(len(data['features']))
 
     # format output file name
     if output_file[-8:] != '.geojson':
         output_file = output_file + '.geojson'
 
+    if metrics is None:
+        metrics = ExtractionMetrics(callback=print_progress)
+
     # find indicies of acceptable polygons
     ix_ok, ix = [], 0
     print 'Extracting image ids...'
@@ -311,7 +900,7 @@ def filter_polygon_size(shapefile, output_file, min_polygon_hw=0, max_polygon_hw
     print 'Filtering polygons...'
     for img_id in img_ids:
         print '... for image {}'.format(img_id)
-        img = geoio.GeoImage(img_id + '.tif')
+        img = raster_pool.open_image(img_id + '.tif')
 
         # create vrt if img has multiple bands (more efficient)
         if img.shape[0] > 1:
@@ -320,26 +909,23 @@ def filter_polygon_size(shapefile, output_file, min_polygon_hw=0, max_polygon_hw
             img = geoio.GeoImage('tmp.vrt')
 
         # cycle thru polygons
-        for chip, properties in img.iter_vector(vector=shapefile,
-                                                properties=True,
-                                                filter=[{'image_id': img_id}],
-                                                mask=True):
+        chips = img.iter_vector(vector=shapefile, properties=True,
+                                filter=[{'image_id': img_id}], mask=True)
+        for chip, properties in metrics.timed(chips, 'read'):
             if chip is None:
+                metrics.reject('empty')
                 continue
 
             chan,h,w = np.shape(chip)
             if min(h, w) < min_polygon_hw or max(h, w) > max_polygon_hw:
                 ix += 1
-                # add percent complete to stdout
-                sys.stdout.write('\r%{0:.2f}'.format(100 * ix / total) + ' ' * 20)
-                sys.stdout.flush()
+                metrics.reject('too_small' if min(h, w) < min_polygon_hw
+                               else 'too_large', chip)
                 continue
 
             ix_ok.append(ix)
             ix += 1
-            # add percent complete to stdout
-            sys.stdout.write('\r%{0:.2f}'.format(100 * ix / total) + ' ' * 20)
-            sys.stdout.flush()
+            metrics.add_chip(chip)
 
     # remove vrt file
     try:
@@ -0,0 +1,127 @@
+# Throughput instrumentation for chip extraction.
+# The chip generators report the chips they produce, the chips they reject and
+# the time spent in each stage to an ExtractionMetrics object, which reports
+# progress to a callback at a bounded rate and summarizes the run.
+
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class ExtractionMetrics(object):
+    '''
+    Collects throughput statistics of a chip extraction run: chips produced, bytes
+        of pixel data read, seconds spent per stage (ex: 'read', 'pad',
+        'normalize') and rejected chips by reason (ex: 'too_small', 'too_large',
+        'missing_label'). The progress callback is called at most once every
+        interval seconds, so reporting costs nothing on fast paths.
+
+    INPUT   callback (function): called as callback(summary) with the output of
+                summary(). Defaults to None (no progress reporting); use
+                print_progress to write a progress line to stdout.
+            interval (float): minimum number of seconds between two calls of
+                callback. Defaults to 1.
+
+    EXAMPLE
+            $ metrics = ExtractionMetrics(callback=print_progress)
+            $ g = get_iter_data('shapefile.geojson', metrics=metrics)
+            $ x, y = g.next()
+            $ metrics.summary()
+    '''
+
+    def __init__(self, callback=None, interval=1.):
+        self.callback = callback
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        '''
+        Clear all statistics and restart the clock.
+        '''
+        self.chips = 0
+        self.bytes_read = 0
+        self.times = defaultdict(float)
+        self.rejects = Counter()
+        self.start_time = time.time()
+        self._last_report = self.start_time
+
+    def add_chip(self, chip):
+        '''
+        Count an extracted chip and the bytes of its pixel data.
+        '''
+        self.chips += 1
+        if chip is not None:
+            self.bytes_read += getattr(chip, 'nbytes', 0)
+        self._report()
+
+    def reject(self, reason, chip=None):
+        '''
+        Count a chip that was read but not used, by reason, and the bytes of its
+            pixel data.
+        '''
+        self.rejects[reason] += 1
+        if chip is not None:
+            self.bytes_read += getattr(chip, 'nbytes', 0)
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Context manager adding the time spent in its block to stage.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.time() - start
+
+    def timed(self, iterable, stage):
+        '''
+        Iterate over iterable, adding the time spent producing each item to stage
+            (ex: the raster reads of a chip generator).
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[stage] += time.time() - start
+                return
+            self.times[stage] += time.time() - start
+            yield item
+
+    def _report(self):
+        if self.callback is None:
+            return
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.callback(self.summary())
+
+    def summary(self):
+        '''
+        Return the statistics of the run.
+
+        OUTPUT  summary (dict): chips, rejected (total), rejects (dict by reason),
+                    bytes_read, seconds (since creation or reset), chips_per_s,
+                    mb_per_s and times (dict of seconds by stage).
+        '''
+        seconds = time.time() - self.start_time
+        return {'chips': self.chips,
+                'rejected': sum(self.rejects.values()),
+                'rejects': dict(self.rejects),
+                'bytes_read': self.bytes_read,
+                'seconds': seconds,
+                'chips_per_s': self.chips / max(seconds, 1e-9),
+                'mb_per_s': self.bytes_read / 1e6 / max(seconds, 1e-9),
+                'times': dict(self.times)}
+
+
+def print_progress(summary):
+    '''
+    Progress callback writing the chip count and rate of a run to stdout.
+    '''
+    sys.stdout.write('\r{} chips, {:.1f} chips/s, {} rejected'.format(
+        summary['chips'], summary['chips_per_s'], summary['rejected']) + ' ' * 5)
+    sys.stdout.flush()
@@ -0,0 +1,135 @@
+# Ragged collection of chips packed into one contiguous buffer.
+# Chips of different shapes are stored back to back in a flat array, with
+# offset and shape arrays locating each chip, so that a collection of chips is
+# a handful of numpy arrays instead of thousands of small ones.
+
+import os
+import numpy as np
+
+
+class PackedChips(object):
+    '''
+    Read-only sequence of chips of variable shape, stored in one flat buffer. Chips
+        are returned as zero-copy views of the buffer (masked arrays if the
+        collection has masks). Pickling a PackedChips object pickles a few large
+        arrays, which is much faster than pickling a list of chips.
+
+    INPUT   data (array): flat array holding the pixels of all chips
+            offsets (array): position of the first pixel of each chip in data
+            shapes (array): array of shape (n, 3) with the shape of each chip
+            mask (array): flat boolean array of the same size as data, or None.
+                Defaults to None.
+
+    EXAMPLE
+            $ chips, ids, labels = get_data('train.geojson', return_labels=True,
+                                            mask=True, packed=True)
+            $ chips.save('train_chips')
+            $ chips = PackedChips.load('train_chips')     # memory-mapped
+            $ for chip in chips:
+            $     print chip.shape
+    '''
+
+    def __init__(self, data, offsets, shapes, mask=None):
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape((-1, 3))
+        self.mask = mask
+
+    @classmethod
+    def from_chips(cls, chips):
+        '''
+        Pack a list of chips (numpy arrays or masked arrays) of shape
+            (bands, h, w). The result has masks if any of the chips is a masked
+            array.
+        '''
+        shapes = np.array([np.shape(chip) for chip in chips], dtype=np.int64)
+        sizes = shapes.reshape((-1, 3)).prod(axis=1)
+        offsets = np.cumsum(sizes) - sizes
+
+        dtypes = set(np.ma.getdata(chip).dtype for chip in chips)
+        dtype = reduce(np.promote_types, dtypes) if dtypes else np.uint8
+        data = np.empty(sizes.sum(), dtype=dtype)
+        has_mask = any(isinstance(chip, np.ma.MaskedArray) for chip in chips)
+        mask = np.zeros(len(data), dtype=bool) if has_mask else None
+
+        for chip, start, size in zip(chips, offsets, sizes):
+            data[start:start + size] = np.ma.getdata(chip).ravel()
+            if has_mask:
+                mask[start:start + size] = np.ma.getmaskarray(chip).ravel()
+
+        return cls(data, offsets, shapes, mask)
+
+    @classmethod
+    def concatenate(cls, collections):
+        '''
+        Join PackedChips objects into one, in order.
+        '''
+        collections = list(collections)
+        if not collections:
+            return cls.from_chips([])
+
+        starts = np.cumsum([0] + [len(c.data) for c in collections[:-1]])
+        offsets = np.concatenate([c.offsets + start
+                                  for c, start in zip(collections, starts)])
+        shapes = np.concatenate([c.shapes for c in collections])
+        data = np.concatenate([c.data for c in collections])
+
+        mask = None
+        if any(c.mask is not None for c in collections):
+            mask = np.concatenate([c.mask if c.mask is not None else
+                                   np.zeros(len(c.data), dtype=bool)
+                                   for c in collections])
+        return cls(data, offsets, shapes, mask)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        '''
+        Return the i-th chip as a view of the buffer.
+        '''
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chip index out of range')
+
+        shape = tuple(self.shapes[i])
+        start = self.offsets[i]
+        stop = start + int(np.prod(shape))
+        chip = self.data[start:stop].reshape(shape)
+        if self.mask is not None:
+            chip = np.ma.masked_array(chip, mask=self.mask[start:stop].reshape(shape))
+        return chip
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def save(self, output_dir):
+        '''
+        Save the buffers as .npy files in output_dir (created if it does not exist).
+        '''
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        arrays = {'data': self.data, 'offsets': self.offsets, 'shapes': self.shapes}
+        if self.mask is not None:
+            arrays['mask'] = self.mask
+        for name, values in arrays.iteritems():
+            np.save(os.path.join(output_dir, name + '.npy'), values)
+
+    @classmethod
+    def load(cls, input_dir, mmap=True):
+        '''
+        Load chips saved with save(). With mmap, the pixel and mask buffers are
+            memory-mapped, so only the chips that are accessed are read.
+        '''
+        mmap_mode = 'r' if mmap else None
+        def load(name):
+            return np.load(os.path.join(input_dir, name + '.npy'), mmap_mode=mmap_mode)
+
+        mask = None
+        if os.path.isfile(os.path.join(input_dir, 'mask.npy')):
+            mask = load('mask')
+        return cls(load('data'), np.load(os.path.join(input_dir, 'offsets.npy')),
+                   np.load(os.path.join(input_dir, 'shapes.npy')), mask)
@@ -0,0 +1,118 @@
+# Process-wide pool of open raster handles.
+# Opening a large GeoTIFF with many overviews, or a VRT over many files, is
+# expensive; the extraction functions of mltools share their handles through
+# this pool instead of reopening the image on every call.
+
+import os
+import threading
+import geoio
+import osgeo.gdal as gdal
+from collections import OrderedDict
+from osgeo.gdalconst import GA_ReadOnly
+
+
+class RasterPool(object):
+    '''
+    LRU cache of open raster handles (geoio.GeoImage objects and GDAL datasets).
+        Handles are keyed by the absolute path, size and modification time of the
+        file, so a rewritten file is reopened. When more than max_open handles are
+        open, the least recently used one is released.
+
+        GDAL handles must not be shared between threads or across a fork: each
+        thread gets its own handles, and a process forked from the owner of the
+        pool (e.g. a multiprocessing worker) starts with an empty pool.
+
+    INPUT   max_open (int): maximum number of open handles. Defaults to 16.
+
+    EXAMPLE
+            $ pool = RasterPool(max_open=8)
+            $ img = pool.image('1040010014800C00.tif')
+            $ img = pool.image('1040010014800C00.tif')    # no reopen
+            $ pool.stats()
+            {'hits': 1, 'misses': 1, 'evictions': 0, 'open': 1}
+    '''
+
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._handles = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def _get(self, kind, file_name, opener):
+        stat = os.stat(file_name)
+        key = (kind, os.path.abspath(file_name), stat.st_size, stat.st_mtime,
+               threading.current_thread().ident)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the inherited handles belong to the parent
+                self._reset()
+
+            handle = self._handles.pop(key, None)
+            if handle is not None:
+                self.hits += 1
+                self._handles[key] = handle
+                return handle
+            self.misses += 1
+
+        # open outside of the lock; opening a VRT can take long
+        handle = opener(file_name)
+        if handle is None:
+            return None
+
+        with self._lock:
+            self._handles[key] = handle
+            while len(self._handles) > self.max_open:
+                self._handles.popitem(last=False)
+                self.evictions += 1
+        return handle
+
+    def image(self, file_name):
+        '''
+        Return a geoio.GeoImage of file_name.
+        '''
+        return self._get('image', file_name, geoio.GeoImage)
+
+    def dataset(self, file_name):
+        '''
+        Return a read-only GDAL dataset of file_name.
+        '''
+        return self._get('dataset', file_name,
+                         lambda f: gdal.Open(f, GA_ReadOnly))
+
+    def stats(self):
+        '''
+        Return the hit, miss and eviction counts and the number of open handles.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'open': len(self._handles)}
+
+    def clear(self):
+        '''
+        Release all handles and reset the counters.
+        '''
+        with self._lock:
+            self._reset()
+
+
+# shared by the extraction functions of mltools
+default_pool = RasterPool()
+
+
+def open_image(file_name):
+    '''
+    Return a geoio.GeoImage of file_name from the default pool.
+    '''
+    return default_pool.image(file_name)
+
+
+def open_dataset(file_name):
+    '''
+    Return a read-only GDAL dataset of file_name from the default pool.
+    '''
+    return default_pool.dataset(file_name)
@@ -0,0 +1,111 @@
+import os
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools.chip_cache import ChipCache
+from mltools.packed_chips import PackedChips
+
+
+@pytest.fixture
+def files(tmpdir):
+    shapefile, image = str(tmpdir.join('polygons.geojson')), str(tmpdir.join('img.tif'))
+    with open(shapefile, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": []}')
+    with open(image, 'w') as f:
+        f.write('pixels')
+    return shapefile, image
+
+
+def make_chips(n, masked=False):
+    rng = np.random.RandomState(n)
+    chips = [rng.randint(0, 255, (3, 2 + i % 3, 4)).astype('uint8') for i in xrange(n)]
+    if masked:
+        chips = [np.ma.masked_array(chip, mask=chip < 100) for chip in chips]
+    return chips
+
+
+def fill(cache, key, chips):
+    writer = cache.writer(key)
+    for i, chip in enumerate(chips):
+        writer.append(chip, {'feature_id': 'f{}'.format(i)})
+    writer.commit()
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_round_trip(tmpdir, files, masked):
+    cache = ChipCache(str(tmpdir.join('cache')))
+    key = cache.key(*files, image_id='img', buffer=[0, 0], mask=masked)
+    assert cache.get(key) is None
+
+    chips = make_chips(5, masked)
+    fill(cache, key, chips)
+    cached = cache.get(key)
+
+    assert isinstance(cached, PackedChips)
+    assert len(cached) == 5
+    for i, (chip, properties) in enumerate(cached):
+        assert properties == {'feature_id': 'f{}'.format(i)}
+        assert isinstance(chip, np.ma.MaskedArray) == masked
+        np.testing.assert_array_equal(np.ma.getdata(chip), np.ma.getdata(chips[i]))
+        np.testing.assert_array_equal(np.ma.getmaskarray(chip),
+                                      np.ma.getmaskarray(chips[i]))
+    np.testing.assert_array_equal(cached.get('f3'), chips[3])
+    assert cached.get('unknown') is None
+
+
+def test_empty_entry(tmpdir, files):
+    cache = ChipCache(str(tmpdir.join('cache')))
+    key = cache.key(*files)
+    fill(cache, key, [])
+    assert len(cache.get(key)) == 0
+
+
+def test_key(tmpdir, files):
+    shapefile, image = files
+    cache = ChipCache(str(tmpdir.join('cache')))
+    key = cache.key(shapefile, image, mask=True)
+
+    assert cache.key(shapefile, image, mask=True) == key
+    assert cache.key(shapefile, image, mask=False) != key
+    with open(shapefile, 'a') as f:
+        f.write('\n')
+    assert cache.key(shapefile, image, mask=True) != key
+
+
+def test_abort(tmpdir, files):
+    cache = ChipCache(str(tmpdir.join('cache')))
+    key = cache.key(*files)
+    writer = cache.writer(key)
+    writer.append(make_chips(1)[0], {'feature_id': 'f0'})
+    writer.abort()
+
+    assert cache.get(key) is None
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_evicts_least_recently_used(tmpdir, files):
+    chips = make_chips(4)
+    cache = ChipCache(str(tmpdir.join('cache')))
+    keys = [cache.key(*files, image_id=i) for i in xrange(3)]
+    for key in keys:
+        fill(cache, key, chips)
+    entry_size = cache.size() / 3
+
+    # make entry 0 the most recently used, then go over budget by one entry
+    for i, key in enumerate([keys[1], keys[2], keys[0]]):
+        os.utime(os.path.join(cache.cache_dir, key, 'index.json'),
+                 (time.time() - 100 + i, time.time() - 100 + i))
+    cache.max_bytes = 3 * entry_size
+    new_key = cache.key(*files, image_id=3)
+    fill(cache, new_key, chips)
+
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) is not None for key in [keys[0], keys[2], new_key])
+    assert cache.size() <= cache.max_bytes
+
+    cache.clear()
+    assert cache.size() == 0
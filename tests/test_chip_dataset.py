@@ -0,0 +1,124 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools import chip_dataset as cd
+
+
+def make_chips(n, dtype='uint8'):
+    return (np.arange(n * 2 * 3 * 3) % 251).reshape(n, 2, 3, 3).astype(dtype)
+
+
+def write_dataset(output_dir, labels, shard_size=4, classes=None):
+    chips = make_chips(len(labels))
+    writer = cd.ChipShardWriter(output_dir, shard_size=shard_size, classes=classes)
+    # batches of 3 do not line up with the shards
+    for start in xrange(0, len(labels), 3):
+        rows = slice(start, start + 3)
+        writer.add(chips[rows], feature_ids=range(len(labels))[rows],
+                   labels=labels[rows], image_ids=['img'] * len(chips[rows]))
+    writer.close()
+    return chips
+
+
+def test_round_trip(tmpdir):
+    labels = np.array([0, 1, 2, 1, 0, 2, 1, 1, 0, 2])
+    chips = write_dataset(str(tmpdir), labels, classes=['a', 'b', 'c'])
+    data = cd.ChipDataset(str(tmpdir))
+
+    assert len(data) == len(labels)
+    assert [shard['size'] for shard in data.shards] == [4, 4, 2]
+    assert data.nb_classes == 3
+    for i in xrange(len(data)):
+        chip, label, feature_id, image_id = data[i]
+        np.testing.assert_array_equal(chip, chips[i])
+        assert (label, feature_id, image_id) == (labels[i], i, 'img')
+    np.testing.assert_array_equal(data[-1][0], chips[-1])
+    with pytest.raises(IndexError):
+        data[len(labels)]
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_iter_batches(tmpdir, shuffle):
+    labels = np.array([0, 1, 2, 1, 0, 2, 1, 1, 0, 2])
+    chips = write_dataset(str(tmpdir), labels, classes=['a', 'b', 'c'])
+    data = cd.ChipDataset(str(tmpdir))
+
+    seen = []
+    for x, ids, y in data.iter_batches(batch_size=3, shuffle=shuffle, seed=1,
+                                       return_id=True):
+        assert x.dtype == np.float32
+        for chip, feature_id, label in zip(x, ids, y):
+            np.testing.assert_allclose(chip, chips[feature_id] / 255.)
+            assert label.tolist() == np.eye(3)[labels[feature_id]].tolist()
+        seen.extend(ids)
+    assert sorted(seen) == range(len(labels))
+
+
+def test_class_count_without_classes(tmpdir):
+    # the first shard only has label 0 and the last one only label 1
+    labels = np.array([0, 0, 0, 0, 0, 0, 1, 0, 1, 1])
+    write_dataset(str(tmpdir), labels, shard_size=4)
+    data = cd.ChipDataset(str(tmpdir))
+
+    assert data.nb_classes == 2
+    batches = list(data.iter_batches(batch_size=2, shuffle=False))
+    assert [y.shape for _, y in batches] == [(2, 2)] * 5
+    assert batches[0][1].tolist() == [[1, 0], [1, 0]]
+
+
+def test_unlabeled_chips(tmpdir):
+    writer = cd.ChipShardWriter(str(tmpdir), classes=['a', 'b'])
+    writer.add(make_chips(2), labels=[[0, 1], [1, 0]])
+    writer.add(make_chips(2))
+    writer.close()
+
+    _, y = next(cd.ChipDataset(str(tmpdir)).iter_batches(shuffle=False))
+    assert y.tolist() == [[0, 1], [1, 0], [0, 0], [0, 0]]
+
+
+def test_index_without_class_count(tmpdir):
+    write_dataset(str(tmpdir), np.array([0, 1, 0]))
+    index_file = str(tmpdir.join('index.json'))
+    with open(index_file) as f:
+        index = json.load(f)
+    del index['nb_classes']
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+
+    with pytest.raises(ValueError):
+        next(cd.ChipDataset(str(tmpdir)).iter_batches())
+
+
+def test_add_rejects_other_dtypes(tmpdir):
+    writer = cd.ChipShardWriter(str(tmpdir), dtype='uint8')
+    with pytest.raises(ValueError):
+        writer.add(make_chips(2, dtype='float32') / 255.)
+
+
+def test_export_chips(tmpdir):
+    shapefile = str(tmpdir.join('polygons.geojson'))
+    with open(shapefile, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'geometry': None,
+             'properties': {'feature_id': 'f{}'.format(i),
+                            'image_id': 'img{}'.format(i % 2)}}
+            for i in xrange(6)]}, f)
+    chips = make_chips(6)
+    batches = [[chips[:4], ['f0', 'f1', 'f2', 'f3'], np.eye(2)[[0, 1, 0, 1]]],
+               [chips[4:], ['f4', 'f5'], np.eye(2)[[1, 1]]]]
+    output_dir = str(tmpdir.join('dataset'))
+
+    assert cd.export_chips(batches, output_dir, shard_size=3, shapefile=shapefile,
+                           max_chips=5) == 5
+    data = cd.ChipDataset(output_dir)
+    assert [data[i][1:] for i in xrange(len(data))] == \
+        [(i % 2, 'f{}'.format(i), 'img{}'.format(i % 2)) for i in xrange(4)] + \
+        [(1, 'f4', 'img0')]
+
+    with pytest.raises(KeyError):
+        cd.export_chips([[chips[:1], ['unknown'], np.eye(2)[[0]]]],
+                        str(tmpdir.join('other')), shapefile=shapefile)
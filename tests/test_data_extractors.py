@@ -0,0 +1,530 @@
+import json
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+geoio = pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from osgeo import osr
+from mltools import data_extractors as de
+
+XSIZE, YSIZE, RES = 64, 48, 0.001
+ORIGIN = (10.0, 20.0)
+
+# polygons in (fractional) pixel coordinates
+POLYGONS = [
+    [(5.3, 4.2), (14.7, 6.1), (8.2, 15.6)],                  # interior
+    [(9.4, 9.3), (20.6, 8.7), (18.2, 19.5), (11.1, 17.4)],   # overlaps the first
+    [(40.3, 30.2), (50.6, 31.5), (45.5, 40.7)],              # another cell
+    [(58.4, 40.3), (66.2, 43.1), (60.5, 52.6)],              # right/bottom edge
+    [(-3.2, -2.5), (6.4, 1.3), (2.1, 7.7)],                  # left/top edge
+    [(80.2, 10.1), (90.3, 12.4), (85.6, 20.2)]]              # outside
+LEFT_TOP = 4
+
+
+def to_lnglat(x, y):
+    return [ORIGIN[0] + x * RES, ORIGIN[1] - y * RES]
+
+
+@pytest.fixture
+def scene(tmpdir):
+    image = str(tmpdir.join('image.tif'))
+    ds = gdal.GetDriverByName('GTiff').Create(image, XSIZE, YSIZE, 3,
+                                              gdal.GDT_Byte)
+    ds.SetGeoTransform((ORIGIN[0], RES, 0, ORIGIN[1], 0, -RES))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    data = np.random.RandomState(0).randint(1, 256, (3, YSIZE, XSIZE))
+    for b in range(3):
+        ds.GetRasterBand(b + 1).WriteArray(data[b].astype('uint8'))
+    ds = None
+
+    features = []
+    for i, polygon in enumerate(POLYGONS):
+        ring = [to_lnglat(x, y) for x, y in polygon + polygon[:1]]
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                         'properties': {'feature_id': i, 'image_id': 'image'}})
+    shapefile = str(tmpdir.join('polygons.geojson'))
+    with open(shapefile, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return image, shapefile, features
+
+
+def iter_vector_chips(image, shapefile, buffer, mask):
+    img = geoio.GeoImage(image)
+    chips = {}
+    for chip, properties in img.iter_vector(vector=shapefile, properties=True,
+                                            filter=[{'image_id': 'image'}],
+                                            buffer=buffer, mask=mask):
+        chips[properties['feature_id']] = chip
+    return chips
+
+
+def coalesced_chips(image, features, buffer, mask):
+    # a small grid, so that the scene has several buckets
+    return {properties['feature_id']: chip for chip, properties in
+            de._iter_coalesced(image, features, buffer=buffer, mask=mask,
+                               cell_size=16)}
+
+
+@pytest.mark.parametrize('buffer', [[0, 0], [2, 3]])
+def test_coalesced_chips_match_iter_vector(scene, buffer):
+    image, shapefile, features = scene
+    expected = iter_vector_chips(image, shapefile, buffer, False)
+    chips = coalesced_chips(image, features, buffer, False)
+
+    assert sorted(chips) == sorted(expected) == range(len(POLYGONS))
+    for feature_id, chip in chips.iteritems():
+        if expected[feature_id] is None:
+            assert chip is None
+        else:
+            assert chip.dtype == expected[feature_id].dtype
+            np.testing.assert_array_equal(chip, expected[feature_id])
+
+
+def test_coalesced_masks_match_iter_vector(scene):
+    image, shapefile, features = scene
+    expected = iter_vector_chips(image, shapefile, [0, 0], True)
+    chips = coalesced_chips(image, features, [0, 0], True)
+
+    # the first two windows overlap, so they are rasterized in two layers
+    for feature_id, chip in chips.iteritems():
+        if expected[feature_id] is None:
+            assert chip is None
+            continue
+        np.testing.assert_array_equal(np.ma.getdata(chip),
+                                      np.ma.getdata(expected[feature_id]))
+        if feature_id != LEFT_TOP:
+            # get_data shifts the mask of windows that cross the left or top
+            # edge (see _iter_coalesced)
+            np.testing.assert_array_equal(np.ma.getmaskarray(chip),
+                                          np.ma.getmaskarray(expected[feature_id]))
+
+
+def test_window_layers_are_disjoint():
+    windows = np.array([[0, 0, 10, 10], [5, 5, 15, 15], [10, 0, 20, 10],
+                        [0, 10, 10, 20], [2, 2, 8, 8], [30, 30, 40, 40]])
+    layers = de._window_layers(windows)
+
+    assert sorted(np.concatenate(layers)) == range(len(windows))
+    for layer in layers:
+        for i in layer:
+            for j in layer:
+                if i < j:
+                    a, b = windows[i], windows[j]
+                    assert (a[2] <= b[0] or b[2] <= a[0] or
+                            a[3] <= b[1] or b[3] <= a[1])
+    assert len(layers) == 3
+
+
+@pytest.mark.parametrize('coalesce', [False, True])
+def test_iter_vector_matches_iter_vector_of_geoio(scene, coalesce):
+    image, shapefile, features = scene
+    expected = iter_vector_chips(image, shapefile, [0, 0], True)
+    items = list(de._iter_vector(image, shapefile, 'image', mask=True,
+                                 coalesce=coalesce))
+
+    # one item per polygon
+    assert len(items) == len(POLYGONS)
+    for chip, properties in items:
+        if chip is None:
+            continue
+        feature_id = properties['feature_id']
+        np.testing.assert_array_equal(np.ma.getdata(chip),
+                                      np.ma.getdata(expected[feature_id]))
+        if feature_id != LEFT_TOP or not coalesce:
+            np.testing.assert_array_equal(np.ma.getmaskarray(chip),
+                                          np.ma.getmaskarray(expected[feature_id]))
+
+
+@pytest.mark.parametrize('coalesce', [False, True])
+def test_iter_vector_start(scene, coalesce):
+    image, shapefile, features = scene
+    items = list(de._iter_vector(image, shapefile, 'image', coalesce=coalesce))
+
+    for start in xrange(len(items) + 1):
+        rest = list(de._iter_vector(image, shapefile, 'image', coalesce=coalesce,
+                                    start=start))
+        assert len(rest) == len(items) - start
+        for (chip, properties), (expected, expected_properties) in \
+                zip(rest, items[start:]):
+            assert properties == expected_properties
+            if expected is None:
+                assert chip is None
+            else:
+                np.testing.assert_array_equal(chip, expected)
+
+
+# getIterData and get_iter_data, with chips read by a stand-in for
+# _get_feature_data: a chip of the side given by the 'size' property, filled with
+# the feature_id
+
+@pytest.fixture
+def polygons(tmpdir, monkeypatch):
+    def write_polygons(sizes, class_names, image_ids):
+        features = [{'type': 'Feature', 'geometry': None,
+                     'properties': {'feature_id': i, 'image_id': image_id,
+                                    'class_name': class_name, 'size': size}}
+                    for i, (size, class_name, image_id) in
+                    enumerate(zip(sizes, class_names, image_ids))]
+        with open('polygons.geojson', 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+        return 'polygons.geojson'
+
+    def read_chip(img, feature, buffer=[0, 0], mask=False, transform=None):
+        properties = feature['properties']
+        return np.full((1, properties['size'], properties['size']),
+                       properties['feature_id'], dtype='uint8')
+
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(de, '_get_feature_data', read_chip)
+    monkeypatch.setattr(de, '_image_transform', lambda ds: None)
+    monkeypatch.setattr(de.raster_pool, 'open_image', lambda image: None)
+    monkeypatch.setattr(de.raster_pool, 'open_dataset', lambda image: None)
+    return write_polygons
+
+
+def two_images(polygons, large=()):
+    # 35 polygons in image a, 25 in image b, classes x and y, all of size 3 but
+    # the ones in large
+    rng = np.random.RandomState(5)
+    image_ids = ['a'] * 35 + ['b'] * 25
+    rng.shuffle(image_ids)
+    class_names = rng.choice(['x', 'y'], 60).tolist()
+    sizes = [9 if i in large else 3 for i in xrange(60)]
+    return polygons(sizes, class_names, image_ids), class_names, image_ids
+
+
+def same_batches(batches, expected):
+    assert len(batches) == len(expected)
+    for batch, expected_batch in zip(batches, expected):
+        for a, b in zip(batch, expected_batch):
+            np.testing.assert_array_equal(a, b)
+
+
+ITER_DATA_CASES = [{}, {'shuffle': True},
+                   {'class_props': {'x': 0.5, 'y': 0.5}},
+                   {'shuffle': True, 'class_props': {'x': 0.25, 'y': 0.75}},
+                   {'prefetch': 2}]
+
+
+@pytest.mark.parametrize('kwargs', ITER_DATA_CASES)
+def test_get_iter_data_state(polygons, kwargs):
+    shapefile = two_images(polygons)[0]
+    # seed=None: the batch shares of the images are drawn at random, and the
+    # resumed instance must use the ones of the instance that saved the state
+    make = lambda **state: de.getIterData(shapefile, batch_size=8, max_chip_hw=5,
+                                          classes=['x', 'y'], return_id=True,
+                                          **dict(kwargs, **state))
+    g = make()
+    [g.next() for _ in xrange(5)]
+    state = json.loads(json.dumps(g.state()))
+    expected = [g.next() for _ in xrange(12)]
+
+    h = make(state=state)
+    assert h.props == g.props
+    same_batches([h.next() for _ in xrange(12)], expected)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_class_props(polygons, shuffle):
+    shapefile, class_names, image_ids = two_images(polygons)
+    g = de.getIterData(shapefile, batch_size=8, max_chip_hw=5, classes=['x', 'y'],
+                       return_id=True, shuffle=shuffle, seed=0,
+                       class_props={'x': 0.25, 'y': 0.75})
+    assert g.props == {'a': 5, 'b': 3}
+    # the rounding remainder goes to the largest classes
+    assert g.quotas == {'a': {'x': 1, 'y': 4}, 'b': {'x': 0, 'y': 3}}
+
+    for _ in xrange(20):
+        x, ids, y = g.next()
+        counts = {}
+        for feature_id, label in zip(ids, y.argmax(axis=1)):
+            assert class_names[feature_id] == ['x', 'y'][label]
+            key = (image_ids[feature_id], class_names[feature_id])
+            counts[key] = counts.get(key, 0) + 1
+        assert counts == {('a', 'x'): 1, ('a', 'y'): 4, ('b', 'y'): 3}
+    assert min(g.epochs.values()) > 0
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_class_props_unusable_class(polygons, shuffle):
+    # every chip of class y in image a is too large
+    rng = np.random.RandomState(5)
+    image_ids = ['a'] * 35 + ['b'] * 25
+    rng.shuffle(image_ids)
+    class_names = rng.choice(['x', 'y'], 60).tolist()
+    large = [i for i in xrange(60) if (image_ids[i], class_names[i]) == ('a', 'y')]
+    shapefile = two_images(polygons, large=large)[0]
+
+    g = de.getIterData(shapefile, batch_size=8, max_chip_hw=5, classes=['x', 'y'],
+                       return_id=True, shuffle=shuffle, seed=0,
+                       class_props={'x': 0.25, 'y': 0.75})
+    for _ in xrange(20):
+        x, ids, y = g.next()
+        assert len(ids) == 8
+        assert not set(ids) & set(large)
+    assert g.quotas['a'] == {'x': 5}
+    assert g.epochs['a'] > 1
+
+
+def test_class_props_without_classes_of_image(polygons):
+    shapefile = polygons([3] * 4, ['x', 'x', 'y', 'z'], ['a', 'a', 'b', 'b'])
+    with pytest.raises(ValueError):
+        de.getIterData(shapefile, batch_size=4, max_chip_hw=5, classes=['x', 'y'],
+                       class_props={'y': 0.5, 'z': 0.5})
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'shuffle': True},
+                                    {'class_props': {'x': 0.5, 'y': 0.5}}])
+def test_no_usable_chips(polygons, kwargs):
+    shapefile = polygons([3, 3, 9, 9], ['x', 'y', 'x', 'y'], ['a', 'a', 'b', 'b'])
+    g = de.getIterData(shapefile, batch_size=4, max_chip_hw=5, classes=['x', 'y'],
+                       **kwargs)
+    with pytest.raises(ValueError):
+        g.next()
+
+
+def test_shuffle(polygons):
+    shapefile, class_names, image_ids = two_images(polygons)
+    g = de.getIterData(shapefile, batch_size=12, max_chip_hw=5, classes=['x', 'y'],
+                       return_id=True, shuffle=True, seed=0)
+
+    # one epoch of image a is 35 chips, which is exactly 7 of its batch shares
+    chips = g.yield_from_img_id('a', batch=5, repeat=True)
+    epochs = [[feature_id for _ in xrange(7) for feature_id in chips.next()[1]]
+              for _ in xrange(2)]
+    for epoch in epochs:
+        assert sorted(epoch) == [i for i in xrange(60) if image_ids[i] == 'a']
+    assert epochs[0] != epochs[1]
+    # the second epoch ends when the generator looks for the next polygon
+    assert g.epochs['a'] == 1
+
+    # chips of a batch are tied to their feature_id and label
+    x, ids, y = g.next()
+    for chip, feature_id, label in zip(x, ids, y):
+        assert chip.max() * 255 == pytest.approx(feature_id)
+        assert class_names[feature_id] == ['x', 'y'][label.argmax()]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'prefetch': 2}])
+def test_get_iter_data_state_resumes(polygons, kwargs):
+    shapefile = two_images(polygons, large=[2, 3, 30])[0]
+    make = lambda state=None: de.get_iter_data(shapefile, batch_size=7,
+                                               max_chip_hw=5, classes=['x', 'y'],
+                                               return_id=True, state=state, **kwargs)
+    expected = list(make())
+    state = {}
+    g = make(state)
+    [g.next() for _ in xrange(3)]
+    state = json.loads(json.dumps(state))
+
+    same_batches(list(make(state)), expected[3:])
+
+
+def test_batch_prefetcher():
+    g = de.BatchPrefetcher(iter(range(10)), depth=3)
+    assert list(g) == range(10)
+    assert g.stats()['batches'] == 10
+    with pytest.raises(StopIteration):
+        g.next()
+
+
+def test_batch_prefetcher_error():
+    def batches():
+        yield 1
+        raise KeyError('source failed')
+
+    g = de.BatchPrefetcher(batches())
+    assert g.next() == 1
+    with pytest.raises(KeyError):
+        g.next()
+
+
+def test_batch_prefetcher_close():
+    source = {'produced': 0, 'closed': False}
+
+    def batches():
+        try:
+            while True:
+                source['produced'] += 1
+                yield source['produced']
+        finally:
+            source['closed'] = True
+
+    g = de.BatchPrefetcher(batches(), depth=2)
+    assert g.next() == 1
+    g.close()
+
+    assert not g.thread.is_alive()
+    assert source['closed']
+    # at most the queued batches and the one waiting for room were produced
+    assert source['produced'] <= 4
+    with pytest.raises(StopIteration):
+        g.next()
+
+
+# apply_mask, random_window_batch and sliding_window on GeoTIFFs of known pixels
+
+def write_image(file_name, data, data_type=gdal.GDT_UInt16, options=['TILED=YES']):
+    ds = gdal.GetDriverByName('GTiff').Create(file_name, data.shape[2], data.shape[1],
+                                              data.shape[0], data_type, options)
+    ds.SetGeoTransform((ORIGIN[0], RES, 0, ORIGIN[1], 0, -RES))
+    for b in xrange(data.shape[0]):
+        ds.GetRasterBand(b + 1).WriteArray(data[b])
+    ds.FlushCache()
+    return file_name
+
+
+def read_image(file_name):
+    ds = gdal.Open(file_name)
+    data = ds.ReadAsArray()
+    return data.reshape((ds.RasterCount,) + data.shape[-2:])
+
+
+def random_pixels(shape, zero_lines=0, seed=0):
+    # uint16 pixels over 8 bits, zero in all bands in the first zero_lines lines
+    data = np.random.RandomState(seed).randint(1, 2 ** 11, shape).astype('uint16')
+    data[:, :zero_lines] = 0
+    return data
+
+
+@pytest.mark.parametrize('options', [['TILED=YES'], []])
+@pytest.mark.parametrize('nodata', [None, 7])
+def test_apply_mask(tmpdir, options, nodata):
+    data = random_pixels((3, 300, 280))
+    mask = np.random.RandomState(1).randint(0, 2, (1, 300, 280)).astype('uint8')
+    image = write_image(str(tmpdir.join('image.tif')), data, options=options)
+    mask_file = write_image(str(tmpdir.join('mask.tif')), mask, gdal.GDT_Byte)
+    output_file = str(tmpdir.join('masked.tif'))
+
+    report = de.apply_mask(image, mask_file, output_file, workers=3, tile_lines=16,
+                           nodata=nodata)
+
+    masked = read_image(output_file)
+    assert masked.dtype == np.uint16
+    np.testing.assert_array_equal(masked, np.where(mask > 0, data, nodata or 0))
+    assert report['bytes'] == data.nbytes
+    ds = gdal.Open(output_file)
+    assert ds.GetGeoTransform() == gdal.Open(image).GetGeoTransform()
+    assert ds.GetRasterBand(1).GetNoDataValue() == nodata
+
+
+def test_random_window_batch(tmpdir):
+    data = random_pixels((2, 90, 70))
+    image = write_image(str(tmpdir.join('image.tif')), data)
+
+    chips, locations = de.random_window_batch(image, [12, 8], no_chips=50, seed=3)
+
+    # chips come in draw order, each with the pixels at its location
+    rng = np.random.RandomState(3)
+    xs, ys = rng.randint(0, 70 - 12 + 1, 50), rng.randint(0, 90 - 8 + 1, 50)
+    np.testing.assert_array_equal(locations, np.column_stack((xs, ys)))
+    assert chips.shape == (50, 2, 8, 12) and chips.dtype == np.uint16
+    for chip, (x, y) in zip(chips, locations):
+        np.testing.assert_array_equal(chip, data[:, y:y + 8, x:x + 12])
+
+
+def test_random_window_batch_reject(tmpdir):
+    # the upper half of the image is zero (land)
+    data = random_pixels((2, 80, 60), zero_lines=40)
+    image = write_image(str(tmpdir.join('image.tif')), data)
+
+    chips, locations = de.random_window_batch(image, [10, 10], no_chips=40,
+                                              reject=de.mostly_zero, seed=0)
+
+    assert len(chips) == 40
+    for chip, (x, y) in zip(chips, locations):
+        np.testing.assert_array_equal(chip, data[:, y:y + 10, x:x + 10])
+        assert not de.mostly_zero(chip)
+        assert y > 40 - 5
+
+    # rejected draws are replaced for max_rounds rounds at most
+    chips, locations = de.random_window_batch(image, [10, 10], no_chips=40,
+                                              reject=lambda chip: True, max_rounds=3)
+    assert chips.shape == (0, 2, 10, 10) and locations.shape == (0, 2)
+
+
+def test_mostly_zero():
+    chip = np.ones((2, 4, 4))
+    chip[:, :2] = 0
+    assert de.mostly_zero(chip)
+    chip[1, 0, 0] = 5      # not zero in all bands
+    assert not de.mostly_zero(chip)
+    assert de.mostly_zero(chip, fraction=0.25)
+
+
+def reference_windows(data, chip_size, stride, max_zero_fraction=None,
+                      max_zeros=None):
+    # every window of the grid, checked one at a time
+    (xsize, ysize), (stride_x, stride_y) = chip_size, stride
+    windows = {}
+    for y in xrange(0, data.shape[1] - ysize + 1, stride_y):
+        for x in xrange(0, data.shape[2] - xsize + 1, stride_x):
+            chip = data[:, y:y + ysize, x:x + xsize]
+            if max_zero_fraction is not None and \
+                    np.all(chip == 0, axis=0).sum() >= max_zero_fraction * xsize * ysize:
+                continue
+            if max_zeros is not None and np.sum(chip == 0) >= max_zeros:
+                continue
+            windows[(x, y)] = chip
+    return windows
+
+
+@pytest.mark.parametrize('chip_size, stride, tile_lines, tile_columns', [
+    ([10, 10], None, 512, None),
+    ([10, 10], None, 25, None),
+    ([12, 7], [5, 3], 20, None),
+    ([12, 7], [5, 3], 20, 31),
+    ([9, 9], [9, 4], 1, 1)])
+@pytest.mark.parametrize('filters', [{}, {'max_zero_fraction': 0.5},
+                                     {'max_zeros': 60}])
+def test_sliding_window(tmpdir, chip_size, stride, tile_lines, tile_columns,
+                        filters):
+    data = random_pixels((2, 67, 53), zero_lines=20)
+    data[0, 30:40] = 0      # zero in one band only
+    image = write_image(str(tmpdir.join('image.tif')), data)
+
+    batches = list(de.sliding_window(image, chip_size, stride=stride, batch_size=8,
+                                     tile_lines=tile_lines,
+                                     tile_columns=tile_columns, **filters))
+
+    expected = reference_windows(data, chip_size, stride or chip_size, **filters)
+    assert all(len(chips) == 8 for chips, _ in batches[:-1])
+    windows = {}
+    for chips, locations in batches:
+        assert chips.dtype == np.uint16
+        for chip, (x, y) in zip(chips, locations):
+            assert (x, y) not in windows
+            windows[(x, y)] = chip
+    assert sorted(windows) == sorted(expected)
+    for location, chip in windows.iteritems():
+        np.testing.assert_array_equal(chip, expected[location])
+
+
+def test_sliding_window_dtype(tmpdir):
+    data = random_pixels((1, 20, 20))
+    image = write_image(str(tmpdir.join('image.tif')), data)
+
+    chips, locations = next(de.sliding_window(image, [20, 20], dtype='float32',
+                                              normalize=True))
+    assert chips.dtype == np.float32
+    np.testing.assert_allclose(chips[0], data / 255., rtol=1e-6)
+    assert list(de.sliding_window(image, [21, 20])) == []
+
+
+@pytest.mark.parametrize('shape, win_size, stride', [
+    ((30, 40), (5, 5), (5, 5)), ((30, 40), (7, 4), (3, 2)),
+    ((30, 40), (40, 30), (1, 1)), ((9, 13), (1, 1), (1, 1))])
+def test_window_sums(shape, win_size, stride):
+    values = np.random.RandomState(0).randint(0, 5, shape)
+    sums = de._window_sums(values, win_size, stride)
+
+    (win_xsize, win_ysize), (stride_x, stride_y) = win_size, stride
+    expected = [[values[y:y + win_ysize, x:x + win_xsize].sum()
+                 for x in xrange(0, shape[1] - win_xsize + 1, stride_x)]
+                for y in xrange(0, shape[0] - win_ysize + 1, stride_y)]
+    assert sums.tolist() == expected
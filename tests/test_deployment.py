@@ -0,0 +1,78 @@
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools import data_extractors as de
+from mltools import deployment
+
+
+@pytest.fixture
+def windows(monkeypatch):
+    # sliding_window stand-in: 5 batches of 4 chips, whose pixels are the window
+    # number; records the arguments and whether it was closed
+    source = {'closed': False, 'batches': 0}
+
+    def sliding_window(image, chip_size, **kwargs):
+        source['kwargs'] = kwargs
+        try:
+            for b in xrange(5):
+                numbers = np.arange(4 * b, 4 * b + 4)
+                chips = np.ones((4, 2) + tuple(chip_size[::-1]), dtype='float32') * \
+                    numbers[:, None, None, None]
+                locations = np.stack([numbers * chip_size[0], numbers * 0], axis=1)
+                source['batches'] += 1
+                yield chips, locations
+        finally:
+            source['closed'] = True
+
+    monkeypatch.setattr(de, 'sliding_window', sliding_window)
+    return source
+
+
+def predict(chips):
+    return chips.reshape(len(chips), -1).mean(axis=1)
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_deploy(windows, prefetch):
+    results = list(deployment.deploy('image.tif', predict, [3, 2], batch_size=4,
+                                     tile_size=[100, 50], max_zeros=3,
+                                     prefetch=prefetch))
+
+    assert np.concatenate([p for _, p in results]).tolist() == range(20)
+    assert np.concatenate([l for l, _ in results])[:, 0].tolist() == \
+        range(0, 60, 3)
+    assert windows['kwargs']['tile_columns'] == 100
+    assert windows['kwargs']['tile_lines'] == 50
+    assert windows['kwargs']['max_zeros'] == 3
+
+
+def test_deploy_compute_features(windows):
+    results = deployment.deploy('image.tif', lambda x: x[:, 0], [3, 2],
+                                compute_features=lambda chip: [chip.sum()])
+    locations, predictions = next(results)
+    assert predictions.tolist() == [i * 12. for i in xrange(4)]
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 2])
+def test_deploy_stops_reading_on_break(windows, prefetch):
+    threads = threading.active_count()
+    for locations, predictions in deployment.deploy('image.tif', predict, [3, 2],
+                                                    prefetch=prefetch):
+        break
+
+    assert windows['closed']
+    assert windows['batches'] < 5
+    assert threading.active_count() == threads
+
+
+def test_deploy_predict_error(windows):
+    def fail(chips):
+        raise RuntimeError('predict failed')
+
+    with pytest.raises(RuntimeError):
+        list(deployment.deploy('image.tif', fail, [3, 2], prefetch=2))
+    assert windows['closed']
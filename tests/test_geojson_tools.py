@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools import geojson_tools as gt
+
+CHUNK_SIZES = [1, 2, 3, 7, 2 ** 20]
+
+
+def make_features(n):
+    names = [u'pool', u'piscine \xe9t\xe9', u'游泳池', u'\U0001f3ca swim']
+    return [{'type': 'Feature',
+             'geometry': {'type': 'Point', 'coordinates': [0.5 + i, -1e-7 * i]},
+             'properties': {'feature_id': i, 'image_id': 'img{}'.format(i % 3),
+                            'class_name': names[i % len(names)],
+                            'score': None if i % 5 == 0 else 0.25 * i,
+                            'tags': [True, False, {'nested': [i, u'"\\']}]}}
+            for i in xrange(n)]
+
+
+def write(tmpdir, text, name='collection.geojson'):
+    path = tmpdir.join(name)
+    with open(str(path), 'wb') as f:
+        f.write(text.encode('utf-8') if isinstance(text, unicode) else text)
+    return str(path)
+
+
+@pytest.fixture(params=[False, True], ids=['utf8', 'ascii'])
+def collection(tmpdir, request):
+    # header members before and after the features, non-ASCII text that is
+    # split across chunks with small chunk sizes
+    text = (u'{ "type" : "FeatureCollection",\n "name": "caf\xe9",\n'
+            u' "features" : [\n  ' +
+            u',\n  '.join(json.dumps(f, ensure_ascii=request.param)
+                          for f in make_features(23)) +
+            u'\n ] ,\r\n "crs": {"type": "name", "properties": '
+            u'{"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}, "count": 23}\n')
+    return write(tmpdir, text)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_features_matches_json_load(collection, chunk_size):
+    with open(collection) as f:
+        expected = json.load(f)
+
+    header = {}
+    features = list(gt.iter_features(collection, header=header,
+                                     chunk_size=chunk_size))
+
+    assert features == expected['features']
+    del expected['features']
+    assert header == expected
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_features_offsets(collection, chunk_size):
+    items = list(gt.iter_features(collection, chunk_size=chunk_size,
+                                  with_offsets=True))
+    offsets = [offset for offset, _ in items]
+
+    assert offsets == sorted(offsets)
+    assert list(gt.read_features(collection, reversed(offsets))) == \
+        [feature for _, feature in reversed(items)]
+
+
+@pytest.mark.parametrize('text', ['{}', '{"type": "FeatureCollection"}',
+                                  '{"features": []}',
+                                  ' {\n"features" :[ ] , "type":"FeatureCollection" }'])
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_features_empty(tmpdir, text, chunk_size):
+    header = {}
+    assert list(gt.iter_features(write(tmpdir, text), header=header,
+                                 chunk_size=chunk_size)) == []
+    expected = json.loads(text)
+    expected.pop('features', None)
+    assert header == expected
+
+
+@pytest.mark.parametrize('text', ['', '[]', '{"features": [{}', '{"features": [1 2]}'])
+def test_iter_features_invalid(tmpdir, text):
+    with pytest.raises(ValueError):
+        list(gt.iter_features(write(tmpdir, text), chunk_size=2))
+
+
+def test_get_from_matches_full_load(collection):
+    with open(collection) as f:
+        features = json.load(f)['features']
+    expected = [(feat['properties'].get('feature_id'),
+                 feat['properties'].get('class_name')) for feat in features]
+
+    assert gt.get_from(collection, ['feature_id', 'class_name']) == expected
+
+
+def where_join(data, property_names, features, filter_name, filter_values):
+    # write_properties_to with a filter, as it was before the values were joined
+    # by index: one np.where per feature
+    filter_values = np.array(filter_values)
+    for feature in features:
+        ind = np.where(filter_values == feature['properties'][filter_name])[0]
+        if len(ind) > 0:
+            for j, property_value in enumerate(data[ind[0]]):
+                feature['properties'][property_names[j]] = property_value
+    return features
+
+
+@pytest.mark.parametrize('ids, values', [
+    (range(40), [7, 0, 39, 12, 3, 100, 25]),                         # numeric
+    (range(40), [7.0, 0.0, 39.0, 12.5]),                             # int vs float
+    (range(40), ['7', '0', '39']),                                   # int vs string
+    (['id{}'.format(i) for i in xrange(40)], ['id7', u'id0', 'id39', 'x']),
+    (['{}'.format(i) for i in xrange(40)], [7, 0, 39]),              # string vs int
+    ([None, 'a', 3, 2.5] * 10, ['a', 3, 2.5])])                      # mixed
+def test_write_properties_to_filter_matches_where(tmpdir, ids, values):
+    features = make_features(len(ids))
+    for feature, feature_id in zip(features, ids):
+        feature['properties']['feature_id'] = feature_id
+    input_file = write(tmpdir, json.dumps({'type': 'FeatureCollection',
+                                           'features': features}))
+    output_file = str(tmpdir.join('output.geojson'))
+    data = [(i, 'class {}'.format(i)) for i in xrange(len(values))]
+
+    gt.write_properties_to(data, ['score', 'class_name'], input_file, output_file,
+                           filter={'feature_id': values})
+
+    with open(input_file) as f:
+        expected = where_join(data, ['score', 'class_name'],
+                              json.load(f)['features'], 'feature_id', values)
+    with open(output_file) as f:
+        assert json.load(f)['features'] == expected
+
+
+def test_write_properties_to_length_mismatch(tmpdir):
+    features = make_features(10)
+    input_file = write(tmpdir, json.dumps({'type': 'FeatureCollection',
+                                           'features': features}))
+    output_file = str(tmpdir.join('output.geojson'))
+
+    # one entry for three values: the second and third match no data entry
+    report = gt.write_properties_to([('x',)], ['class_name'], input_file,
+                                    output_file, filter={'feature_id': [4, 5, 6]})
+
+    assert report['written'] == 10
+    assert report['matched'] == 1
+    assert report['no_data'] == 2
+    written = list(gt.iter_features(output_file))
+    assert [f['properties']['class_name'] for f in written[4:7]] == \
+        ['x', features[5]['properties']['class_name'],
+         features[6]['properties']['class_name']]
+
+
+@pytest.mark.parametrize('max_open', [1, 2, 128])
+def test_shard_by_property(tmpdir, max_open):
+    features = make_features(60)
+    for feature in features[::7]:
+        del feature['properties']['image_id']
+    input_file = write(tmpdir, json.dumps({'type': 'FeatureCollection',
+                                           'features': features,
+                                           'crs': {'type': 'name'}}))
+
+    counts = gt.shard(input_file, 'image_id', max_open=max_open)
+
+    assert sum(counts.values()) == len(features)
+    for value in ['img0', 'img1', 'img2', None]:
+        output_file = str(tmpdir.join('collection_{}.geojson'.format(value)))
+        with open(output_file) as f:
+            collection = json.load(f)
+        assert collection['crs'] == {'type': 'name'}
+        assert collection['features'] == \
+            [feat for feat in features if feat['properties'].get('image_id') == value]
+        assert counts[output_file] == len(collection['features'])
+    assert not [name for name in tmpdir.listdir() if name.ext == '.tmp']
+
+
+def test_feature_writer_pause(tmpdir):
+    output_file = str(tmpdir.join('output.geojson'))
+    features = make_features(5)
+    with gt.FeatureWriter(output_file, {'crs': {'type': 'name'}}) as writer:
+        for feature in features:
+            writer.pause()
+            writer.write(feature)
+            writer.pause()
+
+    with open(output_file) as f:
+        assert json.load(f) == {'type': 'FeatureCollection', 'features': features,
+                                'crs': {'type': 'name'}}
+
+
+def test_shard_non_ascii_values(tmpdir):
+    features = make_features(8)
+    input_file = write(tmpdir, json.dumps({'type': 'FeatureCollection',
+                                           'features': features}))
+
+    counts = gt.shard(input_file, 'class_name')
+
+    names = [u'pool', u'piscine \xe9t\xe9', u'游泳池', u'\U0001f3ca swim']
+    assert sorted(counts.values()) == [2, 2, 2, 2]
+    for name in names:
+        output_file = str(tmpdir.join(u'collection_{}.geojson'.format(name)
+                                      .encode('utf-8')))
+        assert counts[output_file] == 2
+        assert [feat['properties']['class_name']
+                for feat in gt.iter_features(output_file)] == [name, name]
+
+
+@pytest.mark.parametrize('value', ['a/b', '..', u'\xe9/..'])
+def test_shard_rejects_paths(tmpdir, value):
+    features = make_features(3)
+    features[1]['properties']['image_id'] = value
+    input_file = write(tmpdir, json.dumps({'type': 'FeatureCollection',
+                                           'features': features}))
+
+    with pytest.raises(ValueError):
+        gt.shard(input_file, 'image_id')
+    assert sorted(name.basename for name in tmpdir.listdir()) == \
+        ['collection.geojson']
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools import metrics
+from mltools.metrics import ExtractionMetrics
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # a clock that only moves when the test moves it
+    now = [1000.]
+    monkeypatch.setattr(metrics.time, 'time', lambda: now[0])
+    return now
+
+
+def test_counts(clock):
+    m = ExtractionMetrics()
+    chip = np.zeros((3, 4, 5), dtype='uint16')
+    m.add_chip(chip)
+    m.add_chip(chip)
+    m.reject('too_large', chip)
+    m.reject('missing_label')
+    clock[0] += 2
+
+    summary = m.summary()
+    assert summary['chips'] == 2
+    assert summary['rejected'] == 2
+    assert summary['rejects'] == {'too_large': 1, 'missing_label': 1}
+    assert summary['bytes_read'] == 3 * chip.nbytes
+    assert summary['seconds'] == 2
+    assert summary['chips_per_s'] == 1
+    assert summary['mb_per_s'] == 3 * chip.nbytes / 1e6 / 2
+
+    m.reset()
+    assert m.summary()['chips'] == 0 and m.summary()['rejects'] == {}
+
+
+def test_stage_times(clock):
+    m = ExtractionMetrics()
+    with m.timer('pad'):
+        clock[0] += 0.5
+
+    def items():
+        for i in xrange(3):
+            clock[0] += 1
+            yield i
+        clock[0] += 0.25
+
+    for item in m.timed(items(), 'read'):
+        clock[0] += 10      # time spent by the consumer is not counted
+
+    assert m.summary()['times'] == {'pad': 0.5, 'read': 3.25}
+
+
+def test_timer_counts_errors(clock):
+    m = ExtractionMetrics()
+    with pytest.raises(ValueError):
+        with m.timer('read'):
+            clock[0] += 1
+            raise ValueError
+    assert m.times['read'] == 1
+
+
+def test_progress_rate(clock):
+    summaries = []
+    m = ExtractionMetrics(callback=summaries.append, interval=1.)
+    for _ in xrange(10):
+        m.add_chip(None)
+        clock[0] += 0.25
+
+    # reported at most once per interval, not at every chip
+    assert [s['chips'] for s in summaries] == [5, 9]
@@ -0,0 +1,87 @@
+import pickle
+import numpy as np
+import pytest
+
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools.packed_chips import PackedChips
+
+
+def make_chips(masked=False, dtype='uint16'):
+    rng = np.random.RandomState(0)
+    chips = [rng.randint(0, 1000, shape).astype(dtype)
+             for shape in [(3, 4, 5), (3, 1, 7), (1, 6, 2), (3, 0, 4), (2, 3, 3)]]
+    if masked:
+        chips = [np.ma.masked_array(chip, mask=rng.rand(*chip.shape) < 0.3)
+                 for chip in chips]
+    return chips
+
+
+def assert_same_chips(packed, chips):
+    assert len(packed) == len(chips)
+    for chip, expected in zip(packed, chips):
+        assert chip.shape == expected.shape
+        assert chip.dtype == np.ma.getdata(expected).dtype
+        assert isinstance(chip, np.ma.MaskedArray) == \
+            isinstance(expected, np.ma.MaskedArray)
+        np.testing.assert_array_equal(np.ma.getdata(chip), np.ma.getdata(expected))
+        np.testing.assert_array_equal(np.ma.getmaskarray(chip),
+                                      np.ma.getmaskarray(expected))
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_from_chips(masked):
+    chips = make_chips(masked)
+    packed = PackedChips.from_chips(chips)
+
+    assert_same_chips(packed, chips)
+    assert packed.data.size == sum(chip.size for chip in chips)
+    np.testing.assert_array_equal(packed[-1], chips[-1])
+    with pytest.raises(IndexError):
+        packed[len(chips)]
+    # chips are views of the buffer
+    assert np.ma.getdata(packed[0]).base is not None
+
+
+def test_from_chips_promotes_dtypes():
+    chips = [np.ones((1, 2, 2), dtype='uint8'), np.full((1, 1, 3), 0.5, dtype='float32')]
+    packed = PackedChips.from_chips(chips)
+
+    assert packed.data.dtype == np.float32
+    np.testing.assert_array_equal(packed[1], chips[1])
+
+
+def test_empty():
+    packed = PackedChips.from_chips([])
+    assert len(packed) == 0
+    assert list(packed) == []
+
+
+def test_concatenate():
+    plain, masked = make_chips(), make_chips(masked=True)
+    packed = PackedChips.concatenate([PackedChips.from_chips(plain[:2]),
+                                      PackedChips.from_chips([]),
+                                      PackedChips.from_chips(masked[2:])])
+
+    # collections without masks get an all-false mask
+    expected = [np.ma.masked_array(chip) for chip in plain[:2]] + masked[2:]
+    assert_same_chips(packed, expected)
+    assert len(PackedChips.concatenate([])) == 0
+
+
+@pytest.mark.parametrize('masked', [False, True])
+@pytest.mark.parametrize('mmap', [False, True])
+def test_save_load(tmpdir, masked, mmap):
+    chips = make_chips(masked)
+    PackedChips.from_chips(chips).save(str(tmpdir.join('chips')))
+    packed = PackedChips.load(str(tmpdir.join('chips')), mmap=mmap)
+
+    assert isinstance(packed.data, np.memmap) == mmap
+    assert_same_chips(packed, chips)
+
+
+def test_pickle():
+    chips = make_chips(masked=True)
+    assert_same_chips(pickle.loads(pickle.dumps(PackedChips.from_chips(chips), 2)),
+                      chips)
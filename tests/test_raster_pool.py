@@ -0,0 +1,92 @@
+import os
+import threading
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+pytest.importorskip('geoio')
+pytest.importorskip('psycopg2')     # imported by mltools.crowdsourcing
+
+from mltools.raster_pool import RasterPool
+
+
+def write_image(file_name, value=1, xsize=8):
+    ds = gdal.GetDriverByName('GTiff').Create(file_name, xsize, 6, 1, gdal.GDT_Byte)
+    ds.GetRasterBand(1).WriteArray(np.full((6, xsize), value, dtype='uint8'))
+    ds.FlushCache()
+    return file_name
+
+
+@pytest.fixture
+def images(tmpdir):
+    return [write_image(str(tmpdir.join('image{}.tif'.format(i)))) for i in xrange(3)]
+
+
+def test_reuses_handles(images):
+    pool = RasterPool()
+    ds = pool.dataset(images[0])
+
+    assert pool.dataset(images[0]) is ds
+    assert pool.dataset(images[1]) is not ds
+    assert pool.stats() == {'hits': 1, 'misses': 2, 'evictions': 0, 'open': 2}
+
+
+def test_evicts_least_recently_used(images):
+    pool = RasterPool(max_open=2)
+    first = pool.dataset(images[0])
+    pool.dataset(images[1])
+    pool.dataset(images[0])         # images[1] is now the least recently used
+    pool.dataset(images[2])
+
+    assert pool.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, 'open': 2}
+    assert pool.dataset(images[0]) is first
+    pool.dataset(images[1])
+    assert pool.stats()['misses'] == 4
+
+    pool.clear()
+    assert pool.stats() == {'hits': 0, 'misses': 0, 'evictions': 0, 'open': 0}
+
+
+def test_reopens_rewritten_files(images):
+    pool = RasterPool()
+    ds = pool.dataset(images[0])
+    # a different size, so that the key changes within the mtime resolution
+    write_image(images[0], value=2, xsize=9)
+
+    reopened = pool.dataset(images[0])
+    assert reopened is not ds
+    assert reopened.ReadAsArray().max() == 2
+
+
+def test_handles_are_per_thread(images):
+    pool = RasterPool()
+    ds = pool.dataset(images[0])
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.dataset(images[0])))
+    thread.start()
+    thread.join()
+
+    assert other[0] is not None and other[0] is not ds
+    assert pool.dataset(images[0]) is ds
+
+
+def test_fork_starts_with_an_empty_pool(images):
+    pool = RasterPool()
+    ds = pool.dataset(images[0])
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child: the handle of the parent must not be reused
+        try:
+            ok = pool.dataset(images[0]) is not ds and \
+                pool.stats() == {'hits': 0, 'misses': 1, 'evictions': 0, 'open': 1}
+            os.write(write, 'ok' if ok else 'no')
+        finally:
+            os._exit(0)
+    os.close(write)
+    result = os.read(read, 2)
+    os.waitpid(pid, 0)
+
+    assert result == 'ok'
+    assert pool.dataset(images[0]) is ds